@@ -86,10 +86,12 @@ class GranularBackend(ModelBackend):
         return obj_perms
 
         
-    def objects_with_perm(self, user_obj, perm, ModelType):
+    def objects_with_perm(self, user_obj, perm, ModelType, object_ids=None):
         """
         select identifiers of objects the type specified that the 
         user specified has the permission 'perm' for.
+
+        if object_ids is given, only those identifiers are considered.
         """
 
         if not isinstance(perm, Permission):
@@ -97,20 +99,71 @@ class GranularBackend(ModelBackend):
         ct = ContentType.objects.get_for_model(ModelType)
         
         obj_ids = set()
+        id_filter = {}
+        if object_ids is not None:
+            id_filter['object_id__in'] = list(object_ids)
     
         generic_roles = [ANONYMOUS_USERS]
         if not user_obj.is_anonymous():
             generic_roles.append(AUTHENTICATED_USERS)
             obj_ids.update([x[0] for x in UserObjectRoleMapping.objects.filter(user=user_obj,
                                                                                role__permissions=perm,
-                                                                               object_ct=ct).values_list('object_id')])
+                                                                               object_ct=ct,
+                                                                               **id_filter).values_list('object_id')])
         
         obj_ids.update([x[0] for x in GenericObjectRoleMapping.objects.filter(subject__in=generic_roles, 
                                                                               role__permissions=perm,
-                                                                              object_ct=ct).values_list('object_id')])
+                                                                              object_ct=ct,
+                                                                              **id_filter).values_list('object_id')])
     
         return obj_ids
         
+    def objects_with_perms(self, user_obj, perms, ModelType, object_ids=None):
+        """
+        like objects_with_perm, but for several permissions at once.  returns
+        a dict mapping each permission name in perms to the set of 
+        identifiers of objects the user has that permission for.
+        """
+        ct = ContentType.objects.get_for_model(ModelType)
+        names = {}
+        for p in Permission.objects.filter(content_type=ct, codename__in=[
+                perm[perm.index('.')+1:] for perm in perms]):
+            names[p.id] = '%s.%s' % (ct.app_label, p.codename)
+
+        obj_ids = dict((perm, set()) for perm in perms)
+        id_filter = {}
+        if object_ids is not None:
+            id_filter['object_id__in'] = list(object_ids)
+
+        mappings = []
+        generic_roles = [ANONYMOUS_USERS]
+        if not user_obj.is_anonymous():
+            generic_roles.append(AUTHENTICATED_USERS)
+            mappings.append(UserObjectRoleMapping.objects.filter(user=user_obj, 
+                                                                 object_ct=ct, 
+                                                                 **id_filter))
+        mappings.append(GenericObjectRoleMapping.objects.filter(subject__in=generic_roles, 
+                                                                object_ct=ct,
+                                                                **id_filter))
+        role_objects = []
+        for qs in mappings:
+            role_objects.extend(qs.filter(role__permissions__in=names.keys()).values_list('role', 'object_id'))
+
+        # the permission names each of those roles grants
+        RolePermission = ObjectRole.permissions.through
+        role_perms = {}
+        for role_id, perm_id in RolePermission.objects.filter(
+                objectrole__in=set(r for r, o in role_objects), 
+                permission__in=names.keys()).values_list('objectrole', 'permission'):
+            role_perms.setdefault(role_id, []).append(names[perm_id])
+
+        for role_id, object_id in role_objects:
+            for perm in role_perms.get(role_id, []):
+                if perm in obj_ids:
+                    obj_ids[perm].add(object_id)
+
+        return obj_ids
+
     def _permission_for_name(self, perm):
         ps = perm.index('.')
         app_label = perm[0:ps]
@@ -3,25 +3,171 @@ from datetime import date
 from django.conf import settings
 from django.template import Context
 from django.template.loader import get_template
-from owslib.csw import CatalogueServiceWeb, namespaces
+from owslib.csw import namespaces
+from geonode.maps.cswsearch import get_csw_client, metadata_cache
 from owslib.util import nspath
+from StringIO import StringIO
 from xml.dom import minidom
-from xml.etree.ElementTree import XML
+from xml.etree.ElementTree import XML, iterparse
+import hashlib
+import logging
+import threading
+import time
 
+logger = logging.getLogger("geonode.geonetwork")
+
+_CSW = "{http://www.opengis.net/cat/csw/2.0.2}"
+_OWS = "{http://www.opengis.net/ows}"
+_TOTALS = {
+    "insert": _CSW + "TransactionSummary/" + _CSW + "totalInserted",
+    "update": _CSW + "TransactionSummary/" + _CSW + "totalUpdated",
+    "delete": _CSW + "TransactionSummary/" + _CSW + "totalDeleted"
+}
+
+_templates = {}
+
+def render(template, context):
+    """
+    Renders the named template with the context dict to UTF-8.  Templates
+    are loaded and compiled the first time they are used and the compiled
+    template is reused after that.
+    """
+    tpl = _templates.get(template)
+    if tpl is None:
+        tpl = _templates[template] = get_template(template)
+    return tpl.render(Context(context)).encode("utf-8")
+
+def metadata_document(layer):
+    """
+    Returns the ISO metadata document written to the catalog for layer.
+    """
+    return render("maps/csw/full_metadata.xml", {
+        'layer': layer,
+        'SITEURL': settings.SITEURL[:-1],
+    })
+
+def metadata_digest(document):
+    return hashlib.sha1(document).hexdigest()
+
+def record_digest(layer, digest):
+    """
+    Remembers digest as that of the metadata document in the catalog for
+    layer, without saving the rest of it.
+    """
+    layer.metadata_digest = digest
+    type(layer).objects.filter(pk=layer.pk).update(metadata_digest=digest)
+
+def parse_transaction_response(body):
+    """
+    Reads the number of records inserted, updated and deleted from a CSW
+    TransactionResponse, as a dict keyed by 'insert', 'update' and
+    'delete'.  Raises a RuntimeError if the catalog reported an exception.
+    """
+    doc = XML(body)
+    if doc.tag == _OWS + "ExceptionReport":
+        raise RuntimeError("CSW exception: %s" % doc.findtext(".//" + _OWS + "ExceptionText"))
+    if doc.tag != _CSW + "TransactionResponse":
+        raise RuntimeError("Unexpected CSW transaction response: %s" % doc.tag)
+    totals = {}
+    for action, path in _TOTALS.iteritems():
+        totals[action] = int(doc.findtext(path) or 0)
+    return totals
+
+def _session_expired(body):
+    """
+    Whether body is what GeoNetwork answers with when a session is no
+    longer logged in, an <error id="service-not-allowed"> document.  Only
+    the root element is read.
+    """
+    try:
+        for event, elem in iterparse(StringIO(body), ('start',)):
+            return elem.tag == 'error' and elem.get('id') == 'service-not-allowed'
+    except Exception:
+        # not XML
+        pass
+    return False
+
+
+class _CatalogIds(object):
+    """
+    Ids looked up in a GeoNetwork catalog, shared by the Catalogs for its
+    URL: the database ids of records by uuid, and the ids of groups and
+    operations by name.
+    """
+
+    # forget all record ids rather than keep more than this
+    max_records = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self.groups = {}
+        self.operations = {}
+        self.fetched_at = None
+
+_catalog_ids = {}
+_catalog_ids_lock = threading.Lock()
+
+def _ids_for(base):
+    with _catalog_ids_lock:
+        ids = _catalog_ids.get(base)
+        if ids is None:
+            ids = _catalog_ids[base] = _CatalogIds()
+        return ids
+
+
+class _Session(object):
+    """
+    A GeoNetwork session, with its own cookies.
+    """
+
+    def __init__(self):
+        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(),
+                urllib2.HTTPRedirectHandler())
+        self.used_at = None
+
+
+class _Record(object):
+    """
+    A catalog record known only by its uuid, in place of its layer.
+    """
+
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.typename = uuid
 
 
 class Catalog(object):
+    """
+    A GeoNetwork catalog, accessed through a pool of logged in sessions.
+
+    Each request takes a session from the pool, logging a new one in if
+    there is none, and returns it when done, so a Catalog can be shared
+    between threads.  Sessions that GeoNetwork has expired are logged in
+    again, either because they were idle for longer than
+    session_idle_timeout or when a request is refused.
+    """
+
+    # GeoNetwork's sessions time out after 30 minutes by default
+    session_idle_timeout = 20 * 60
+    # the most idle sessions to keep logged in
+    max_idle_sessions = 4
+    # seconds after which the group and operation ids are fetched again
+    info_ttl = 60 * 60
 
     def __init__(self, base, user, password):
         self.base = base
         self.user = user
         self.password = password
-        self._group_ids = {}
-        self._operation_ids = {}
-        self.connected = False
+        self._ids = _ids_for(base)
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
 
+    @property
+    def connected(self):
+        return len(self._sessions) > 0
 
-    def login(self):
+    def _login(self, session):
         url = "%ssrv/en/xml.user.login" % self.base
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
@@ -32,23 +178,67 @@ class Catalog(object):
             "password": self.password
         })
         request = urllib2.Request(url, post, headers)
-        self.opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(),
-                urllib2.HTTPRedirectHandler())
-        response = self.opener.open(request)
+        response = session.opener.open(request)
         body = response.read()
         dom = minidom.parseString(body)
         assert dom.childNodes[0].nodeName == 'ok', "GeoNetwork login failed!"
-        self.connected = True
+        session.used_at = time.time()
 
-    def logout(self):
+    def _logout(self, session):
         url = "%ssrv/en/xml.user.logout" % self.base
-        request = urllib2.Request(url)
-        response = self.opener.open(request)
-        self.connected = False
+        try:
+            session.opener.open(urllib2.Request(url)).read()
+        except Exception, e:
+            logger.warning("Could not log out of GeoNetwork: %s", e)
+
+    def _checkout(self):
+        with self._sessions_lock:
+            session = self._sessions and self._sessions.pop() or None
+        if session is None:
+            session = _Session()
+        if session.used_at is None or time.time() - session.used_at > self.session_idle_timeout:
+            try:
+                self._login(session)
+            except:
+                self._checkin(session, logged_in=False)
+                raise
+        return session
+
+    def _checkin(self, session, logged_in=True):
+        """
+        Returns session to the pool.  A session that failed is returned with
+        logged_in false, so that it is logged in again before it is used.
+        """
+        session.used_at = logged_in and time.time() or None
+        with self._sessions_lock:
+            if len(self._sessions) < self.max_idle_sessions:
+                self._sessions.append(session)
+                return
+        self._logout(session)
+
+    def login(self):
+        """
+        Logs a new session in and adds it to the pool, raising an error if
+        GeoNetwork can't be reached or refuses the credentials.  Requests
+        log in as needed, so this is only useful to check the connection.
+        """
+        session = _Session()
+        self._login(session)
+        self._checkin(session)
+
+    def logout(self):
+        """
+        Logs out all the sessions in the pool.
+        """
+        with self._sessions_lock:
+            sessions = self._sessions
+            self._sessions = []
+        for session in sessions:
+            self._logout(session)
 
     def get_by_uuid(self, uuid):
-        csw = CatalogueServiceWeb(self.base + "srv/en/csw")
-        csw.getrecordbyid([uuid], outputschema=namespaces["gmd"])
+        csw = get_csw_client(self.base + "srv/en/csw").getrecordbyid(
+            [uuid], outputschema=namespaces["gmd"])
         recs = csw.records
         return recs.values()[0] if len(recs) > 0 else None
 
@@ -63,33 +253,21 @@ class Catalog(object):
         })
 
     def csw_request(self, layer, template):
-        tpl = get_template(template)
-        ctx = Context({
+        md_doc = render(template, {
             'layer': layer,
             'SITEURL': settings.SITEURL[:-1],
         })
-        md_doc = tpl.render(ctx)
         url = "%ssrv/en/csw" % self.base
         headers = {
             "Content-Type": "application/xml; charset=UTF-8",
             "Accept": "text/plain"
         }
-        md_doc = md_doc.encode("utf-8")
         request = urllib2.Request(url, md_doc, headers)
         response = self.urlopen(request)
         return response
 
     def create_from_layer(self, layer):
-        response = self.csw_request(layer, "maps/csw/transaction_insert.xml")
-        # TODO: Parse response, check for error report
-
-        # Turn on the "view" permission (aka publish) for
-        # the "all" group in GeoNetwork so that the layer
-        # will be searchable via CSW without admin login.
-        # all other privileges are set to False for all 
-        # groups.
-        self.set_metadata_privs(layer.uuid, {"all":  {"view": True}})
-        
+        self.insert_layer(layer)
         return self.base + "srv/en/csw?" + urllib.urlencode({
             "request": "GetRecordById",
             "service": "CSW",
@@ -99,13 +277,125 @@ class Catalog(object):
             "id": layer.uuid
         })
 
+    def insert_layer(self, layer, document=None):
+        """
+        Inserts and publishes the record of layer, returning whether it was
+        written.  document is its metadata_document, if already rendered.
+        """
+        if not self._single_transaction("insert", layer, document):
+            return False
+        # Turn on the "view" permission (aka publish) for
+        # the "all" group in GeoNetwork so that the layer
+        # will be searchable via CSW without admin login.
+        # all other privileges are set to False for all 
+        # groups.
+        self.set_metadata_privs(layer.uuid, {"all":  {"view": True}})
+        return True
+
     def delete_layer(self, layer):
-        response = self.csw_request(layer, "maps/csw/transaction_delete.xml")
-        # TODO: Parse response, check for error report
+        """
+        Deletes the record of layer, returning whether it was deleted.
+        """
+        if self._single_transaction("delete", layer):
+            self.forget_record(layer.uuid)
+            return True
+        return False
 
-    def update_layer(self, layer):
-        response = self.csw_request(layer, "maps/csw/transaction_update.xml")
-        # TODO: Parse response, check for error report
+    def delete_record(self, uuid):
+        """
+        Deletes the record with uuid, for which there may be no layer,
+        returning whether it was deleted.
+        """
+        return self.delete_layer(_Record(uuid))
+
+    def update_layer(self, layer, document=None):
+        """
+        Updates the record of layer, returning whether it was written.
+        """
+        return self._single_transaction("update", layer, document)
+
+    def _single_transaction(self, action, layer, document=None):
+        documents = document is not None and {layer.uuid: document} or None
+        action, layer, error = self.transaction([(action, layer)], documents=documents)[0]
+        if error is not None:
+            logger.warning("Could not %s the metadata of %s: %s", action, layer.typename, error)
+        return error is None
+
+    def existing_uuids(self, uuids):
+        """
+        Returns the set of those of uuids that the catalog has records for.
+        """
+        client = get_csw_client(self.base + "srv/en/csw")
+        uuids = list(uuids)
+        existing = set()
+        # keep the GetRecordById URLs to a sensible length
+        for i in range(0, len(uuids), 50):
+            existing.update(row['uuid'] for row in client.records(uuids[i:i + 50], esn='brief'))
+        return existing
+
+    def transaction(self, operations, batch_size=None, documents=None):
+        """
+        Applies operations, a list of (action, layer) pairs where action is
+        'insert', 'update' or 'delete', packing up to batch_size of them
+        (by default settings.CSW_TRANSACTION_BATCH_SIZE) in each CSW
+        Transaction.  documents optionally maps layer uuids to their
+        already rendered metadata_document.  Returns a list of (action,
+        layer, error) triples in the same order, where error is None for
+        the records that were written and otherwise describes why not.
+        """
+        if batch_size is None:
+            batch_size = getattr(settings, "CSW_TRANSACTION_BATCH_SIZE", 50)
+        batch_size = max(batch_size, 1)
+        documents = dict(documents or {})
+        for action, layer in operations:
+            if action != "delete" and layer.uuid not in documents:
+                documents[layer.uuid] = metadata_document(layer)
+        results = []
+        for i in range(0, len(operations), batch_size):
+            results.extend(self._transaction(operations[i:i + batch_size], documents))
+        return results
+
+    def _transaction(self, operations, documents):
+        md_doc = render("maps/csw/transaction.xml", {
+            'operations': [(action, layer, documents.get(layer.uuid))
+                           for action, layer in operations],
+        })
+        url = "%ssrv/en/csw" % self.base
+        headers = {
+            "Content-Type": "application/xml; charset=UTF-8",
+            "Accept": "text/plain"
+        }
+        expected = {"insert": 0, "update": 0, "delete": 0}
+        for action, layer in operations:
+            expected[action] += 1
+        try:
+            totals = parse_transaction_response(
+                self.urlopen(urllib2.Request(url, md_doc, headers)).read())
+        except Exception, e:
+            totals = None
+            error = str(e)
+        else:
+            error = "the catalog reported %(insert)d inserted, %(update)d updated " \
+                    "and %(delete)d deleted records" % totals
+
+        if totals == expected:
+            return [(action, layer, None) for action, layer in operations]
+        if len(operations) == 1:
+            return [operations[0] + (error,)]
+
+        # Some of the batch failed, but the response doesn't say which.
+        # Inserts and deletes are told apart by whether the record now
+        # exists, while updates and the rest are sent again one at a time.
+        existing = self.existing_uuids(layer.uuid for action, layer in operations)
+        results = []
+        for action, layer in operations:
+            if action == "insert" and layer.uuid in existing:
+                results.append((action, layer, None))
+            elif action == "delete" and layer.uuid not in existing:
+                results.append((action, layer, None))
+            else:
+                results.extend(self._transaction([(action, layer)], documents))
+        return results
 
     def set_metadata_privs(self, uuid, privileges):
         """
@@ -119,46 +409,95 @@ class Catalog(object):
         all unspecified operations and operations for unspecified groups 
         are set to False.
         """
+        self.set_metadata_privs_batch([uuid], privileges)
+
+    def set_metadata_privs_batch(self, uuids, privileges):
+        """
+        set the same privileges, as for set_metadata_privs, on all the 
+        items with the given uuids.  GeoNetwork takes one request per 
+        item, but the item ids and the group and operation ids are
+        remembered so that no other requests are usually needed.
+        """
         
         # XXX This is a fairly ugly workaround that makes 
         # requests similar to those made by the GeoNetwork
         # admin based on the recommendation here: 
         # http://bit.ly/ccVEU7
 
-        
-        get_dbid_url = self.base + 'srv/en/portal.search.present?' + urllib.urlencode({'uuid': uuid})
+        # build params that represent the privilege configuration
+        priv_params = {}
+        for group, op in self._privilege_ids(privileges):
+            priv_params['_%s_%s' % (group, op)] = 'on'
+
+        for uuid in uuids:
+            for attempt in range(2):
+                # "uuid": layer.uuid, # you can say this instead of id in newer versions of GN 
+                params = dict(priv_params, id=self._record_id(uuid))
+                update_privs_url = self.base + "srv/en/metadata.admin?" + urllib.urlencode(params)
+                body = self.urlopen(urllib2.Request(update_privs_url)).read()
+                if "<error" not in body:
+                    break
+                # the record may have been replaced, with a new id
+                self.forget_record(uuid)
+            else:
+                logger.warning("Could not set the privileges of %s: %s", uuid, body)
 
-        # get the id of the data.
+    def _record_id(self, uuid):
+        """
+        Returns the GeoNetwork database id of the record with uuid.
+        """
+        ids = self._ids
+        with ids.lock:
+            dbid = ids.records.get(uuid)
+        if dbid is not None:
+            return dbid
+
+        get_dbid_url = self.base + 'srv/en/portal.search.present?' + urllib.urlencode({'uuid': uuid})
         request = urllib2.Request(get_dbid_url)
         response = self.urlopen(request)
         doc = XML(response.read())
-        data_dbid = doc.find('metadata/{http://www.fao.org/geonetwork}info/id').text
+        dbid = doc.find('metadata/{http://www.fao.org/geonetwork}info/id').text
 
-        # update group and operation info if needed
-        if len(self._group_ids) == 0:
-            self._group_ids = self._get_group_ids()
-        if len(self._operation_ids) == 0:
-            self._operation_ids = self._get_operation_ids()
+        with ids.lock:
+            if len(ids.records) >= ids.max_records:
+                ids.records.clear()
+            ids.records[uuid] = dbid
+        return dbid
 
-        # build params that represent the privilege configuration
-        priv_params = {
-            "id": data_dbid, # "uuid": layer.uuid, # you can say this instead in newer versions of GN 
-        }
-        for group, privs in privileges.items():
-            group_id = self._group_ids[group.lower()]
-            for op, state in privs.items():
-                if state != True:
-                    continue
-                op_id = self._operation_ids[op.lower()]
-                priv_params['_%s_%s' % (group_id, op_id)] = 'on'
-
-        # update all privileges
-        update_privs_url = self.base + "srv/en/metadata.admin?" + urllib.urlencode(priv_params)
-        request = urllib2.Request(update_privs_url)
-        response = self.urlopen(request)
+    def forget_record(self, uuid):
+        with self._ids.lock:
+            self._ids.records.pop(uuid, None)
+
+    def _privilege_ids(self, privileges):
+        """
+        Returns the (group id, operation id) pairs of the privileges that
+        are turned on, fetching the ids again when they are older than
+        info_ttl or a name is not known.
+        """
+        ids = self._ids
+        for attempt in range(2):
+            with ids.lock:
+                stale = ids.fetched_at is None or time.time() - ids.fetched_at > self.info_ttl
+            if stale or attempt > 0:
+                groups = self._get_group_ids()
+                operations = self._get_operation_ids()
+                with ids.lock:
+                    ids.groups = groups
+                    ids.operations = operations
+                    ids.fetched_at = time.time()
+            try:
+                pairs = []
+                for group, privs in privileges.items():
+                    group_id = ids.groups[group.lower()]
+                    for op, state in privs.items():
+                        if state != True:
+                            continue
+                        pairs.append((group_id, ids.operations[op.lower()]))
+                return pairs
+            except KeyError:
+                if attempt > 0:
+                    raise
 
-        # TODO: check for error report  
-        
     def _get_group_ids(self):
         """
         helper to fetch the set of geonetwork 
@@ -189,8 +528,135 @@ class Catalog(object):
             ops[op.find('name').text.lower()] = op.attrib['id']
         return ops
 
+    def _open(self, session, request):
+        """
+        Makes request with session, returning the response and its body, or
+        None for both if GeoNetwork refused it as not logged in.
+        """
+        try:
+            response = session.opener.open(request)
+        except urllib2.HTTPError, e:
+            if e.code in (401, 403):
+                return None, None
+            raise
+        body = response.read()
+        if _session_expired(body):
+            return None, None
+        return response, body
+
     def urlopen(self, request):
-        if self.opener is None:
-            raise Exception("No URL opener defined in geonetwork module!!")
-        else:
-            return self.opener.open(request)
+        """
+        Makes request with a logged in session, returning the response with
+        its body read.
+
+        A request refused because the session expired is sent again once
+        the session is logged in again.  This is safe for transactions too,
+        as GeoNetwork refuses them before applying anything.  If the request
+        fails, the session is returned to the pool to be logged in again.
+        """
+        session = self._checkout()
+        succeeded = False
+        try:
+            response, body = self._open(session, request)
+            if response is None:
+                logger.info("GeoNetwork session expired, logging in again")
+                self._login(session)
+                response = session.opener.open(request)
+                body = response.read()
+            succeeded = True
+        finally:
+            self._checkin(session, logged_in=succeeded)
+        return urllib.addinfourl(StringIO(body), response.info(),
+                                 response.geturl(), response.code)
+
+
+class Batch(object):
+    """
+    Metadata writes for layers, collected to be sent to a catalog in
+    batched transactions by flush().  Only the last write queued for each
+    layer is sent, and saved layers whose metadata document is the one
+    last written for them are skipped unless force is true.  Once flushed
+    the batch is closed, and queues nothing more.
+    """
+
+    def __init__(self, catalog, batch_size=None, force=False):
+        self.catalog = catalog
+        self.batch_size = batch_size
+        self.force = force
+        self.closed = False
+        self._uuids = []
+        self._operations = {}
+        # layers may be queued from several threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._uuids)
+
+    def _add(self, action, layer):
+        with self._lock:
+            if self.closed:
+                return False
+            if layer.uuid not in self._operations:
+                self._uuids.append(layer.uuid)
+            self._operations[layer.uuid] = (action, layer)
+            return True
+
+    def save(self, layer):
+        """
+        Queues the insert or update of the layer's record, whichever is
+        needed when the batch is flushed.  Returns False, queuing nothing,
+        if the batch is closed.
+        """
+        return self._add("save", layer)
+
+    def delete(self, layer):
+        return self._add("delete", layer)
+
+    def flush(self):
+        """
+        Sends the queued writes, returning the results as
+        Catalog.transaction does.  Skipped layers are left out of the
+        results.
+        """
+        with self._lock:
+            operations = [self._operations[uuid] for uuid in self._uuids]
+            self._uuids = []
+            self._operations = {}
+            self.closed = True
+
+        documents = {}
+        digests = {}
+        for action, layer in operations:
+            if action == "save":
+                documents[layer.uuid] = metadata_document(layer)
+                digests[layer.uuid] = metadata_digest(documents[layer.uuid])
+        if not self.force:
+            operations = [(action, layer) for action, layer in operations
+                          if action != "save" or layer.metadata_digest != digests[layer.uuid]]
+        if not operations:
+            return []
+
+        saved = [layer.uuid for action, layer in operations if action == "save"]
+        existing = saved and self.catalog.existing_uuids(saved) or set()
+        for i, (action, layer) in enumerate(operations):
+            if action == "save":
+                operations[i] = ("update" if layer.uuid in existing else "insert", layer)
+
+        results = self.catalog.transaction(operations, self.batch_size, documents)
+        inserted = []
+        for action, layer, error in results:
+            metadata_cache.invalidate(layer.uuid)
+            if error is not None:
+                logger.warning("Could not %s the metadata of %s: %s", action, layer.typename, error)
+                continue
+            if action in ("insert", "update"):
+                record_digest(layer, digests[layer.uuid])
+            if action == "insert":
+                inserted.append(layer.uuid)
+            elif action == "delete":
+                self.catalog.forget_record(layer.uuid)
+
+        # publish new records, as create_from_layer does
+        if inserted:
+            self.catalog.set_metadata_privs_batch(inserted, {"all":  {"view": True}})
+        return results
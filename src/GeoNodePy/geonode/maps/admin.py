@@ -30,7 +30,7 @@ class LayerAdmin(admin.ModelAdmin):
     list_filter  = ('date', 'date_type', 'constraints_use', 'topic_category')
     filter_horizontal = ('contacts',)
     date_hierarchy = 'date'
-    readonly_fields = ('uuid', 'typename', 'workspace') 
+    readonly_fields = ('uuid', 'typename', 'workspace', 'bbox_x0', 'bbox_x1', 'bbox_y0', 'bbox_y1')
     inlines = [ContactRoleInline]
 
     actions = ['change_poc']
@@ -0,0 +1,76 @@
+"""
+Static embed bundles for publicly readable maps.
+
+When settings.MAP_EMBED_BUNDLE_ROOT is set, each map that anonymous users may
+view gets a directory named after its id there, holding an index.html
+equivalent to the maps/<id>/embed page and a config.json with the map's
+viewer configuration.  The front web server can then serve embedded maps
+without a request to Django.  Bundles are rewritten when a map or its
+permissions change and removed when the map stops being public.
+"""
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.template import Context, loader
+from geonode.maps.context_processors import resource_urls
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger("geonode.maps.bundles")
+
+def bundles_enabled():
+    return getattr(settings, "MAP_EMBED_BUNDLE_ROOT", None) is not None
+
+def bundle_path(map_id):
+    return os.path.join(settings.MAP_EMBED_BUNDLE_ROOT, str(map_id))
+
+def _write_file(directory, name, content):
+    # write to a temporary file first so the web server never serves a
+    # partially written bundle
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".%s" % name)
+    try:
+        os.write(fd, content)
+    finally:
+        os.close(fd)
+    os.chmod(temp_path, 0644)
+    os.rename(temp_path, os.path.join(directory, name))
+
+def write_embed_bundle(map):
+    """
+    Renders the embed page and viewer configuration of map into its bundle
+    directory.
+    """
+    config = json.dumps(map.viewer_json())
+    context = Context(resource_urls(None))
+    context['config'] = config
+    html = loader.get_template('maps/embed.html').render(context)
+
+    directory = bundle_path(map.id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    _write_file(directory, "config.json", config)
+    _write_file(directory, "index.html", html.encode('utf-8'))
+
+def remove_embed_bundle(map_id):
+    directory = bundle_path(map_id)
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+
+def update_embed_bundle(map):
+    """
+    Writes the bundle for map if anonymous users can view it, and removes any
+    existing bundle otherwise.  Does nothing unless MAP_EMBED_BUNDLE_ROOT is
+    set.
+    """
+    if not bundles_enabled():
+        return
+    try:
+        if AnonymousUser().has_perm('maps.view_map', obj=map):
+            write_embed_bundle(map)
+        else:
+            remove_embed_bundle(map.id)
+    except (IOError, OSError), e:
+        # the dynamic embed view still works, so don't fail the save
+        logger.exception("Could not update the embed bundle for map %s: %s", map.id, e)
@@ -0,0 +1,435 @@
+"""
+Searching the GeoNetwork catalog over CSW.
+
+owslib parses a whole GetRecords response into a tree and then into
+CswRecord objects, and the search view used to walk the tree a second time
+for the parts owslib doesn't expose.  Here the response is instead parsed
+incrementally as it is read from the connection, turning each csw:Record
+into a search result row and discarding it before the next one is read.
+
+This module also keeps one CswClient per catalog URL for the process, so
+that requests don't each begin with a GetCapabilities round trip, and a
+cache of parsed ISO metadata records for the layer and search detail pages.
+"""
+from django.conf import settings
+from owslib import util
+from owslib.csw import CatalogueServiceWeb, namespaces, outputformat, schema_location
+from owslib.etree import etree
+from owslib.filter import FilterRequest
+from owslib.ows import OwsCommon
+from urllib import urlencode
+from urlparse import urlparse
+import logging
+import re
+import threading
+import time
+import urllib2
+
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
+
+logger = logging.getLogger("geonode.maps.cswsearch")
+
+def _tag(prefix, name):
+    return "{%s}%s" % (namespaces[prefix], name)
+
+_SEARCH_RESULTS = _tag('csw', 'SearchResults')
+# brief and summary element sets may come as csw:BriefRecord and csw:SummaryRecord
+_RECORDS = (_tag('csw', 'Record'), _tag('csw', 'BriefRecord'), _tag('csw', 'SummaryRecord'))
+_EXCEPTION_TEXT = _tag('ows', 'ExceptionText')
+_EXCEPTION_REPORT = _tag('ows', 'ExceptionReport')
+_MD_METADATA = _tag('gmd', 'MD_Metadata')
+_IDENTIFIER = _tag('dc', 'identifier')
+_TITLE = _tag('dc', 'title')
+_ABSTRACT = _tag('dct', 'abstract')
+_SUBJECT = _tag('dc', 'subject')
+_URI = _tag('dc', 'URI')
+_BOUNDING_BOX = _tag('ows', 'BoundingBox')
+_LOWER_CORNER = _tag('ows', 'LowerCorner')
+_UPPER_CORNER = _tag('ows', 'UpperCorner')
+
+_WGS84 = 'urn:ogc:def:crs:::WGS 1984'
+_DOWNLOAD_PROTOCOL = 'WWW:DOWNLOAD-1.0-http--download'
+_format_re = re.compile(".*\((.*)(\s*Format*\s*)\).*?")
+
+def csw_url():
+    return "%ssrv/en/csw" % settings.GEONETWORK_BASE_URL
+
+def metadata_link(uuid):
+    """
+    the link to the geonetwork metadata record (not self-indexed)
+    """
+    return csw_url() + "?" + urlencode({
+            "request": "GetRecordById",
+            "service": "CSW",
+            "version": "2.0.2",
+            "OutputSchema": "http://www.isotc211.org/2005/gmd",
+            "ElementSetName": "full",
+            "id": uuid
+        })
+
+# the GeoNetwork index field telling records harvested from other catalogs
+# ('y') from its own, which its CSW service accepts as a queryable
+_HARVESTED_PROPERTY = '_isHarvested'
+
+def _harvested_filter(constraint):
+    """
+    Narrows the ogc:Filter constraint down to harvested records.
+    """
+    conditions = list(constraint)
+    parent = constraint
+    if conditions:
+        for condition in conditions:
+            constraint.remove(condition)
+        parent = etree.SubElement(constraint, util.nspath_eval('ogc:And', namespaces))
+        for condition in conditions:
+            parent.append(condition)
+    node = etree.SubElement(parent, util.nspath_eval('ogc:PropertyIsEqualTo', namespaces))
+    etree.SubElement(node, util.nspath_eval('ogc:PropertyName', namespaces)).text = _HARVESTED_PROPERTY
+    etree.SubElement(node, util.nspath_eval('ogc:Literal', namespaces)).text = 'y'
+    return constraint
+
+def getrecords_request(keywords=[], startposition=0, maxrecords=10, bbox=None, esn='full',
+                       harvested=False):
+    """
+    Builds the same GetRecords request for csw:Records as owslib's
+    CatalogueServiceWeb.getrecords, with keywords or-ed together and bbox
+    given as [minx, miny, maxx, maxy].  esn is the element set to return,
+    'brief', 'summary' or 'full'.  If harvested is true, only records
+    harvested from other catalogs are searched.  With maxrecords 0, only
+    the number of matches is asked for.
+    """
+    node0 = etree.Element(util.nspath_eval('csw:GetRecords', namespaces))
+    node0.set('xmlns:ows', namespaces['ows'])
+    node0.set('outputSchema', namespaces['csw'])
+    node0.set('outputFormat', outputformat)
+    node0.set('version', '2.0.2')
+    node0.set('resultType', maxrecords > 0 and 'results' or 'hits')
+    node0.set('service', 'CSW')
+    if startposition > 0:
+        node0.set('startPosition', str(startposition))
+    if maxrecords > 0:
+        node0.set('maxRecords', str(maxrecords))
+    node0.set(util.nspath_eval('xsi:schemaLocation', namespaces), schema_location)
+
+    node1 = etree.SubElement(node0, util.nspath_eval('csw:Query', namespaces))
+    node1.set('typeNames', 'csw:Record')
+    etree.SubElement(node1, util.nspath_eval('csw:ElementSetName', namespaces)).text = esn
+
+    if keywords or bbox is not None or harvested:
+        node2 = etree.SubElement(node1, util.nspath_eval('csw:Constraint', namespaces))
+        node2.set('version', '1.1.0')
+        constraint = FilterRequest().set(keywords=keywords, bbox=bbox)
+        if harvested:
+            constraint = _harvested_filter(constraint)
+        node2.append(constraint)
+
+    return util.xml2string(etree.tostring(node0))
+
+def build_search_result(record):
+    """
+    Builds a search result row from a csw:Record element.
+    """
+    identifier = None
+    title = None
+    abstract = None
+    uri = None
+    keywords = []
+    download_links = []
+    bbox_el = None
+
+    for child in record:
+        tag = child.tag
+        if tag == _IDENTIFIER:
+            if identifier is None:
+                identifier = child.text
+        elif tag == _TITLE:
+            if title is None:
+                title = child.text
+        elif tag == _ABSTRACT:
+            if abstract is None:
+                abstract = child.text
+        elif tag == _SUBJECT:
+            if child.text:
+                keywords.append(child.text)
+        elif tag == _URI:
+            if uri is None:
+                uri = child.text
+            if child.get('protocol', '') == _DOWNLOAD_PROTOCOL:
+                match = _format_re.match(child.get('description') or '')
+                if match is not None:
+                    extension = child.get('name', '').split('.')[-1]
+                    download_links.append((extension, match.groups()[0], child.text))
+        elif tag == _BOUNDING_BOX:
+            if bbox_el is None:
+                bbox_el = child
+
+    result = {
+        'title': title,
+        'uuid': identifier,
+        'abstract': abstract,
+        'keywords': keywords,
+        'detail': uri or '',
+        'attribution': {'title': '', 'href': ''},
+        'download_links': download_links,
+        'metadata_links': [("text/xml", "TC211", metadata_link(identifier))]
+    }
+
+    # pull out the geonode 'typename' from the detail link if there is one,
+    # falling back to the geonetwork uuid
+    if uri:
+        result['name'] = urlparse(uri).path.split('/')[-1]
+    if not result.get('name', ''):
+        result['name'] = identifier
+
+    # XXX this assumes all our bboxes are in this
+    # improperly specified SRS.
+    if bbox_el is not None and bbox_el.get('crs') == _WGS84:
+        try:
+            minx, miny = [float(c) for c in bbox_el.find(_LOWER_CORNER).text.split()[:2]]
+            maxx, maxy = [float(c) for c in bbox_el.find(_UPPER_CORNER).text.split()[:2]]
+        except (AttributeError, ValueError):
+            pass
+        else:
+            # slight workaround for ticket 530
+            result['bbox'] = {
+                'minx': min(minx, maxx),
+                'maxx': max(minx, maxx),
+                'miny': min(miny, maxy),
+                'maxy': max(miny, maxy)
+            }
+
+    return result
+
+def parse_getrecords(source):
+    """
+    Parses a GetRecords response from source, a file name or file-like
+    object, returning a dict with the result 'rows' and the 'matches',
+    'returned' and 'nextrecord' counts of the csw:SearchResults element.
+    """
+    results = None
+    rows = []
+    for event, elem in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == _SEARCH_RESULTS:
+                results = elem
+                info = {
+                    'matches': int(elem.get('numberOfRecordsMatched', 0)),
+                    'returned': int(elem.get('numberOfRecordsReturned', 0)),
+                    'nextrecord': int(elem.get('nextRecord', 0))
+                }
+        elif elem.tag in _RECORDS:
+            rows.append(build_search_result(elem))
+            if results is not None:
+                results.remove(elem)
+            else:
+                elem.clear()
+        elif elem.tag == _EXCEPTION_REPORT:
+            text = elem.findtext('.//' + _EXCEPTION_TEXT)
+            raise RuntimeError("CSW exception: %s" % text)
+
+    if results is None:
+        raise RuntimeError("CSW response has no search results")
+    info['rows'] = rows
+    return info
+
+def parse_records(source):
+    """
+    Parses the csw:Records of a GetRecordById response from source, a file
+    name or file-like object, returning a list of search result rows.
+    """
+    rows = []
+    for event, elem in iterparse(source):
+        if elem.tag in _RECORDS:
+            rows.append(build_search_result(elem))
+            elem.clear()
+        elif elem.tag == _EXCEPTION_REPORT:
+            text = elem.findtext('.//' + _EXCEPTION_TEXT)
+            raise RuntimeError("CSW exception: %s" % text)
+    return rows
+
+class _CatalogueRequests(CatalogueServiceWeb):
+    """
+    A CatalogueServiceWeb for making requests with, which unlike owslib's
+    doesn't fetch the capabilities document when it is created.
+    """
+
+    def __init__(self, url, lang='en-US', version='2.0.2', timeout=10):
+        self.url = url
+        self.lang = lang
+        self.version = version
+        self.timeout = timeout
+        self.service = 'CSW'
+        self.exceptionreport = None
+        self.owscommon = OwsCommon('1.0.0')
+
+
+class CswClient(object):
+    """
+    A client for one catalog, safe to share between threads.
+
+    owslib keeps the state of the last request on the CatalogueServiceWeb,
+    so each request gets its own lightweight one from requests().  The
+    capabilities document is never fetched.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def requests(self):
+        """
+        Returns a new owslib CatalogueServiceWeb, without fetching the
+        capabilities, to make requests and read their results with.
+        """
+        return _CatalogueRequests(self.url)
+
+    def getrecordbyid(self, ids, outputschema=namespaces['csw'], esn='full'):
+        csw = self.requests()
+        csw.getrecordbyid(ids, esn=esn, outputschema=outputschema)
+        return csw
+
+    def search(self, keywords=[], startposition=0, maxrecords=10, bbox=None, esn='full',
+               harvested=False):
+        """
+        Runs a GetRecords query, reading the response as it arrives.  See
+        parse_getrecords for the result.
+        """
+        request = urllib2.Request(self.url, getrecords_request(keywords,
+                                  startposition, maxrecords, bbox, esn, harvested))
+        request.add_header('Content-Type', 'text/xml')
+        request.add_header('Accept', 'text/xml')
+        response = urllib2.urlopen(request)
+        try:
+            return parse_getrecords(response)
+        finally:
+            response.close()
+
+    def records(self, ids, esn='full'):
+        """
+        Fetches the csw:Records with the given ids in a single GetRecordById
+        request, returning them as search result rows.
+        """
+        response = urllib2.urlopen(self.url + "?" + urlencode({
+                "service": "CSW",
+                "version": "2.0.2",
+                "request": "GetRecordById",
+                "ElementSetName": esn,
+                "outputSchema": namespaces['csw'],
+                "id": ",".join(ids)
+            }))
+        try:
+            return parse_records(response)
+        finally:
+            response.close()
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_csw_client(url=None):
+    """
+    Returns the process-wide CswClient for url, by default the GeoNetwork
+    catalog of this GeoNode.
+    """
+    if url is None:
+        url = csw_url()
+    with _clients_lock:
+        client = _clients.get(url)
+        if client is None:
+            client = _clients[url] = CswClient(url)
+        return client
+
+def search(keywords=[], startposition=0, maxrecords=10, bbox=None, esn='full', harvested=False):
+    return get_csw_client().search(keywords, startposition, maxrecords, bbox, esn, harvested)
+
+def records(ids, esn='full'):
+    return get_csw_client().records(ids, esn)
+
+
+class MetadataCache(object):
+    """
+    Parsed ISO 19139 records by uuid, as (owslib MD_Metadata, MD_Metadata
+    element) pairs.
+
+    Records are fetched from the catalog on first use.  After
+    settings.METADATA_CACHE_TTL seconds a record is stale: it is still
+    returned, but is fetched again in the background so that pages don't
+    wait on a slow catalog.  At most settings.METADATA_CACHE_SIZE records
+    are kept, evicting the least recently used.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # uuid -> [fetched at, last used, record, refreshing]
+        self._entries = {}
+
+    def _fetch(self, uuid):
+        csw = get_csw_client().getrecordbyid([uuid], outputschema=namespaces['gmd'])
+        record = csw.records.get(uuid)
+        if record is None:
+            return None
+        return record, csw._exml.find(_MD_METADATA)
+
+    def get(self, uuid):
+        """
+        Returns the (MD_Metadata, element) pair for uuid, or None if the
+        catalog has no such record.
+        """
+        now = time.time()
+        ttl = getattr(settings, "METADATA_CACHE_TTL", 300)
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry is not None:
+                entry[1] = now
+                if now - entry[0] > ttl and not entry[3]:
+                    entry[3] = True
+                    thread = threading.Thread(target=self._refresh, args=(uuid, entry))
+                    thread.setDaemon(True)
+                    thread.start()
+                return entry[2]
+
+        record = self._fetch(uuid)
+        if record is not None:
+            self._store(uuid, [time.time(), time.time(), record, False])
+        return record
+
+    def _refresh(self, uuid, entry):
+        try:
+            record = self._fetch(uuid)
+        except Exception, e:
+            logger.warning("Could not refresh the metadata of %s: %s", uuid, e)
+            entry[3] = False
+            return
+        with self._lock:
+            # don't bring back a record that was invalidated meanwhile
+            if self._entries.get(uuid) is not entry:
+                return
+            if record is None:
+                del self._entries[uuid]
+            else:
+                entry[0] = time.time()
+                entry[2] = record
+                entry[3] = False
+
+    def _store(self, uuid, entry):
+        size = getattr(settings, "METADATA_CACHE_SIZE", 500)
+        if size <= 0:
+            return
+        with self._lock:
+            if uuid not in self._entries and len(self._entries) >= size:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+            self._entries[uuid] = entry
+
+    def invalidate(self, uuid):
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+metadata_cache = MetadataCache()
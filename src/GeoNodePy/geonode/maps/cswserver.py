@@ -0,0 +1,350 @@
+"""
+A read-only CSW 2.0.2 service for the local layers.
+
+GetCapabilities, GetRecords and GetRecordById are answered from the layer
+table and the in-process search indexes rather than by GeoNetwork, so
+catalog clients don't load GeoNetwork and every GeoNode process can serve
+them.  Records are returned as Dublin Core csw:Records, or with
+outputSchema=http://www.isotc211.org/2005/gmd as the same ISO documents
+that are written to GeoNetwork.
+
+Requests may be sent as KVP parameters or as XML POST bodies.  Query
+constraints are OGC filters made of PropertyIsLike (matched as full text,
+like csw:AnyText, whatever the property), PropertyIsEqualTo on the
+identifier and BBOX, combined with And and Or.
+"""
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse
+from django.template import Context
+from django.template.loader import get_template
+from geonode.maps.models import Layer
+from geonode.maps.search import extent_index, text_index
+from owslib.csw import namespaces
+from xml.etree.ElementTree import XML
+from xml.parsers.expat import ExpatError
+
+DEFAULT_MAX_RECORDS = 10
+MAX_RECORDS = 100
+
+_ELEMENT_SETS = ('brief', 'summary', 'full')
+_OUTPUT_SCHEMAS = {
+    namespaces['csw']: 'csw',
+    namespaces['gmd']: 'gmd'
+}
+
+def _tag(prefix, name):
+    return "{%s}%s" % (namespaces[prefix], name)
+
+_FILTER = _tag('ogc', 'Filter')
+_AND = _tag('ogc', 'And')
+_OR = _tag('ogc', 'Or')
+_LIKE = _tag('ogc', 'PropertyIsLike')
+_EQUAL_TO = _tag('ogc', 'PropertyIsEqualTo')
+_BBOX = _tag('ogc', 'BBOX')
+_PROPERTY_NAME = _tag('ogc', 'PropertyName')
+_LITERAL = _tag('ogc', 'Literal')
+_ENVELOPE = _tag('gml', 'Envelope')
+_LOWER_CORNER = _tag('gml', 'lowerCorner')
+_UPPER_CORNER = _tag('gml', 'upperCorner')
+_QUERY = _tag('csw', 'Query')
+_CONSTRAINT = _tag('csw', 'Constraint')
+_ELEMENT_SET_NAME = _tag('csw', 'ElementSetName')
+_ID = _tag('csw', 'Id')
+
+class CswError(Exception):
+    """
+    An error to report to the client as an ows:ExceptionReport.
+    """
+
+    def __init__(self, code, locator, text):
+        Exception.__init__(self, text)
+        self.code = code
+        self.locator = locator
+        self.text = text
+
+def service_url():
+    return settings.SITEURL[:-1] + reverse('csw')
+
+def _like_keyword(el):
+    # wildcards only separate words as far as the text index is concerned
+    wildcards = (el.get('wildCard', '%'), el.get('singleChar', '_'))
+    escape = el.get('escapeChar', '\\')
+    chars = []
+    escaped = False
+    for c in el.findtext(_LITERAL) or '':
+        if escaped:
+            chars.append(c)
+            escaped = False
+        elif c == escape:
+            escaped = True
+        elif c in wildcards:
+            chars.append(' ')
+        else:
+            chars.append(c)
+    return ''.join(chars).strip()
+
+def _envelope(el):
+    try:
+        minx, miny = [float(c) for c in el.findtext(_LOWER_CORNER).split()[:2]]
+        maxx, maxy = [float(c) for c in el.findtext(_UPPER_CORNER).split()[:2]]
+    except (AttributeError, ValueError):
+        raise CswError("InvalidParameterValue", "constraint", "Invalid BBOX envelope")
+    return [minx, miny, maxx, maxy]
+
+def _evaluate(el, keywords):
+    """
+    Returns the set of ids of the layers matching the filter element el,
+    or None if it matches all layers.  The text of PropertyIsLike
+    operations is appended to keywords, for ranking the results.
+    """
+    if el.tag == _FILTER:
+        if len(el) != 1:
+            raise CswError("InvalidParameterValue", "constraint", "A filter needs one operation")
+        return _evaluate(el[0], keywords)
+    if el.tag in (_AND, _OR):
+        matches = [_evaluate(child, keywords) for child in el]
+        if el.tag == _OR:
+            if None in matches:
+                return None
+            return set().union(*matches)
+        result = None
+        for ids in matches:
+            if ids is not None:
+                result = ids if result is None else result & ids
+        return result
+    if el.tag == _LIKE:
+        keyword = _like_keyword(el)
+        if not keyword:
+            return None
+        keywords.append(keyword)
+        return set(text_index.search([keyword]))
+    if el.tag == _EQUAL_TO:
+        name = (el.findtext(_PROPERTY_NAME) or '').split(':')[-1].lower()
+        if name != 'identifier':
+            raise CswError("InvalidParameterValue", "constraint",
+                "PropertyIsEqualTo is only supported on the identifier")
+        uuid = el.findtext(_LITERAL) or ''
+        return set(Layer.objects.filter(uuid=uuid).values_list('id', flat=True))
+    if el.tag == _BBOX:
+        envelope = el.find(_ENVELOPE)
+        if envelope is None:
+            raise CswError("InvalidParameterValue", "constraint", "BBOX needs a gml:Envelope")
+        return extent_index.intersects(_envelope(envelope))[0]
+    raise CswError("InvalidParameterValue", "constraint",
+        "Unsupported filter operation %s" % el.tag.split('}')[-1])
+
+def find_layers(constraint):
+    """
+    Returns the ids of the layers matching the ogc:Filter element
+    constraint, or all layers if it is None.  Layers matching the text
+    of the filter come first, best matches first, followed by the rest
+    ordered by title.
+    """
+    if constraint is None:
+        return text_index.search([])
+    keywords = []
+    matches = _evaluate(constraint, keywords)
+    ranked = keywords and text_index.search(keywords) or []
+    ranked_ids = set(ranked)
+    ordered = ranked + [i for i in text_index.search([]) if i not in ranked_ids]
+    if matches is None:
+        return ordered
+    return [i for i in ordered if i in matches]
+
+class _Resource(object):
+    # the parts of the GeoServer resource that full_metadata.xml uses
+    def __init__(self, layer):
+        self.title = layer.title
+        self.latlon_bbox = layer.geographic_bbox()
+
+class _RecordLayer(object):
+    """
+    A layer as full_metadata.xml sees it, with its GeoServer resource
+    fields taken from the database.
+    """
+
+    def __init__(self, layer):
+        self._layer = layer
+        self.resource = _Resource(layer)
+
+    def __getattr__(self, name):
+        return getattr(self._layer, name)
+
+def _dc_record(layer, esn):
+    record = {
+        'uuid': layer.uuid,
+        'title': layer.title,
+        'bbox': layer.bbox_x0 is not None and \
+            (layer.bbox_x0, layer.bbox_y0, layer.bbox_x1, layer.bbox_y1) or None
+    }
+    if esn == 'brief':
+        return record
+    record['abstract'] = layer.abstract
+    record['keywords'] = layer.keyword_list()
+    record['modified'] = layer.date
+    if esn == 'summary':
+        return record
+    record['detail'] = settings.SITEURL[:-1] + layer.get_absolute_url()
+    record['name'] = layer.typename
+    record['download_links'] = layer.download_links()
+    record['wms'] = settings.GEOSERVER_BASE_URL + "wms"
+    return record
+
+def _records_context(layers, schema, esn):
+    if schema == 'gmd':
+        return {'layers': [_RecordLayer(l) for l in layers], 'SITEURL': settings.SITEURL[:-1]}
+    return {'records': [_dc_record(l, esn) for l in layers]}
+
+def _render(template, context):
+    body = get_template(template).render(Context(context))
+    return HttpResponse(body, mimetype="application/xml")
+
+def _exception(error):
+    response = _render("maps/csw/server/exception.xml", {'error': error})
+    response.status_code = 400
+    return response
+
+def _element_set(value):
+    esn = (value or 'summary').lower()
+    if esn not in _ELEMENT_SETS:
+        raise CswError("InvalidParameterValue", "ElementSetName",
+            "ElementSetName must be one of %s" % ", ".join(_ELEMENT_SETS))
+    return esn
+
+def _output_schema(value):
+    if not value:
+        return 'csw'
+    if value not in _OUTPUT_SCHEMAS:
+        raise CswError("InvalidParameterValue", "outputSchema",
+            "outputSchema must be one of %s" % ", ".join(_OUTPUT_SCHEMAS))
+    return _OUTPUT_SCHEMAS[value]
+
+def _int_param(value, name, default):
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise CswError("InvalidParameterValue", name, "%s must be an integer" % name)
+
+def get_capabilities(params, viewable):
+    return _render("maps/csw/server/capabilities.xml", {
+        'url': service_url(),
+        'SITEURL': settings.SITEURL
+    })
+
+def get_records(params, viewable):
+    """
+    Answers a GetRecords request, given as a dict of the KVP parameter
+    names (lower case) and an optional 'constraint' ogc:Filter element,
+    searching the layers with ids in the set viewable.
+    """
+    schema = _output_schema(params.get('outputschema'))
+    esn = _element_set(params.get('elementsetname'))
+    start = max(_int_param(params.get('startposition'), 'startPosition', 1), 1)
+    max_records = _int_param(params.get('maxrecords'), 'maxRecords', DEFAULT_MAX_RECORDS)
+    max_records = min(max(max_records, 0), MAX_RECORDS)
+    result_type = (params.get('resulttype') or 'hits').lower()
+    if result_type not in ('hits', 'results'):
+        raise CswError("InvalidParameterValue", "resultType", "resultType must be hits or results")
+
+    ids = [i for i in find_layers(params.get('constraint')) if i in viewable]
+    page = result_type == 'results' and ids[start - 1:start - 1 + max_records] or []
+    layers = Layer.objects.in_bulk(page)
+    layers = [layers[i] for i in page if i in layers]
+    returned_through = start - 1 + len(layers)
+    context = _records_context(layers, schema, esn)
+    context.update({
+        'schema': schema,
+        'esn': esn,
+        'matched': len(ids),
+        'returned': len(layers),
+        'next': returned_through < len(ids) and returned_through + 1 or 0,
+    })
+    return _render("maps/csw/server/getrecords.xml", context)
+
+def get_record_by_id(params, viewable):
+    """
+    Answers a GetRecordById request for those of the layers with the uuids
+    in the 'id' list of params whose ids are in the set viewable, in the
+    order given.
+    """
+    schema = _output_schema(params.get('outputschema'))
+    esn = _element_set(params.get('elementsetname') or 'full')
+    uuids = params.get('id')
+    if not uuids:
+        raise CswError("MissingParameterValue", "id", "Missing id parameter")
+    layers = dict((l.uuid, l) for l in Layer.objects.filter(uuid__in=uuids) if l.id in viewable)
+    layers = [layers[u] for u in uuids if u in layers]
+    context = _records_context(layers, schema, esn)
+    context.update({'schema': schema, 'esn': esn})
+    return _render("maps/csw/server/getrecordbyid.xml", context)
+
+_OPERATIONS = {
+    'getcapabilities': get_capabilities,
+    'getrecords': get_records,
+    'getrecordbyid': get_record_by_id
+}
+
+def _kvp_params(query):
+    params = dict((key.lower(), value) for key, value in query.items())
+    if 'id' in params:
+        params['id'] = [u.strip() for u in params['id'].split(',') if u.strip()]
+    constraint = params.pop('constraint', None)
+    if constraint:
+        language = params.get('constraintlanguage', 'FILTER').upper()
+        if language != 'FILTER':
+            raise CswError("InvalidParameterValue", "constraintLanguage",
+                "Only FILTER constraints are supported")
+        try:
+            params['constraint'] = XML(constraint.encode('utf-8'))
+        except ExpatError:
+            raise CswError("InvalidParameterValue", "constraint", "The constraint is not valid XML")
+    return params
+
+def _xml_params(body):
+    try:
+        doc = XML(body)
+    except ExpatError:
+        raise CswError("NoApplicableCode", None, "The request is not valid XML")
+    params = dict((key.lower(), value) for key, value in doc.attrib.items()
+                  if not key.startswith('{'))
+    params['request'] = doc.tag.split('}')[-1]
+    query = doc.find(_QUERY)
+    if query is not None:
+        params['elementsetname'] = query.findtext(_ELEMENT_SET_NAME)
+        constraint = query.find(_CONSTRAINT)
+        if constraint is not None:
+            params['constraint'] = constraint.find(_FILTER)
+            if params['constraint'] is None:
+                raise CswError("InvalidParameterValue", "constraint",
+                    "Only FILTER constraints are supported")
+    else:
+        params['elementsetname'] = doc.findtext(_ELEMENT_SET_NAME)
+    params['id'] = [el.text.strip() for el in doc.findall(_ID) if el.text]
+    return params
+
+def handle(request, viewable):
+    """
+    Answers the CSW request made by the HTTP request, with the records of
+    the layers whose ids are in the set viewable.
+    """
+    try:
+        if request.method == 'POST' and request.raw_post_data.lstrip().startswith('<'):
+            params = _xml_params(request.raw_post_data)
+        else:
+            params = _kvp_params(request.REQUEST)
+        if params.get('service', 'CSW').upper() != 'CSW':
+            raise CswError("InvalidParameterValue", "service", "The service must be CSW")
+        name = params.get('request')
+        if not name:
+            raise CswError("MissingParameterValue", "request", "Missing request parameter")
+        if name.lower() not in _OPERATIONS:
+            raise CswError("OperationNotSupported", "request",
+                "%s is not supported by this read-only service" % name)
+        if name.lower() != 'getcapabilities' and params.get('version', '2.0.2') != '2.0.2':
+            raise CswError("VersionNegotiationFailed", "version", "Only version 2.0.2 is supported")
+        return _OPERATIONS[name.lower()](params, viewable)
+    except CswError, e:
+        return _exception(e)
@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 from django import forms
+from django.conf import settings
 import json
 import os
 import tempfile
@@ -12,6 +13,16 @@ class JSONField(forms.CharField):
         except ValueError:
             raise forms.ValidationError("this field must be valid JSON")
 
+def _link(source, target):
+    """Hard links source to target, returning False where that can't be
+       done, as across filesystems.
+    """
+    try:
+        os.link(source, target)
+    except (AttributeError, OSError):
+        return False
+    return True
+
 class LayerUploadForm(forms.Form):
     base_file = forms.FileField()
     dbf_file = forms.FileField(required=False)
@@ -23,8 +34,14 @@ class LayerUploadForm(forms.Form):
     def clean(self):
         cleaned = super(LayerUploadForm, self).clean()
         base_name, base_ext = os.path.splitext(cleaned["base_file"].name)
-        if base_ext.lower() not in (".shp", ".tif", ".tiff", ".geotif", ".geotiff"):
-            raise forms.ValidationError("Only Shapefiles and GeoTiffs are supported. You uploaded a %s file" % base_ext)
+        if base_ext.lower() not in (".shp", ".tif", ".tiff", ".geotif", ".geotiff", ".zip"):
+            raise forms.ValidationError("Only Shapefiles and GeoTiffs, or zip archives of one, are supported. You uploaded a %s file" % base_ext)
+        if base_ext.lower() == ".zip":
+            from geonode.maps.utils import get_zip_members, GeoNodeException
+            try:
+                get_zip_members(cleaned["base_file"])
+            except GeoNodeException, e:
+                raise forms.ValidationError(str(e))
         if base_ext.lower() == ".shp":
             dbf_file = cleaned["dbf_file"]
             shx_file = cleaned["shx_file"]
@@ -45,12 +62,18 @@ class LayerUploadForm(forms.Form):
         return cleaned
 
     def write_files(self):
-        tempdir = tempfile.mkdtemp()
+        # Uploads that Django spooled to disk are linked into the directory
+        # under their own names instead of being copied, so large files are
+        # only written once.  Creating it beside them keeps it on the same
+        # filesystem.
+        tempdir = tempfile.mkdtemp(dir=settings.FILE_UPLOAD_TEMP_DIR)
         for field in self.spatial_files:
             f = self.cleaned_data[field]
             if f is not None:
                 path = os.path.join(tempdir, f.name)
-                with open(path, 'w') as writable:
+                if hasattr(f, 'temporary_file_path') and _link(f.temporary_file_path(), path):
+                    continue
+                with open(path, 'wb') as writable:
                     for c in f.chunks():
                         writable.write(c)
         absolute_base_file = os.path.join(tempdir,
@@ -0,0 +1,95 @@
+from django.core.management.base import BaseCommand
+from geonode.maps.cswsearch import parse_getrecords
+from optparse import make_option
+from owslib.csw import CswRecord, namespaces
+from owslib.util import nspath
+from StringIO import StringIO
+from xml.etree.ElementTree import parse
+import re
+import time
+
+_response_template = """<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dct="http://purl.org/dc/terms/" xmlns:ows="http://www.opengis.net/ows">
+  <csw:SearchStatus timestamp="2011-01-01T00:00:00" />
+  <csw:SearchResults numberOfRecordsMatched="%(matched)d" numberOfRecordsReturned="%(count)d" elementSet="full" nextRecord="%(next)d">
+%(records)s
+  </csw:SearchResults>
+</csw:GetRecordsResponse>
+"""
+
+_record_template = """    <csw:Record>
+      <dc:identifier>%(uuid)s</dc:identifier>
+      <dc:title>Layer %(i)d</dc:title>
+      <dc:type>dataset</dc:type>
+      <dc:subject>keyword%(i)d</dc:subject>
+      <dc:subject>boundaries</dc:subject>
+      <dc:subject>location</dc:subject>
+      <dc:format>ESRI Shapefile</dc:format>
+      <dct:abstract>An abstract describing layer %(i)d, long enough to be representative of what users write here.</dct:abstract>
+      <dc:URI protocol="WWW:LINK-1.0-http--link" name="geonode:layer%(i)d" description="Layer %(i)d">http://localhost:8000/data/geonode:layer%(i)d</dc:URI>
+      <dc:URI protocol="WWW:DOWNLOAD-1.0-http--download" name="layer%(i)d.zip" description="Layer %(i)d (Zipped Shapefile Format)">http://localhost:8001/geoserver/wfs?typename=geonode:layer%(i)d&amp;outputFormat=SHAPE-ZIP</dc:URI>
+      <dc:URI protocol="WWW:DOWNLOAD-1.0-http--download" name="layer%(i)d.kml" description="Layer %(i)d (KML Format)">http://localhost:8001/geoserver/wms/kml?layers=geonode:layer%(i)d</dc:URI>
+      <dc:URI protocol="WWW:DOWNLOAD-1.0-http--download" name="layer%(i)d.pdf" description="Layer %(i)d (PDF Format)">http://localhost:8001/geoserver/wms?layers=geonode:layer%(i)d&amp;format=application/pdf</dc:URI>
+      <dc:URI protocol="OGC:WMS-1.1.1-http-get-map" name="geonode:layer%(i)d" description="Layer %(i)d">http://localhost:8001/geoserver/wms</dc:URI>
+      <ows:BoundingBox crs="urn:ogc:def:crs:::WGS 1984">
+        <ows:LowerCorner>-124.4 32.5</ows:LowerCorner>
+        <ows:UpperCorner>-114.1 42.0</ows:UpperCorner>
+      </ows:BoundingBox>
+    </csw:Record>"""
+
+def sample_response(count, matched=None):
+    """
+    Returns a GetRecords response like GeoNetwork's with count records.
+    """
+    records = "\n".join(_record_template % {
+            'i': i, 'uuid': '00000000-0000-0000-0000-%012d' % i
+        } for i in range(count))
+    return _response_template % {
+        'matched': matched or count,
+        'count': count,
+        'next': 0,
+        'records': records
+    }
+
+def _owslib_parse(response):
+    # the way search results were built before cswsearch, for comparison
+    doc = parse(StringIO(response))
+    results = []
+    for record in doc.findall('.//' + nspath('Record', namespaces['csw'])):
+        rec = CswRecord(record)
+        links = []
+        format_re = re.compile(".*\((.*)(\s*Format*\s*)\).*?")
+        for link_el in record.findall(nspath('URI', namespaces['dc'])):
+            if link_el.get('protocol', '') == 'WWW:DOWNLOAD-1.0-http--download':
+                links.append((link_el.get('name', '').split('.')[-1],
+                              format_re.match(link_el.get('description')).groups()[0],
+                              link_el.text))
+        results.append((rec, links))
+    return results
+
+class Command(BaseCommand):
+    help = """
+    Times parsing of CSW GetRecords responses of 25 and 1000 records (or the
+    sizes given as arguments) with cswsearch, and with owslib as the search
+    view used to.
+    """
+    args = '[record count ...]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', dest='repeat', type='int', default=20,
+            help='How many times to parse each response.'),
+    )
+
+    def handle(self, *args, **options):
+        counts = [int(a) for a in args] or [25, 1000]
+        repeat = options['repeat']
+        for count in counts:
+            response = sample_response(count)
+            for name, parser in [("owslib", _owslib_parse),
+                                 ("cswsearch", lambda r: parse_getrecords(StringIO(r)))]:
+                started = time.time()
+                for i in range(repeat):
+                    parser(response)
+                elapsed = (time.time() - started) / repeat
+                print "%5d records, %-9s: %8.2f ms per response, %6.1f us per record" % (
+                    count, name, elapsed * 1000, elapsed * 1000000 / count)
@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
 from optparse import make_option
+from geonode.maps.manifest import ImportManifest
 from geonode.maps.utils import upload
 
 class Command(BaseCommand):
@@ -17,11 +18,30 @@ class Command(BaseCommand):
             make_option('--quiet', dest='quiet', default=False, action="store_true",
                 help="Don't print out a help message if invoked with an empty path list"),
             make_option('--keywords', dest='keywords', default="", 
-                help="The default keywords for the imported layer(s). Will be the same for all imported layers if multiple imports are done in one command")
+                help="The default keywords for the imported layer(s). Will be the same for all imported layers if multiple imports are done in one command"),
+            make_option('--workers', dest='workers', type='int', default=1,
+                help="How many files of a directory to import at the same time (defaults 1)"),
+            make_option('--timeout', dest='timeout', type='int', default=None,
+                help="Seconds after which a file still importing is reported as failed, when importing with several workers"),
+            make_option('--manifest', dest='manifest', default=None,
+                help="A file recording what was imported, so that importing a directory again skips unchanged files and resumes an interrupted import")
         )
 
     def handle(self, *args, **opts):
         if not opts['quiet'] and len(args) == 0:
             print "No files passed to import command... Is that what you meant to do?"
+        manifest = None
+        if opts['manifest'] is not None:
+            manifest = ImportManifest(opts['manifest'])
         for path in args:
-            upload(path, opts['user'], opts['overwrite'], opts['keywords'].split())
+            upload(path, opts['user'], opts['overwrite'], opts['keywords'].split(),
+                   workers=opts['workers'], timeout=opts['timeout'], callback=self.report,
+                   manifest=manifest)
+
+    def report(self, result):
+        if 'errors' in result:
+            print result['errors']
+        elif result.get('unchanged'):
+            print "Skipped %s, unchanged since imported as %s" % (result['file'], result['name'])
+        else:
+            print "Imported %s as %s" % (result['file'], result['name'])
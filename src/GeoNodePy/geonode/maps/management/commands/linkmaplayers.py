@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from geonode.maps.models import Layer
+
+class Command(BaseCommand):
+    help = """
+    Links map layers that display layers of this GeoNode to those layers
+    (MapLayer.local_layer_id).  Map layers are linked when they are saved, so
+    this is only needed for maps saved before the link existed.
+    """
+    args = '[none]'
+
+    def handle(self, *args, **keywordargs):
+        for layer in Layer.objects.all():
+            layer.link_map_layers()
+        print "Linked map layers for %d layers" % Layer.objects.count()
@@ -0,0 +1,149 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from geonode.geonetwork import Batch
+from geonode.maps.models import Layer
+from optparse import make_option
+from Queue import Queue, Empty
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_STATE_FILE = os.path.join(tempfile.gettempdir(), "geonode-rebuildcatalog.json")
+
+def _read_state(path):
+    try:
+        f = open(path)
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def _write_state(path, state):
+    # write to a temporary file first so an interruption never leaves a
+    # truncated state file behind
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        os.write(fd, json.dumps(state))
+    finally:
+        os.close(fd)
+    os.rename(temp_path, path)
+
+def _worker(catalog, batch_size, chunks, results):
+    try:
+        while True:
+            try:
+                n, layers = chunks.get_nowait()
+            except Empty:
+                return
+            try:
+                batch = Batch(catalog, batch_size, force=True)
+                for layer in layers:
+                    batch.save(layer)
+                results.put((n, batch.flush(), None))
+            except Exception, e:
+                results.put((n, None, e))
+    finally:
+        # rendering the records reads contacts, on this thread's own
+        # database connection
+        connection.close()
+
+class Command(BaseCommand):
+    help = """
+    Rebuilds the GeoNetwork metadata records of all layers from the layer
+    table, inserting the records that are missing and updating the rest.
+    Layers are sent in batched CSW transactions by several worker threads.
+    Progress is saved to a state file after each batch, so an interrupted
+    run can be continued with --resume.
+    """
+    args = '[none]'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=4,
+            help='How many batches to render and send at the same time.'),
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+            help='Layers per transaction (default CSW_TRANSACTION_BATCH_SIZE).'),
+        make_option('--state', dest='state', default=DEFAULT_STATE_FILE,
+            help='Where to save progress (default %s).' % DEFAULT_STATE_FILE),
+        make_option('--resume', action='store_true', dest='resume', default=False,
+            help='Continue an interrupted run, skipping the layers it already sent.'),
+    )
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        batch_size = options['batch_size'] or getattr(settings, "CSW_TRANSACTION_BATCH_SIZE", 50)
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+        state_path = options['state']
+
+        state = {"done_through": 0, "failed": []}
+        if options['resume']:
+            saved = _read_state(state_path)
+            if saved is None:
+                print "No saved progress in %s, starting from the first layer" % state_path
+            else:
+                state = saved
+                print "Resuming after layer id %d" % state["done_through"]
+
+        # layers whose records were refused last time are tried again
+        retry = Layer.objects.filter(id__in=state["failed"])
+        ids = sorted(set(retry.values_list("id", flat=True)) |
+                     set(Layer.objects.filter(id__gt=state["done_through"]).values_list("id", flat=True)))
+        state["failed"] = []
+        chunks = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+        if not chunks:
+            print "No layers to send"
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            return
+
+        pending = Queue()
+        for n, chunk in enumerate(chunks):
+            pending.put((n, list(Layer.objects.filter(id__in=chunk).order_by("id"))))
+        results = Queue()
+        catalog = Layer.objects.gn_catalog
+        for i in range(min(workers, len(chunks))):
+            thread = threading.Thread(target=_worker,
+                args=(catalog, batch_size, pending, results))
+            thread.daemon = True
+            thread.start()
+
+        # Batches finish out of order, so the saved position only moves
+        # past a batch once all those before it are done.
+        finished = {}
+        next_chunk = 0
+        sent = 0
+        broken = []
+        started = time.time()
+        for i in range(len(chunks)):
+            n, chunk_results, error = results.get()
+            finished[n] = chunk_results, error
+            if error is not None:
+                broken.append(n)
+                print "Could not send layers %d to %d: %s" % (chunks[n][0], chunks[n][-1], error)
+            else:
+                for action, layer, record_error in chunk_results:
+                    if record_error is None:
+                        sent += 1
+                    else:
+                        state["failed"].append(layer.id)
+                        print "Could not %s the metadata of %s: %s" % (action, layer.typename, record_error)
+            while next_chunk in finished and finished[next_chunk][1] is None:
+                state["done_through"] = chunks[next_chunk][-1]
+                next_chunk += 1
+            _write_state(state_path, state)
+            print "%d of %d layers sent (%.1f layers/s)" % (
+                sent, len(ids), sent / max(time.time() - started, 0.001))
+
+        if broken:
+            print "%d batches failed; run again with --resume to retry them" % len(broken)
+        elif state["failed"]:
+            print "The metadata of layers with ids %s could not be written" % \
+                ", ".join(str(id) for id in sorted(set(state["failed"])))
+        else:
+            os.remove(state_path)
+        print "Sent the metadata of %d layers" % sent
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from geonode.maps.models import Layer, wkt_to_bbox
+from urllib2 import URLError
+
+class Command(BaseCommand):
+    help = """
+    Fills in the numeric lat/lon extent (bbox_x0, bbox_x1, bbox_y0, bbox_y1)
+    of layers that don't have one yet.  The extent is read from the stored
+    geographic_bounding_box when that is in EPSG:4326; otherwise GeoServer is
+    asked for the layer's lat/lon bounding box.
+    """
+    args = '[none]'
+
+    def handle(self, *args, **keywordargs):
+        updated = 0
+        for layer in Layer.objects.filter(bbox_x0__isnull=True):
+            box = wkt_to_bbox(layer.geographic_bounding_box)
+            if box is None or box[4] not in ("4326", "EPSG:4326"):
+                try:
+                    resource = layer.resource
+                except (URLError, RuntimeError):
+                    print "Couldn't connect to GeoServer; is it running? Make sure the GEOSERVER_BASE_URL setting is set correctly."
+                    return
+                if resource is None or resource.latlon_bbox is None:
+                    print "No bounds found for %s, skipping" % layer.typename
+                    continue
+                box = resource.latlon_bbox
+            layer.update_latlon_bbox(box)
+            updated += 1
+        print "Updated bounds for %d layers" % updated
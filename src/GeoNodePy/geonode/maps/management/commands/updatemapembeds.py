@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from geonode.maps.bundles import bundles_enabled, update_embed_bundle
+from geonode.maps.models import Map
+
+class Command(BaseCommand):
+    help = """
+    Writes the static embed bundle of every publicly readable map to
+    MAP_EMBED_BUNDLE_ROOT, and removes the bundles of maps that are not
+    publicly readable.  Bundles are kept up to date as maps change, so this
+    is only needed when enabling the setting or after restoring a database.
+    """
+    args = '[none]'
+
+    def handle(self, *args, **keywordargs):
+        if not bundles_enabled():
+            raise CommandError("MAP_EMBED_BUNDLE_ROOT is not set")
+        count = 0
+        for map in Map.objects.all():
+            update_embed_bundle(map)
+            count += 1
+        print "Updated embed bundles for %d maps" % count
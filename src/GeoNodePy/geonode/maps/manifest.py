@@ -0,0 +1,130 @@
+"""
+A record of the data files imported by geonode.maps.utils.upload, so that
+importing the same directory again only uploads what changed.
+
+For each imported file the manifest keeps the size and modification time
+of it and its helper files (the .dbf, .shx, .prj and .sld of a shapefile),
+a SHA-1 of their contents, and the name and uuid of the layer made from
+it.  A file whose sizes and times are unchanged is taken to be unchanged;
+otherwise its contents are hashed again, so files that were only touched
+are still skipped.  Entries are written as soon as a file is uploaded and
+marked complete once the layer's metadata is in GeoNetwork, which lets an
+interrupted import carry on where it stopped.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+def _stats(paths):
+    return [[os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+
+def _digest(paths):
+    sha1 = hashlib.sha1()
+    for path in paths:
+        f = open(path, 'rb')
+        try:
+            for chunk in iter(lambda: f.read(1 << 16), ''):
+                sha1.update(chunk)
+        finally:
+            f.close()
+    return sha1.hexdigest()
+
+class ImportManifest(object):
+    """
+    The import manifest kept in the JSON file at path.  It may be used from
+    several threads at once.
+    """
+
+    # what check() returns for a file
+    NEW, CHANGED, UNCHANGED, INCOMPLETE = "new", "changed", "unchanged", "incomplete"
+
+    # the most seconds record() waits before saving the manifest
+    save_interval = 5
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._saved_at = time.time()
+        if os.path.exists(path):
+            f = open(path)
+            try:
+                self._files = json.load(f)["files"]
+            finally:
+                f.close()
+        else:
+            self._files = {}
+
+    def _key(self, filename):
+        return os.path.realpath(filename)
+
+    def entry(self, filename):
+        """
+        Returns the recorded entry of filename, a dict with the layer
+        'name' and 'uuid' among others, or None.
+        """
+        with self._lock:
+            return self._files.get(self._key(filename))
+
+    def check(self, filename, paths):
+        """
+        Compares filename, made of the data files at paths, with its entry.
+        Returns NEW if it has none, CHANGED if their contents differ from
+        when it was imported, INCOMPLETE if they don't but its import
+        didn't finish, and otherwise UNCHANGED.
+        """
+        entry = self.entry(filename)
+        if entry is None:
+            return self.NEW
+        stats = _stats(paths)
+        if stats != entry["stats"]:
+            if _digest(paths) != entry["sha1"]:
+                return self.CHANGED
+            with self._lock:
+                entry["stats"] = stats
+        return entry["complete"] and self.UNCHANGED or self.INCOMPLETE
+
+    def record(self, filename, paths, layer):
+        """
+        Records that filename, made of the data files at paths, was
+        uploaded as layer.  The manifest is saved if it hasn't been for
+        save_interval seconds.
+        """
+        entry = {
+            "stats": _stats(paths),
+            "sha1": _digest(paths),
+            "name": layer.name,
+            "uuid": layer.uuid,
+            "complete": False
+        }
+        with self._lock:
+            self._files[self._key(filename)] = entry
+            due = time.time() - self._saved_at >= self.save_interval
+        if due:
+            self.save()
+
+    def complete(self, filenames):
+        """
+        Marks the imports of filenames finished, and saves the manifest.
+        """
+        with self._lock:
+            for filename in filenames:
+                entry = self._files.get(self._key(filename))
+                if entry is not None:
+                    entry["complete"] = True
+        self.save()
+
+    def save(self):
+        with self._lock:
+            content = json.dumps({"files": self._files})
+            # write to a temporary file first so an interruption never
+            # leaves a truncated manifest behind
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            try:
+                os.write(fd, content)
+            finally:
+                os.close(fd)
+            os.rename(temp_path, self.path)
+            self._saved_at = time.time()
@@ -2,11 +2,15 @@
 from django.conf import settings
 from django.db import models
 from owslib.wms import WebMapService
-from owslib.csw import CatalogueServiceWeb
 from geoserver.catalog import Catalog
 from geonode.core.models import PermissionLevelMixin
 from geonode.core.models import AUTHENTICATED_USERS, ANONYMOUS_USERS
-from geonode.geonetwork import Catalog as GeoNetwork
+from geonode.core.models import GenericObjectRoleMapping
+from geonode.maps.bundles import bundles_enabled, update_embed_bundle, remove_embed_bundle
+from geonode.maps.cswsearch import get_csw_client, metadata_cache
+from django.contrib.contenttypes.models import ContentType
+from geonode.geonetwork import Catalog as GeoNetwork, Batch as MetadataBatch
+from geonode.geonetwork import metadata_document, metadata_digest, record_digest
 from django.db.models import signals
 from django.utils.html import escape
 import httplib2
@@ -23,6 +27,8 @@ from StringIO import StringIO
 from xml.etree.ElementTree import parse, XML
 from gs_helpers import cascading_delete
 import logging
+import re
+import threading
 
 logger = logging.getLogger("geonode.maps.models")
 
@@ -31,6 +37,26 @@ def bbox_to_wkt(x0, x1, y0, y1, srid="4326"):
     return 'SRID=%s;POLYGON((%s %s,%s %s,%s %s,%s %s,%s %s))' % (srid,
                             x0, y0, x0, y1, x1, y1, x1, y0, x0, y0)
 
+_wkt_bbox_re = re.compile(r"^SRID=(.*);POLYGON\(\((.*)\)\)$")
+
+def wkt_to_bbox(wkt):
+    """
+    The inverse of bbox_to_wkt.  Returns a list [x0, x1, y0, y1, srid] with
+    float coordinates, or None if the string is not a polygon as written by
+    bbox_to_wkt.
+    """
+    match = _wkt_bbox_re.match(wkt or '')
+    if match is None:
+        return None
+    srid, ring = match.groups()
+    try:
+        points = [[float(c) for c in pt.split()] for pt in ring.split(',')]
+    except ValueError:
+        return None
+    xs = [pt[0] for pt in points]
+    ys = [pt[1] for pt in points]
+    return [min(xs), max(xs), min(ys), max(ys), srid]
+
 
 
 
@@ -532,7 +558,6 @@ def _get_viewer_projection_info(srid):
     return _viewer_projection_lookup.get(srid, {})
 
 _wms = None
-_csw = None
 _user, _password = settings.GEOSERVER_CREDENTIALS
 
 def get_wms():
@@ -556,28 +581,50 @@ def get_wms():
     _wms = WebMapService(wms_url, xml=body)
 
 def get_csw():
-    global _csw
-    csw_url = "%ssrv/en/csw" % settings.GEONETWORK_BASE_URL
-    _csw = CatalogueServiceWeb(csw_url)
-    return _csw
+    """
+    Returns an owslib CatalogueServiceWeb for GeoNetwork to make a request
+    with, without fetching the catalog's capabilities first.
+    """
+    return get_csw_client().requests()
+
+class _ThreadCatalog(object):
+    """
+    Stands in for a gsconfig Catalog, using a separate one in each thread
+    since a catalog's HTTP connection can't be shared between threads.
+    """
+
+    def __init__(self, url, user, password):
+        self._args = (url, user, password)
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        catalog = getattr(self._local, 'catalog', None)
+        if catalog is None:
+            catalog = self._local.catalog = Catalog(*self._args)
+        return getattr(catalog, name)
 
 class LayerManager(models.Manager):
     
     def __init__(self):
         models.Manager.__init__(self)
         url = "%srest" % settings.GEOSERVER_BASE_URL
-        user, password = settings.GEOSERVER_CREDENTIALS
-        self.gs_catalog = Catalog(url, _user, _password)
+        self.gs_catalog = _ThreadCatalog(url, _user, _password)
         self.geonetwork = GeoNetwork(settings.GEONETWORK_BASE_URL, settings.GEONETWORK_CREDENTIALS[0], settings.GEONETWORK_CREDENTIALS[1])
 
     @property
     def gn_catalog(self):
-        # check if geonetwork is logged in
-        if not self.geonetwork.connected:
-            self.geonetwork.login()
-        # Make sure to logout after you have finished using it.
+        # the catalog logs its sessions in as needed
         return self.geonetwork
 
+    def intersecting(self, bbox):
+        """
+        Returns the layers whose lat/lon extent intersects the given
+        [minx, miny, maxx, maxy] box, filtered in the database.
+        """
+        minx, miny, maxx, maxy = [float(c) for c in bbox]
+        return self.filter(bbox_x0__lte=maxx, bbox_x1__gte=minx,
+                           bbox_y0__lte=maxy, bbox_y1__gte=miny)
+
     def admin_contact(self):
         # this assumes there is at least one superuser
         superusers = User.objects.filter(is_superuser=True).order_by('id')
@@ -596,43 +643,45 @@ class LayerManager(models.Manager):
 
     def slurp(self):
         cat = self.gs_catalog
-        gn = self.gn_catalog
-        for resource in cat.get_resources():
-            try:
-                store = resource.store
-                workspace = store.workspace
-
-                layer, created = self.get_or_create(name=resource.name, defaults = {
-                    "workspace": workspace.name,
-                    "store": store.name,
-                    "storeType": store.resource_type,
-                    "typename": "%s:%s" % (workspace.name, resource.name),
-                    "title": resource.title or 'No title provided',
-                    "abstract": resource.abstract or 'No abstract provided',
-                    "uuid": str(uuid.uuid4())
-                })
-
-                ## Due to a bug in GeoNode versions prior to 1.0RC2, the data
-                ## in the database may not have a valid date_type set.  The
-                ## invalid values are expected to differ from the acceptable
-                ## values only by case, so try to convert, then fallback to a
-                ## default.
-                ##
-                ## We should probably drop this adjustment in 1.1. --David Winslow
-                if layer.date_type not in Layer.VALID_DATE_TYPES:
-                    candidate = lower(layer.date_type)
-                    if candidate in Layer.VALID_DATE_TYPES:
-                        layer.date_type = candidate
-                    else:
-                        layer.date_type = Layer.VALID_DATE_TYPES[0]
+        # the catalog records are written in batches once all layers are saved
+        with GeoNetworkBatch():
+            for resource in cat.get_resources():
+                try:
+                    store = resource.store
+                    workspace = store.workspace
+
+                    layer, created = self.get_or_create(name=resource.name, defaults = {
+                        "workspace": workspace.name,
+                        "store": store.name,
+                        "storeType": store.resource_type,
+                        "typename": "%s:%s" % (workspace.name, resource.name),
+                        "title": resource.title or 'No title provided',
+                        "abstract": resource.abstract or 'No abstract provided',
+                        "uuid": str(uuid.uuid4())
+                    })
 
-                layer.save()
-                if created: 
-                    layer.set_default_permissions()
-            finally:
-                pass
-        # Doing a logout since we know we don't need this object anymore.
-        gn.logout()
+                    ## Due to a bug in GeoNode versions prior to 1.0RC2, the data
+                    ## in the database may not have a valid date_type set.  The
+                    ## invalid values are expected to differ from the acceptable
+                    ## values only by case, so try to convert, then fallback to a
+                    ## default.
+                    ##
+                    ## We should probably drop this adjustment in 1.1. --David Winslow
+                    if layer.date_type not in Layer.VALID_DATE_TYPES:
+                        candidate = lower(layer.date_type)
+                        if candidate in Layer.VALID_DATE_TYPES:
+                            layer.date_type = candidate
+                        else:
+                            layer.date_type = Layer.VALID_DATE_TYPES[0]
+
+                    if resource.latlon_bbox is not None:
+                        layer.set_latlon_bbox(resource.latlon_bbox)
+
+                    layer.save()
+                    if created: 
+                        layer.set_default_permissions()
+                finally:
+                    pass
 
 class Layer(models.Model, PermissionLevelMixin):
     """
@@ -647,7 +696,7 @@ class Layer(models.Model, PermissionLevelMixin):
     store = models.CharField(max_length=128)
     storeType = models.CharField(max_length=128)
     name = models.CharField(max_length=128)
-    uuid = models.CharField(max_length=36)
+    uuid = models.CharField(max_length=36, db_index=True)
     typename = models.CharField(max_length=128, unique=True)
     owner = models.ForeignKey(User, blank=True, null=True)
 
@@ -682,7 +731,16 @@ class Layer(models.Model, PermissionLevelMixin):
     temporal_extent_start = models.DateField(_('temporal extent start'), blank=True, null=True)
     temporal_extent_end = models.DateField(_('temporal extent end'), blank=True, null=True)
     geographic_bounding_box = models.TextField(_('geographic bounding box'))
+    # the lat/lon extent of the layer, kept as numbers so the database can
+    # filter and aggregate on it.  see set_latlon_bbox()
+    bbox_x0 = models.FloatField(blank=True, null=True, db_index=True)
+    bbox_x1 = models.FloatField(blank=True, null=True, db_index=True)
+    bbox_y0 = models.FloatField(blank=True, null=True, db_index=True)
+    bbox_y1 = models.FloatField(blank=True, null=True, db_index=True)
     supplemental_information = models.TextField(_('supplemental information'), default=DEFAULT_SUPPLEMENTAL_INFORMATION)
+    # a hash of the metadata document last written to GeoNetwork, so that
+    # saves which don't change it aren't sent again.  see save_to_geonetwork()
+    metadata_digest = models.CharField(max_length=40, blank=True, null=True)
 
     # Section 6
     distribution_url = models.TextField(_('distribution URL'), blank=True, null=True)
@@ -698,10 +756,10 @@ class Layer(models.Model, PermissionLevelMixin):
         """Returns a list of (mimetype, URL) tuples for downloads of this data
         in various formats."""
  
-        bbox = self.resource.latlon_bbox
+        bbox = self.geographic_bbox()
 
-        dx = float(bbox[1]) - float(bbox[0])
-        dy = float(bbox[3]) - float(bbox[2])
+        dx = bbox[1] - bbox[0]
+        dy = bbox[3] - bbox[2]
 
         dataAspect = 1 if dy == 0 else dx / dy
 
@@ -711,11 +769,11 @@ class Layer(models.Model, PermissionLevelMixin):
         # bbox: this.adjustBounds(widthAdjust, heightAdjust, values.llbbox).toString(),
 
         srs = 'EPSG:4326' # bbox[4] might be None
-        bbox_string = ",".join([bbox[0], bbox[2], bbox[1], bbox[3]])
+        bbox_string = ",".join([str(bbox[0]), str(bbox[2]), str(bbox[1]), str(bbox[3])])
 
         links = []        
 
-        if self.resource.resource_type == "featureType":
+        if self.storeType == "dataStore":
             def wfs_link(mime):
                 return settings.GEOSERVER_BASE_URL + "wfs?" + urllib.urlencode({
                     'service': 'WFS',
@@ -732,7 +790,7 @@ class Layer(models.Model, PermissionLevelMixin):
                 ("json", _("GeoJSON"), "json")
             ]
             links.extend((ext, name, wfs_link(mime)) for ext, name, mime in types)
-        elif self.resource.resource_type == "coverage":
+        elif self.storeType == "coverageStore":
             try:
                 client = httplib2.Http()
                 description_url = settings.GEOSERVER_BASE_URL + "wcs?" + urllib.urlencode({
@@ -833,12 +891,14 @@ class Layer(models.Model, PermissionLevelMixin):
         #    msg = "API Record missing for layer [%s]" % self.typename
         #    raise GeoNodeException(msg)
  
-        # Check the layer is in the GeoNetwork catalog and points back to get_absolute_url
-        if(_csw is None): # Might need to re-cache, nothing equivalent to _wms.contents?
-            get_csw()
+        # Check the layer is in the GeoNetwork catalog and points back to get_absolute_url,
+        # unless its record is waiting in a batch (which reports its own failures)
+        if current_geonetwork_batch() is not None:
+            return
         try:
-            _csw.getrecordbyid([self.uuid])
-            csw_layer = _csw.records.get(self.uuid)
+            csw = get_csw()
+            csw.getrecordbyid([self.uuid])
+            csw_layer = csw.records.get(self.uuid)
         except:
             msg = "CSW Record Missing for layer [%s]" % self.typename
             raise GeoNodeException(msg)
@@ -858,8 +918,17 @@ class Layer(models.Model, PermissionLevelMixin):
 
     def maps(self):
         """Return a list of all the maps that use this layer"""
+        map_layers = MapLayer.objects.filter(local_layer_id=self.id).select_related('map')
+        return set([layer.map for layer in map_layers])
+
+    def link_map_layers(self):
+        """
+        Links map layers saved before this layer existed that refer to it
+        through the local GeoServer.
+        """
         local_wms = "%swms" % settings.GEOSERVER_BASE_URL
-        return set([layer.map for layer in MapLayer.objects.filter(ows_url=local_wms, name=self.typename).select_related()])
+        MapLayer.objects.filter(ows_url=local_wms, name=self.typename,
+            local_layer_id__isnull=True).update(local_layer_id=self.id)
 
     def metadata(self):
         global _wms
@@ -887,11 +956,8 @@ class Layer(models.Model, PermissionLevelMixin):
         return _wms[self.typename]
 
     def metadata_csw(self):
-        global _csw
-        if(_csw is None):
-            _csw = get_csw()
-        _csw.getrecordbyid([self.uuid], outputschema = 'http://www.isotc211.org/2005/gmd')
-        return _csw.records.get(self.uuid)
+        record = metadata_cache.get(self.uuid)
+        return record and record[0]
 
     @property
     def attribute_names(self):
@@ -941,19 +1007,33 @@ class Layer(models.Model, PermissionLevelMixin):
         cascading_delete(Layer.objects.gs_catalog, self.resource)
 
     def delete_from_geonetwork(self):
+        batch = current_geonetwork_batch()
+        # a closed batch was flushed already, so write directly
+        if batch is not None and batch.delete(self):
+            return
         gn = Layer.objects.gn_catalog
         gn.delete_layer(self)
-        gn.logout()
+        metadata_cache.invalidate(self.uuid)
 
     def save_to_geonetwork(self):
+        batch = current_geonetwork_batch()
+        if batch is not None and batch.save(self):
+            return
+        document = metadata_document(self)
+        digest = metadata_digest(document)
+        if digest == self.metadata_digest:
+            # the catalog already has this record
+            return
         gn = Layer.objects.gn_catalog
         record = gn.get_by_uuid(self.uuid)
         if record is None:
-            md_link = gn.create_from_layer(self)
-            self.metadata_links = [("text/xml", "TC211", md_link)]
+            written = gn.insert_layer(self, document)
+            self.metadata_links = [("text/xml", "TC211", gn.url_for_uuid(self.uuid))]
         else:
-            gn.update_layer(self)
-        gn.logout()
+            written = gn.update_layer(self, document)
+        if written:
+            record_digest(self, digest)
+        metadata_cache.invalidate(self.uuid)
 
     @property
     def resource(self):
@@ -1059,7 +1139,6 @@ class Layer(models.Model, PermissionLevelMixin):
             self.resource.metadata_links = [('text/xml', 'TC211', gn.url_for_uuid(self.uuid))]
             self.resource.keywords = self.keyword_list()
             Layer.objects.gs_catalog.save(self._resource_cache)
-            gn.logout()
         if self.poc and self.poc.user:
             self.publishing.attribution = str(self.poc.user)
             profile = Contact.objects.get(user=self.poc.user)
@@ -1073,6 +1152,8 @@ class Layer(models.Model, PermissionLevelMixin):
         srs = gs_resource.projection
         if self.geographic_bounding_box is '' or self.geographic_bounding_box is None:
             self.set_bbox(gs_resource.native_bbox, srs=srs)
+        if self.bbox_x0 is None and gs_resource.latlon_bbox is not None:
+            self.set_latlon_bbox(gs_resource.latlon_bbox)
 
     def _autopopulate(self):
         if self.poc is None:
@@ -1112,6 +1193,41 @@ class Layer(models.Model, PermissionLevelMixin):
             srid = box[4]
         self.geographic_bounding_box = bbox_to_wkt(box[0], box[1], box[2], box[3], srid=srid )
 
+    def set_latlon_bbox(self, box):
+        """
+        Sets the numeric lat/lon extent from a gsconfig style
+        [x0, x1, y0, y1, ...] latlon_bbox.
+        """
+        self.bbox_x0, self.bbox_x1, self.bbox_y0, self.bbox_y1 = \
+            [float(c) for c in box[:4]]
+
+    def update_latlon_bbox(self, box):
+        """
+        Like set_latlon_bbox, but also writes the extent straight to the
+        database, skipping the GeoServer/GeoNetwork sync a save() would do.
+        The search indexes are updated as a save() would.
+        """
+        # imported here as geonode.maps.search imports this module
+        from geonode.maps.search import layer_updated
+        self.set_latlon_bbox(box)
+        Layer.objects.filter(pk=self.pk).update(
+            bbox_x0=self.bbox_x0, bbox_x1=self.bbox_x1,
+            bbox_y0=self.bbox_y0, bbox_y1=self.bbox_y1)
+        layer_updated(self)
+
+    def geographic_bbox(self):
+        """
+        Returns the lat/lon extent of this layer as floats [x0, x1, y0, y1].
+        This uses the stored bounding box when it is in EPSG:4326 and only
+        asks GeoServer for the resource when it is not.
+        """
+        if self.bbox_x0 is not None:
+            return [self.bbox_x0, self.bbox_x1, self.bbox_y0, self.bbox_y1]
+        box = wkt_to_bbox(self.geographic_bounding_box)
+        if box is not None and box[4] in ("4326", "EPSG:4326"):
+            return box[:4]
+        return [float(c) for c in self.resource.latlon_bbox[:4]]
+
     def get_absolute_url(self):
         return "/data/%s" % (self.typename)
 
@@ -1517,6 +1633,23 @@ class MapLayer(models.Model):
     If this dictionary conflicts with options that are stored in other fields
     (such as ows_url) then the fields override.
     """
+
+    local_layer_id = models.IntegerField(null=True, blank=True, editable=False, db_index=True)
+    """
+    The id of the layer of this GeoNode that this map layer displays, if
+    any.  This is set when the map layer is saved, using the same heuristic
+    as local().  It is not a foreign key, as deleting a layer would then
+    delete the map layers displaying it; the links are cleared instead.
+    """
+
+    @property
+    def local_layer(self):
+        if self.local_layer_id is None:
+            return None
+        try:
+            return Layer.objects.get(id=self.local_layer_id)
+        except Layer.DoesNotExist:
+            return None
     
     def local(self): 
         """
@@ -1524,10 +1657,20 @@ class MapLayer(models.Model):
         paired with the GeoNode site.  Currently this is based on heuristics,
         but we try to err on the side of false negatives.
         """
+        if self.local_layer_id is not None:
+            return True
         if self.ows_url == (settings.GEOSERVER_BASE_URL + "wms"):
             return Layer.objects.filter(typename=self.name).count() != 0
         else: 
             return False
+
+    def save(self, *args, **kwargs):
+        self.local_layer_id = None
+        if self.ows_url == (settings.GEOSERVER_BASE_URL + "wms"):
+            ids = Layer.objects.filter(typename=self.name).values_list('id', flat=True)
+            if ids:
+                self.local_layer_id = ids[0]
+        super(MapLayer, self).save(*args, **kwargs)
  
     def source_config(self):
         """
@@ -1574,7 +1717,7 @@ class MapLayer(models.Model):
     @property
     def local_link(self): 
         if self.local():
-            layer = Layer.objects.get(typename=self.name)
+            layer = self.local_layer or Layer.objects.get(typename=self.name)
             link = "<a href=\"%s\">%s</a>" % (layer.get_absolute_url(),layer.title)
         else: 
             link = "<span>%s</span> " % self.name
@@ -1628,6 +1771,58 @@ class ContactRole(models.Model):
     class Meta:
         unique_together = (("contact", "layer", "role"),)
 
+_local = threading.local()
+
+def current_geonetwork_batch():
+    return getattr(_local, 'geonetwork_batch', None)
+
+class GeoNetworkBatch(object):
+    """
+    Collects the GeoNetwork writes of layers saved and deleted in this
+    thread within a with statement, and sends them in batched CSW
+    transactions at its end::
+
+        with GeoNetworkBatch() as batch:
+            for layer in layers:
+                layer.save()
+        failed = [layer for action, layer, error in batch.results if error]
+
+    A batch begun inside another is merged into the outer one.  Writes
+    from threads still attached after it has ended, like those of uploads
+    given up on after a timeout, are made directly.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        self.results = []
+        self._batch = None
+        self._target = None
+
+    def __enter__(self):
+        if current_geonetwork_batch() is None:
+            self._batch = MetadataBatch(Layer.objects.gn_catalog, self.batch_size)
+            _local.geonetwork_batch = self._batch
+        # the batch writes go to, this one's or the one it is merged into
+        self._target = current_geonetwork_batch()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._batch is not None:
+            _local.geonetwork_batch = None
+            self.results = self._batch.flush()
+        return False
+
+    def attach(self):
+        """
+        Sends the GeoNetwork writes of the calling thread to this batch
+        too, until detach() is called.  For the worker threads of the
+        thread that began the batch.
+        """
+        _local.geonetwork_batch = self._target
+
+    def detach(self):
+        _local.geonetwork_batch = None
+
 def delete_layer(instance, sender, **kwargs): 
     """
     Removes the layer from GeoServer and GeoNetwork
@@ -1641,12 +1836,48 @@ def post_save_layer(instance, sender, **kwargs):
 
     if kwargs['created']:
         instance._populate_from_gs()
+        instance.link_map_layers()
 
     instance.save_to_geonetwork()
 
     if kwargs['created']:
-        instance._populate_from_gn()
+        # a batched record isn't in the catalog yet to read back
+        if current_geonetwork_batch() is None:
+            instance._populate_from_gn()
         instance.save(force_update=True)
 
+def post_save_map(instance, sender, **kwargs):
+    update_embed_bundle(instance)
+
+def post_delete_map(instance, sender, **kwargs):
+    if bundles_enabled():
+        remove_embed_bundle(instance.id)
+
+def map_permissions_changed(instance, sender, **kwargs):
+    """
+    Keeps the embed bundle of a map in line with whether anonymous users may
+    view it.
+    """
+    if not bundles_enabled():
+        return
+    if instance.object_ct != ContentType.objects.get_for_model(Map):
+        return
+    try:
+        update_embed_bundle(Map.objects.get(pk=instance.object_id))
+    except Map.DoesNotExist:
+        remove_embed_bundle(instance.object_id)
+
+def unlink_map_layers(instance, sender, **kwargs):
+    """
+    Clears the links of the map layers displaying the deleted layer, which
+    keep referring to it by name.
+    """
+    MapLayer.objects.filter(local_layer_id=instance.id).update(local_layer_id=None)
+
 signals.pre_delete.connect(delete_layer, sender=Layer)
+signals.post_delete.connect(unlink_map_layers, sender=Layer)
 signals.post_save.connect(post_save_layer, sender=Layer)
+signals.post_save.connect(post_save_map, sender=Map)
+signals.post_delete.connect(post_delete_map, sender=Map)
+signals.post_save.connect(map_permissions_changed, sender=GenericObjectRoleMapping)
+signals.post_delete.connect(map_permissions_changed, sender=GenericObjectRoleMapping)
@@ -0,0 +1,601 @@
+"""
+In-process indexes over the local Layer and Map tables, used to answer
+searches for local layers without a round trip to GeoNetwork and to rank map
+searches, and a cache of search results.
+
+The indexes are built lazily from the database on first use and are kept
+current by the Layer and Map save and delete signals.  Since other processes may
+write to the same database, they are also rebuilt when they are older than
+settings.LOCAL_SEARCH_INDEX_TTL seconds.
+"""
+from django.conf import settings
+from django.db.models import signals
+from geonode.maps.models import Layer, Map, MapLayer
+from bisect import bisect_left, insort
+import logging
+import math
+import re
+import threading
+import time
+
+logger = logging.getLogger("geonode.maps.search")
+
+def _index_ttl():
+    return getattr(settings, "LOCAL_SEARCH_INDEX_TTL", 300)
+
+
+class _Index(object):
+    """
+    Base class for the indexes below, handling loading, expiry and locking.
+    Subclasses implement _reset, _add and _discard to maintain their
+    structures one object at a time.
+    """
+
+    model = Layer
+    fields = ('id',)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded_at = None
+
+    def _rows(self):
+        return self.model.objects.values(*self.fields)
+
+    def _load(self):
+        self._reset()
+        for row in self._rows():
+            self._add(row)
+        self._loaded_at = time.time()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.time() - self._loaded_at > _index_ttl():
+            self._load()
+
+    def _row(self, instance):
+        return dict((f, getattr(instance, f)) for f in self.fields)
+
+    def update(self, layer):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            row = self._row(layer)
+            self._discard(layer.id)
+            self._add(row)
+
+    def remove(self, layer):
+        with self._lock:
+            if self._loaded_at is None:
+                return
+            self._discard(layer.id)
+
+    def clear(self):
+        with self._lock:
+            self._loaded_at = None
+            self._reset()
+
+
+def _union(boxes):
+    minxs, minys, maxxs, maxys = zip(*boxes)
+    return (min(minxs), min(minys), max(maxxs), max(maxys))
+
+def _intersects(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def _str_pack(entries, node_size):
+    """
+    Groups (box, item) pairs into nodes of at most node_size entries using
+    the Sort-Tile-Recursive algorithm: sort by the x center, cut into
+    vertical slices, then sort each slice by the y center and cut it into
+    nodes.  Returns a list of (box, [entries]) pairs.
+    """
+    node_count = int(math.ceil(len(entries) / float(node_size)))
+    slice_count = int(math.ceil(math.sqrt(node_count)))
+    slice_size = slice_count * node_size
+
+    def x_center(entry):
+        return entry[0][0] + entry[0][2]
+    def y_center(entry):
+        return entry[0][1] + entry[0][3]
+
+    entries = sorted(entries, key=x_center)
+    nodes = []
+    for i in range(0, len(entries), slice_size):
+        vertical_slice = sorted(entries[i:i + slice_size], key=y_center)
+        for j in range(0, len(vertical_slice), node_size):
+            children = vertical_slice[j:j + node_size]
+            nodes.append((_union([c[0] for c in children]), children))
+    return nodes
+
+
+class LayerExtentIndex(_Index):
+    """
+    An STR-packed R-tree over the lat/lon extents of local layers.
+
+    Layer extents are kept in a dict which signal handlers update; the packed
+    tree is rebuilt from it on the first query after a change.
+    """
+
+    fields = ('id', 'bbox_x0', 'bbox_x1', 'bbox_y0', 'bbox_y1')
+
+    def __init__(self, node_size=16):
+        super(LayerExtentIndex, self).__init__()
+        self.node_size = node_size
+        self._reset()
+
+    def _reset(self):
+        self._extents = {}
+        self._tree = None
+
+    def _add(self, row):
+        if row['bbox_x0'] is not None:
+            self._extents[row['id']] = (row['bbox_x0'], row['bbox_y0'],
+                                        row['bbox_x1'], row['bbox_y1'])
+        self._tree = None
+
+    def _discard(self, layer_id):
+        self._extents.pop(layer_id, None)
+        self._tree = None
+
+    def _build(self):
+        """
+        Packs the current extents bottom-up into a tree, returning a list of
+        top level nodes.  Each node is a (box, children, is_leaf) tuple where
+        the children of leaf nodes are (box, layer id) pairs.
+        """
+        entries = [(box, layer_id) for layer_id, box in self._extents.iteritems()]
+        if len(entries) == 0:
+            return []
+        level = [(box, children, True) for box, children
+                 in _str_pack(entries, self.node_size)]
+        while len(level) > self.node_size:
+            level = [(box, children, False) for box, children
+                     in _str_pack([(n[0], n) for n in level], self.node_size)]
+            level = [(box, [c[1] for c in children], leaf)
+                     for box, children, leaf in level]
+        return level
+
+    def intersects(self, bbox):
+        """
+        Finds the layers whose extent intersects bbox, given as
+        [minx, miny, maxx, maxy] in lat/lon.
+
+        Returns a tuple (ids, stats) where ids is a set of layer ids and stats
+        is a dict reporting the number of layer extents that had to be tested
+        ('candidates'), the number of hits ('matches'), the number of indexed
+        layers ('size') and the query time in seconds ('elapsed').
+        """
+        started = time.time()
+        query = tuple(float(c) for c in bbox)
+        with self._lock:
+            self._ensure_loaded()
+            if self._tree is None:
+                self._tree = self._build()
+            tree = self._tree
+            size = len(self._extents)
+
+        ids = set()
+        candidates = 0
+        stack = list(tree)
+        while stack:
+            box, children, is_leaf = stack.pop()
+            if not _intersects(box, query):
+                continue
+            if is_leaf:
+                candidates += len(children)
+                for child_box, layer_id in children:
+                    if _intersects(child_box, query):
+                        ids.add(layer_id)
+            else:
+                stack.extend(children)
+
+        stats = {
+            'candidates': candidates,
+            'matches': len(ids),
+            'size': size,
+            'elapsed': time.time() - started
+        }
+        logger.debug("Extent index query %s: %d candidates, %d matches of %d layers in %.6fs",
+                     query, candidates, len(ids), size, stats['elapsed'])
+        return ids, stats
+
+
+_token_re = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    if not text:
+        return []
+    return _token_re.findall(text.lower())
+
+
+class _TextIndex(_Index):
+    """
+    An inverted index over the descriptive text of objects.
+
+    Query terms match indexed terms they are a prefix of, so that as with the
+    catalog's like-queries "calif" finds "California".  Matches are weighted
+    by the field they occur in and by how rare the matched term is.
+    """
+
+    weights = {}
+
+    def __init__(self):
+        super(_TextIndex, self).__init__()
+        self._reset()
+
+    def _reset(self):
+        # term -> {object id: weight}
+        self._postings = {}
+        # sorted list of all terms, for prefix lookups
+        self._terms = []
+        # object id -> (lowercased title, terms), for ordering and removal
+        self._docs = {}
+
+    def _add(self, row):
+        doc_weights = {}
+        for field, weight in self.weights.iteritems():
+            for term in tokenize(row[field]):
+                doc_weights[term] = doc_weights.get(term, 0) + weight
+        for term, weight in doc_weights.iteritems():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = {}
+                insort(self._terms, term)
+            postings[row['id']] = weight
+        self._docs[row['id']] = ((row['title'] or '').lower(), doc_weights.keys())
+
+    def _discard(self, object_id):
+        doc = self._docs.pop(object_id, None)
+        if doc is None:
+            return
+        for term in doc[1]:
+            postings = self._postings[term]
+            del postings[object_id]
+            if not postings:
+                del self._postings[term]
+                del self._terms[bisect_left(self._terms, term)]
+
+    def _expand(self, prefix):
+        i = bisect_left(self._terms, prefix)
+        while i < len(self._terms) and self._terms[i].startswith(prefix):
+            yield self._terms[i]
+            i += 1
+
+    def _term_scores(self, term):
+        scores = {}
+        total = float(len(self._docs))
+        for match in self._expand(term):
+            postings = self._postings[match]
+            idf = math.log(1 + total / len(postings))
+            for object_id, weight in postings.iteritems():
+                scores[object_id] = scores.get(object_id, 0) + weight * idf
+        return scores
+
+    def _scores(self, keywords):
+        scores = {}
+        for keyword in keywords:
+            keyword_scores = None
+            for term in tokenize(keyword):
+                term_scores = self._term_scores(term)
+                if keyword_scores is None:
+                    keyword_scores = term_scores
+                else:
+                    keyword_scores = dict((i, s + term_scores[i])
+                        for i, s in keyword_scores.iteritems() if i in term_scores)
+            for object_id, score in (keyword_scores or {}).iteritems():
+                scores[object_id] = scores.get(object_id, 0) + score
+        return scores
+
+    def search(self, keywords):
+        """
+        Finds the objects matching any of keywords, each of which may be a
+        phrase whose words must all match.  Returns a list of ids, best
+        matches first.  With no keywords, all objects are returned ordered
+        by title.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if not keywords:
+                return [object_id for object_id, doc in
+                        sorted(self._docs.iteritems(), key=lambda item: item[1][0])]
+
+            scores = self._scores(keywords)
+            docs = self._docs
+            return sorted(scores, key=lambda i: (-scores[i], docs[i][0]))
+
+
+class LayerTextIndex(_TextIndex):
+    """
+    A text index over the title, abstract, keywords and topic category of
+    local layers.
+    """
+
+    weights = {
+        'title': 4.0,
+        'keywords': 3.0,
+        'topic_category': 2.0,
+        'abstract': 1.0
+    }
+    fields = ('id', 'title', 'abstract', 'keywords', 'topic_category')
+
+
+class MapTextIndex(_TextIndex):
+    """
+    A text index over the title and abstract of maps and the titles of the
+    local layers they contain.
+
+    As a map's layers are saved separately from the map, changes only mark
+    the map as stale, and stale maps are reindexed together on the next
+    search.
+    """
+
+    model = Map
+    weights = {
+        'title': 4.0,
+        'layer_titles': 2.0,
+        'abstract': 1.0
+    }
+    fields = ('id', 'title', 'abstract', 'last_modified')
+    sort_fields = ('title', 'abstract', 'last_modified', 'id')
+
+    # reload everything rather than query for more stale maps than this
+    max_refresh = 200
+
+    def _reset(self):
+        super(MapTextIndex, self)._reset()
+        # map id -> {field: value} for the sort fields
+        self._sort_values = {}
+        self._stale = set()
+
+    def _rows(self, map_ids=None):
+        maps = Map.objects.all()
+        map_layers = MapLayer.objects.filter(local_layer_id__isnull=False)
+        if map_ids is not None:
+            maps = maps.filter(id__in=map_ids)
+            map_layers = map_layers.filter(map__in=map_ids)
+        links = list(map_layers.values_list('map', 'local_layer_id'))
+        titles = dict(Layer.objects.filter(id__in=set(layer_id for map_id, layer_id in links))
+                      .values_list('id', 'title'))
+        layer_titles = {}
+        for map_id, layer_id in links:
+            if titles.get(layer_id):
+                layer_titles.setdefault(map_id, []).append(titles[layer_id])
+        for row in maps.values(*self.fields):
+            row['layer_titles'] = " ".join(layer_titles.get(row['id'], []))
+            yield row
+
+    def _add(self, row):
+        super(MapTextIndex, self)._add(row)
+        self._sort_values[row['id']] = dict((f, row[f]) for f in self.sort_fields)
+
+    def _discard(self, map_id):
+        super(MapTextIndex, self)._discard(map_id)
+        self._sort_values.pop(map_id, None)
+
+    def _ensure_loaded(self):
+        super(MapTextIndex, self)._ensure_loaded()
+        if len(self._stale) > self.max_refresh:
+            self._load()
+        elif self._stale:
+            stale = self._stale
+            self._stale = set()
+            for map_id in stale:
+                self._discard(map_id)
+            for row in self._rows(stale):
+                self._add(row)
+
+    def invalidate(self, map_ids):
+        """
+        Marks the maps with the given ids as needing to be reindexed.
+        """
+        with self._lock:
+            if self._loaded_at is not None:
+                self._stale.update(map_ids)
+
+    def update(self, map):
+        self.invalidate([map.id])
+
+    def remove(self, map):
+        self.invalidate([map.id])
+
+    def search(self, keywords, sort_field=None, descending=False):
+        """
+        Finds the maps matching keywords as LayerTextIndex.search does,
+        returning their ids best matches first, or if sort_field is given
+        ordered by that field then id.
+        """
+        if not sort_field:
+            return super(MapTextIndex, self).search(keywords)
+        with self._lock:
+            self._ensure_loaded()
+            if keywords:
+                ids = self._scores(keywords).keys()
+            else:
+                ids = self._docs.keys()
+            values = self._sort_values
+            return sorted(ids, key=lambda i: (values[i][sort_field], i),
+                          reverse=descending)
+
+
+class LayerFacetIndex(_Index):
+    """
+    Counts of local layers by keyword, topic category, year of their date,
+    store type and owner, for narrowing down searches.
+
+    Totals over all layers are kept up to date as layers change; counts for
+    the results of a search are taken from the values stored per layer.
+    """
+
+    facets = ('keyword', 'topic_category', 'date', 'storeType', 'owner')
+    fields = ('id', 'keywords', 'topic_category', 'date', 'storeType', 'owner__username')
+
+    def __init__(self):
+        super(LayerFacetIndex, self).__init__()
+        self._reset()
+
+    def _reset(self):
+        # layer id -> {facet: [values]}
+        self._values = {}
+        # facet -> {value: number of layers}
+        self._totals = dict((f, {}) for f in self.facets)
+
+    def _row(self, layer):
+        row = dict((f, getattr(layer, f)) for f in self.fields[:-1])
+        row['owner__username'] = layer.owner and layer.owner.username
+        return row
+
+    def _add(self, row):
+        values = {
+            'keyword': sorted(set((row['keywords'] or '').split())),
+            'topic_category': [row['topic_category']],
+            'date': [row['date'] and str(row['date'].year)],
+            'storeType': [row['storeType']],
+            'owner': [row['owner__username']]
+        }
+        for facet in self.facets:
+            values[facet] = [v for v in values[facet] if v]
+            totals = self._totals[facet]
+            for value in values[facet]:
+                totals[value] = totals.get(value, 0) + 1
+        self._values[row['id']] = values
+
+    def _discard(self, layer_id):
+        values = self._values.pop(layer_id, None)
+        if values is None:
+            return
+        for facet in self.facets:
+            totals = self._totals[facet]
+            for value in values[facet]:
+                totals[value] -= 1
+                if not totals[value]:
+                    del totals[value]
+
+    def filter(self, ids, filters):
+        """
+        Returns those of ids whose layers have each of the values in filters,
+        a dict of facet names to values.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            layer_values = self._values
+            return [i for i in ids if i in layer_values and
+                    all(v in layer_values[i][f] for f, v in filters.iteritems())]
+
+    def counts(self, ids=None, limit=None):
+        """
+        Counts the layers with the given ids, or all layers if ids is None,
+        by each facet value.  Returns a dict of facet names to lists of
+        (value, count) pairs, most frequent first and at most limit long.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if ids is None:
+                counts = dict((f, dict(c)) for f, c in self._totals.iteritems())
+            else:
+                counts = dict((f, {}) for f in self.facets)
+                for layer_id in ids:
+                    values = self._values.get(layer_id)
+                    if values is None:
+                        continue
+                    for facet in self.facets:
+                        facet_counts = counts[facet]
+                        for value in values[facet]:
+                            facet_counts[value] = facet_counts.get(value, 0) + 1
+
+        result = {}
+        for facet, facet_counts in counts.iteritems():
+            ordered = sorted(facet_counts.iteritems(), key=lambda item: (-item[1], item[0]))
+            result[facet] = ordered[:limit]
+        return result
+
+
+class SearchCache(object):
+    """
+    A small in-process cache of search results.  Entries expire after
+    settings.SEARCH_CACHE_TTL seconds, and once settings.SEARCH_CACHE_SIZE
+    entries are stored the least recently used one is evicted.  Results are
+    shared between users, so they must not hold anything user specific.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> [stored at, last used, value]
+        self._entries = {}
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if now - entry[0] > getattr(settings, "SEARCH_CACHE_TTL", 60):
+                del self._entries[key]
+                return None
+            entry[1] = now
+            return entry[2]
+
+    def put(self, key, value):
+        size = getattr(settings, "SEARCH_CACHE_SIZE", 100)
+        if size <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= size:
+                oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                del self._entries[oldest]
+            self._entries[key] = [now, now, value]
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+extent_index = LayerExtentIndex()
+text_index = LayerTextIndex()
+map_text_index = MapTextIndex()
+facet_index = LayerFacetIndex()
+search_cache = SearchCache()
+
+def _update_indexes(instance, sender, **kwargs):
+    extent_index.update(instance)
+    text_index.update(instance)
+    facet_index.update(instance)
+    search_cache.clear()
+
+def _remove_from_indexes(instance, sender, **kwargs):
+    extent_index.remove(instance)
+    text_index.remove(instance)
+    facet_index.remove(instance)
+    search_cache.clear()
+
+signals.post_save.connect(_update_indexes, sender=Layer)
+signals.post_delete.connect(_remove_from_indexes, sender=Layer)
+
+def layer_updated(layer):
+    """
+    Updates the indexes for a layer written with a queryset update(), which
+    sends no post_save signal.
+    """
+    _update_indexes(layer, Layer)
+
+def _layer_maps_changed(instance, sender, **kwargs):
+    # maps are indexed by the titles of their layers
+    if map_text_index._loaded_at is None:
+        return
+    map_ids = MapLayer.objects.filter(local_layer_id=instance.id).values_list('map', flat=True)
+    map_text_index.invalidate(map_ids)
+
+signals.post_save.connect(_layer_maps_changed, sender=Layer)
+signals.pre_delete.connect(_layer_maps_changed, sender=Layer)
+
+def _map_changed(instance, sender, **kwargs):
+    map_text_index.invalidate([instance.id])
+    search_cache.clear()
+
+signals.post_save.connect(_map_changed, sender=Map)
+signals.post_delete.connect(_map_changed, sender=Map)
+
+def _map_layer_changed(instance, sender, **kwargs):
+    map_text_index.invalidate([instance.map_id])
+
+signals.post_save.connect(_map_layer_changed, sender=MapLayer)
+signals.post_delete.connect(_map_layer_changed, sender=MapLayer)
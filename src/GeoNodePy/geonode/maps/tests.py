@@ -6,7 +6,7 @@ from django.contrib.auth.models import User, AnonymousUser
 import geonode.maps.models
 import geonode.maps.views
 
-from geonode.maps.models import Map, Layer, User
+from geonode.maps.models import Map, Layer, User, Contact
 from geonode.maps.utils import get_valid_user, GeoNodeException
 
 from mock import Mock, patch
@@ -14,9 +14,11 @@ from mock import Mock, patch
 import json
 import os
 import base64
+import time
 
 _gs_resource = Mock()
 _gs_resource.native_bbox = [1, 2, 3, 4]
+_gs_resource.latlon_bbox = [1, 2, 3, 4]
 
 Layer.objects.geonetwork = Mock()
 Layer.objects.gs_catalog = Mock()
@@ -32,6 +34,10 @@ _csw_resource.url = "http://example.com/"
 _csw_resource.description = "example link"
 geonode.maps.models.get_csw.return_value.records.get.return_value.distribution.online = [_csw_resource]
 
+geonode.maps.models.metadata_cache = Mock()
+geonode.maps.models.metadata_cache.get.return_value = (
+    geonode.maps.models.get_csw.return_value.records.get.return_value, None)
+
 class MapTest(TestCase):
     """Tests geonode.maps app/module
     """
@@ -72,7 +78,29 @@ community."
         pass
 
     def test_layer_maps(self):
-        pass
+        from geonode.maps.models import MapLayer
+        layer = Layer.objects.get(typename="base:CA")
+        map = Map.objects.get(pk=1)
+        self.assertEquals(layer.maps(), set([map]))
+
+        remote = MapLayer(map=map, name="base:CA", ows_url="http://example.com/wms",
+                          stack_order=1, layer_params="", source_params="")
+        remote.save()
+        self.assertEquals(remote.local_layer, None)
+        self.assertFalse(remote.local())
+
+        MapLayer.objects.update(local_layer_id=None)
+        layer.link_map_layers()
+        self.assertEquals(MapLayer.objects.filter(local_layer_id=layer.id).count(), 1)
+        self.assertEquals(MapLayer.objects.get(map=map, name="base:CA", ows_url__contains="localhost").local_layer, layer)
+
+        # deleting the layer, even through a queryset as the admin does,
+        # leaves the map intact and unlinked
+        with patch.object(Layer, 'delete_from_geoserver'):
+            with patch.object(Layer, 'delete_from_geonetwork'):
+                Layer.objects.filter(id=layer.id).delete()
+        self.assertEquals(MapLayer.objects.filter(map=map, name="base:CA").count(), 2)
+        self.assertEquals(MapLayer.objects.filter(local_layer_id__isnull=False).count(), 0)
 
     def test_layer_metadata(self):
         pass
@@ -158,6 +186,120 @@ community."
     def test_layer_get_absolute_url(self):
         pass
 
+    def test_layer_intersecting(self):
+        Layer.objects.filter(typename="base:CA").update(
+            bbox_x0=-10, bbox_x1=10, bbox_y0=-5, bbox_y1=5)
+        self.assertEquals(Layer.objects.intersecting([5, 0, 20, 20]).count(), 1)
+        self.assertEquals(Layer.objects.intersecting([10, 5, 20, 20]).count(), 1)
+        self.assertEquals(Layer.objects.intersecting([11, 0, 20, 20]).count(), 0)
+        self.assertEquals(Layer.objects.intersecting([-20, -20, -10.5, 20]).count(), 0)
+
+    def test_layer_extent_index(self):
+        from geonode.maps.search import LayerExtentIndex
+        import random
+        index = LayerExtentIndex(node_size=4)
+        rand = random.Random(42)
+        boxes = {}
+        for i in range(500):
+            x, y = rand.uniform(-180, 170), rand.uniform(-90, 80)
+            boxes[i] = (x, y, x + rand.uniform(0, 10), y + rand.uniform(0, 10))
+        index._extents = boxes
+        index._loaded_at = 1e20
+
+        query = [0, 0, 30, 30]
+        expected = set(i for i, b in boxes.items()
+                       if b[0] <= 30 and b[2] >= 0 and b[1] <= 30 and b[3] >= 0)
+        ids, stats = index.intersects(query)
+        self.assertEquals(ids, expected)
+        self.assertEquals(stats['matches'], len(expected))
+        self.assertEquals(stats['size'], 500)
+        self.assertTrue(stats['candidates'] < 500)
+
+        # changes are picked up on the next query
+        layer = Layer(id=1000, bbox_x0=1, bbox_x1=2, bbox_y0=1, bbox_y1=2)
+        index.update(layer)
+        self.assertTrue(1000 in index.intersects(query)[0])
+        index.remove(layer)
+        self.assertFalse(1000 in index.intersects(query)[0])
+
+    def test_layer_text_index(self):
+        from geonode.maps.search import LayerTextIndex
+        index = LayerTextIndex()
+        index._loaded_at = 1e20
+        index._add(dict(id=1, title="California Roads", abstract="Highways",
+                        keywords="transport roads", topic_category="transportation"))
+        index._add(dict(id=2, title="Oregon Rivers", abstract="Rivers and roads of Oregon",
+                        keywords=None, topic_category="inlandWaters"))
+        index._add(dict(id=3, title="Airports", abstract="",
+                        keywords="transport", topic_category="transportation"))
+
+        self.assertEquals(index.search([]), [3, 1, 2])
+        # title and keyword matches outrank abstract matches
+        self.assertEquals(index.search(["roads"]), [1, 2])
+        self.assertEquals(index.search(["calif"]), [1])
+        self.assertEquals(index.search(["oregon rivers"]), [2])
+        self.assertEquals(index.search(["oregon highways"]), [])
+        self.assertEquals(set(index.search(["airports", "rivers"])), set([2, 3]))
+
+        layer = Layer(id=3, title="Seaports", abstract="", keywords="", topic_category="")
+        index.update(layer)
+        self.assertEquals(index.search(["airports"]), [])
+        self.assertEquals(index.search(["sea"]), [3])
+        index.remove(layer)
+        self.assertEquals(index.search(["sea"]), [])
+        self.assertFalse("seaports" in index._terms)
+
+    def test_map_text_index(self):
+        from geonode.maps.search import MapTextIndex
+        Layer.objects.filter(typename="base:CA").update(title="California Counties")
+        Map.objects.filter(id=1).update(title="Roads", abstract="")
+        other = Map.objects.create(title="Counties of Oregon", abstract="",
+            zoom=1, projection="EPSG:900913", center_x=0, center_y=0)
+        index = MapTextIndex()
+
+        # maps are found by the titles of their layers, but rank below maps
+        # with the term in their own title
+        self.assertEquals(index.search(["counties"]), [other.id, 1])
+        self.assertEquals(index.search(["calif"]), [1])
+        self.assertEquals(index.search(["counties"], 'title'), [other.id, 1])
+        self.assertEquals(index.search(["counties"], 'title', True), [1, other.id])
+
+        # changes are picked up once the maps are invalidated
+        Layer.objects.filter(typename="base:CA").update(title="Nevada Counties")
+        other_id = other.id
+        other.delete()
+        self.assertEquals(index.search(["calif"]), [1])
+        index.invalidate([1, other_id])
+        self.assertEquals(index.search(["calif"]), [])
+        self.assertEquals(index.search(["counties"]), [1])
+
+    def test_updatelayerbounds(self):
+        from django.core.management import call_command
+        from geonode.maps.models import bbox_to_wkt
+        from geonode.maps.search import extent_index
+        Layer.objects.filter(typename="base:CA").update(
+            geographic_bounding_box=bbox_to_wkt(-10, 10, -5, 5, srid="EPSG:4326"),
+            bbox_x0=None, bbox_x1=None, bbox_y0=None, bbox_y1=None)
+        extent_index.clear()
+        self.assertFalse(1 in extent_index.intersects([-1, -1, 1, 1])[0])
+        call_command('updatelayerbounds')
+        layer = Layer.objects.get(typename="base:CA")
+        self.assertEquals(layer.geographic_bbox(), [-10, 10, -5, 5])
+        self.assertEquals(layer.bbox_x0, -10)
+        # the loaded extent index is updated too
+        self.assertTrue(1 in extent_index.intersects([-1, -1, 1, 1])[0])
+
+        layer.update_latlon_bbox([20, 30, 20, 30])
+        self.assertFalse(1 in extent_index.intersects([-1, -1, 1, 1])[0])
+        self.assertTrue(1 in extent_index.intersects([25, 25, 26, 26])[0])
+
+    def test_wkt_to_bbox(self):
+        from geonode.maps.models import bbox_to_wkt, wkt_to_bbox
+        wkt = bbox_to_wkt("-10.5", "20", "-5", "7.25", srid="EPSG:4326")
+        self.assertEquals(wkt_to_bbox(wkt), [-10.5, 20.0, -5.0, 7.25, "EPSG:4326"])
+        self.assertEquals(wkt_to_bbox(None), None)
+        self.assertEquals(wkt_to_bbox("POINT(1 2)"), None)
+
     def test_layer_set_default_permissions(self):
         """Verify that Layer.set_default_permissions is behaving as expected
         """
@@ -407,6 +549,38 @@ community."
     def test_embed_map(self):
         pass
 
+    def test_embed_bundles(self):
+        import shutil
+        import tempfile
+        from geonode.core.models import ANONYMOUS_USERS
+        root = tempfile.mkdtemp()
+        settings.MAP_EMBED_BUNDLE_ROOT = root
+        try:
+            map = Map.objects.get(pk=1)
+            map.set_gen_level(ANONYMOUS_USERS, map.LEVEL_NONE)
+            bundle = os.path.join(root, "1")
+            self.assertFalse(os.path.exists(bundle))
+
+            map.set_gen_level(ANONYMOUS_USERS, map.LEVEL_READ)
+            config = json.load(open(os.path.join(bundle, "config.json")))
+            self.assertEquals(config["about"]["title"], map.title)
+            self.assertTrue("GeoExplorer.Viewer" in open(os.path.join(bundle, "index.html")).read())
+
+            map.title = "Renamed Map"
+            map.save()
+            config = json.load(open(os.path.join(bundle, "config.json")))
+            self.assertEquals(config["about"]["title"], "Renamed Map")
+
+            map.set_gen_level(ANONYMOUS_USERS, map.LEVEL_NONE)
+            self.assertFalse(os.path.exists(bundle))
+
+            map.set_gen_level(ANONYMOUS_USERS, map.LEVEL_READ)
+            map.delete()
+            self.assertFalse(os.path.exists(bundle))
+        finally:
+            settings.MAP_EMBED_BUNDLE_ROOT = None
+            shutil.rmtree(root)
+
     # Batch Tests    
     
     def test_map_download(self):
@@ -711,7 +885,36 @@ community."
     def test_build_search_result(self):
         pass
 
+    def test_parse_getrecords(self):
+        from geonode.maps.cswsearch import parse_getrecords
+        from geonode.maps.management.commands.benchmarkcswsearch import sample_response
+        from StringIO import StringIO
+        results = parse_getrecords(StringIO(sample_response(3, matched=10)))
+        self.assertEqual(results['matches'], 10)
+        self.assertEqual(results['returned'], 3)
+        self.assertEqual(len(results['rows']), 3)
+        row = results['rows'][1]
+        self.assertEqual(row['uuid'], '00000000-0000-0000-0000-000000000001')
+        self.assertEqual(row['title'], 'Layer 1')
+        self.assertEqual(row['name'], 'geonode:layer1')
+        self.assertEqual(row['detail'], 'http://localhost:8000/data/geonode:layer1')
+        self.assertEqual(row['keywords'], ['keyword1', 'boundaries', 'location'])
+        self.assertEqual(row['bbox'], {'minx': -124.4, 'maxx': -114.1, 'miny': 32.5, 'maxy': 42.0})
+        self.assertEqual([(l[0], l[1].strip()) for l in row['download_links']],
+                         [('zip', 'Zipped Shapefile'), ('kml', 'KML'), ('pdf', 'PDF')])
+        self.assertTrue(row['uuid'] in row['metadata_links'][0][2])
+
+        exception = """<?xml version="1.0"?>
+        <ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows" version="1.0.0">
+          <ows:Exception exceptionCode="InvalidParameterValue">
+            <ows:ExceptionText>bad filter</ows:ExceptionText>
+          </ows:Exception>
+        </ows:ExceptionReport>"""
+        self.assertRaises(RuntimeError, parse_getrecords, StringIO(exception))
+
     def test_metadata_search(self):
+        from geonode.maps.search import search_cache
+        search_cache.clear()
         c = Client()
 
         #test around _metadata_search helper
@@ -731,9 +934,424 @@ community."
             self.assertEqual(call_args[0][1], 5)
             self.assertEqual(call_args[0][2], 10)
 
+            # equivalent queries are answered from the cache
+            response = c.get("/data/search/api?q=FOO%20&start=5&limit=10")
+            self.assertEqual(mock_ms.call_count, 1)
+            response = c.get("/data/search/api?q=foo&start=15&limit=10")
+            self.assertEqual(mock_ms.call_count, 2)
+
+            # until a layer changes
+            Layer.objects.all()[0].save()
+            response = c.get("/data/search/api?q=foo&start=5&limit=10")
+            self.assertEqual(mock_ms.call_count, 3)
+
+    def test_search_cache(self):
+        from geonode.maps.search import SearchCache
+        cache = SearchCache()
+        settings.SEARCH_CACHE_SIZE = 2
+        try:
+            cache.put("a", 1)
+            cache.put("b", 2)
+            self.assertEqual(cache.get("a"), 1)
+            cache.put("c", 3)
+            # b was the least recently used
+            self.assertEqual(cache.get("b"), None)
+            self.assertEqual(cache.get("a"), 1)
+            self.assertEqual(cache.get("c"), 3)
+
+            settings.SEARCH_CACHE_TTL = -1
+            self.assertEqual(cache.get("a"), None)
+        finally:
+            settings.SEARCH_CACHE_SIZE = 100
+            settings.SEARCH_CACHE_TTL = 60
+
     def test_search_result_detail(self):
         pass
 
+    def test_csw_client(self):
+        from geonode.maps.cswsearch import get_csw_client
+        client = get_csw_client("http://example.com/csw")
+        self.assertTrue(client is get_csw_client("http://example.com/csw"))
+
+        response = """<?xml version="1.0"?>
+        <csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+            xmlns:dc="http://purl.org/dc/elements/1.1/">
+          <csw:Record><dc:identifier>abc</dc:identifier><dc:title>A</dc:title></csw:Record>
+        </csw:GetRecordByIdResponse>"""
+        with patch('owslib.util.http_post') as mock_post:
+            mock_post.return_value = response
+            csw = client.getrecordbyid(["abc"])
+            self.assertEqual(csw.records["abc"].title, "A")
+            # just the one request, no GetCapabilities
+            self.assertEqual(mock_post.call_count, 1)
+            self.assertTrue("GetRecordById" in mock_post.call_args[0][1])
+
+    def test_parse_records(self):
+        from geonode.maps.cswsearch import getrecords_request, parse_records
+        from StringIO import StringIO
+        self.assertTrue("<csw:ElementSetName>brief</csw:ElementSetName>"
+                        in getrecords_request(esn='brief'))
+        response = """<?xml version="1.0"?>
+        <csw:GetRecordByIdResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+            xmlns:dc="http://purl.org/dc/elements/1.1/">
+          <csw:Record><dc:identifier>a</dc:identifier><dc:title>A</dc:title></csw:Record>
+          <csw:Record><dc:identifier>b</dc:identifier><dc:title>B</dc:title></csw:Record>
+        </csw:GetRecordByIdResponse>"""
+        rows = parse_records(StringIO(response))
+        self.assertEqual([(r['uuid'], r['title']) for r in rows], [('a', 'A'), ('b', 'B')])
+
+    def test_geonetwork_sessions(self):
+        from geonode.geonetwork import Catalog
+        from StringIO import StringIO
+        import urllib, urllib2
+        opened = []
+        expired = []
+        def open_url(request):
+            url = request.get_full_url()
+            opened.append(url.split("/")[-1].split("?")[0])
+            if url.endswith("xml.user.login"):
+                body = "<ok />"
+            elif expired:
+                refusal = expired.pop()
+                if refusal == 401:
+                    raise urllib2.HTTPError(url, 401, "Unauthorized", {}, StringIO(""))
+                body = refusal
+            else:
+                body = "<response />"
+            return urllib.addinfourl(StringIO(body), {}, url, 200)
+
+        with patch('urllib2.build_opener') as mock_build_opener:
+            mock_build_opener.return_value.open.side_effect = open_url
+            gn = Catalog("http://localhost/geonetwork/", "admin", "admin")
+            request = urllib2.Request("http://localhost/geonetwork/srv/en/xml.info?type=groups")
+
+            # logged in once, then the session is reused
+            self.assertEqual(gn.urlopen(request).read(), "<response />")
+            self.assertEqual(gn.urlopen(request).read(), "<response />")
+            self.assertEqual(opened, ["xml.user.login", "xml.info", "xml.info"])
+            self.assertEqual(mock_build_opener.call_count, 1)
+
+            # expired sessions log in again
+            for refusal in ('<?xml version="1.0"?>\n<error id="service-not-allowed" />', 401):
+                del opened[:]
+                expired.append(refusal)
+                self.assertEqual(gn.urlopen(request).read(), "<response />")
+                self.assertEqual(opened, ["xml.info", "xml.user.login", "xml.info"])
+
+            # but not because of what a response says
+            del opened[:]
+            text = "<records><title>Service-not-allowed areas, not authenticated</title></records>"
+            expired.append(text)
+            self.assertEqual(gn.urlopen(request).read(), text)
+            self.assertEqual(opened, ["xml.info"])
+
+            # transactions refused as not logged in are sent again too
+            del opened[:]
+            expired.append('<error id="service-not-allowed" />')
+            transaction = urllib2.Request("http://localhost/geonetwork/srv/en/csw", "<csw:Transaction />")
+            self.assertEqual(gn.urlopen(transaction).read(), "<response />")
+            self.assertEqual(opened, ["csw", "xml.user.login", "csw"])
+
+            # failed sessions go back to the pool, to be logged in again
+            del opened[:]
+            mock_build_opener.return_value.open.side_effect = urllib2.URLError("down")
+            self.assertRaises(urllib2.URLError, gn.urlopen, request)
+            self.assertEqual(len(gn._sessions), 1)
+            self.assertTrue(gn._sessions[0].used_at is None)
+            self.assertRaises(urllib2.URLError, gn.urlopen, request)
+            self.assertEqual(len(gn._sessions), 1)
+            mock_build_opener.return_value.open.side_effect = open_url
+            self.assertEqual(gn.urlopen(request).read(), "<response />")
+            self.assertEqual(opened, ["xml.user.login", "xml.info"])
+            self.assertEqual(mock_build_opener.call_count, 1)
+            del opened[:]
+            gn._sessions[0].used_at -= gn.session_idle_timeout + 1
+            gn.urlopen(request)
+            self.assertEqual(opened, ["xml.user.login", "xml.info"])
+
+            # concurrent users get sessions of their own
+            first = gn._checkout()
+            second = gn._checkout()
+            self.assertTrue(first is not second)
+            gn._checkin(first)
+            gn._checkin(second)
+            self.assertEqual(len(gn._sessions), 2)
+
+            del opened[:]
+            gn.logout()
+            self.assertEqual(opened, ["xml.user.logout", "xml.user.logout"])
+            self.assertFalse(gn.connected)
+
+    def test_geonetwork_transactions(self):
+        from geonode.geonetwork import Catalog, Batch, parse_transaction_response
+        import urllib
+        from StringIO import StringIO
+        response = """<csw:TransactionResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">
+          <csw:TransactionSummary>
+            <csw:totalInserted>%d</csw:totalInserted>
+            <csw:totalUpdated>%d</csw:totalUpdated>
+            <csw:totalDeleted>%d</csw:totalDeleted>
+          </csw:TransactionSummary>
+        </csw:TransactionResponse>"""
+        self.assertEqual(parse_transaction_response(response % (1, 2, 3)),
+                         {"insert": 1, "update": 2, "delete": 3})
+        self.assertRaises(RuntimeError, parse_transaction_response,
+            """<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows">
+            <ows:Exception><ows:ExceptionText>no</ows:ExceptionText></ows:Exception>
+            </ows:ExceptionReport>""")
+
+        layers = []
+        for i in range(5):
+            layer = Layer.objects.get(typename="base:CA")
+            layer.uuid = "uuid-%d" % i
+            layers.append(layer)
+
+        gn = Catalog("http://localhost/geonetwork/", "admin", "admin")
+        sent = []
+        def urlopen(request):
+            doc = request.get_data()
+            sent.append(doc)
+            totals = [doc.count("<csw:%s>" % action) for action in ("Insert", "Update", "Delete")]
+            if "uuid-3" in doc and len(sent) == 2:
+                # the second batch has a failing record
+                totals[0] -= 1
+            return StringIO(response % tuple(totals))
+        gn.urlopen = urlopen
+        gn.existing_uuids = Mock(return_value=set(["uuid-0", "uuid-2"]))
+        gn.set_metadata_privs_batch = Mock()
+
+        operations = [("insert", layers[0]), ("update", layers[1]), ("insert", layers[2]),
+                      ("insert", layers[3]), ("delete", layers[4])]
+        results = gn.transaction(operations, batch_size=3)
+        # two batches, then the insert from the failed one that the catalog
+        # doesn't have is sent again on its own
+        self.assertEqual(len(sent), 3)
+        self.assertEqual(sent[2].count("<csw:Insert>"), 1)
+        self.assertEqual(sent[0].count("<csw:Insert>"), 2)
+        self.assertEqual([(a, l.uuid, e is None) for a, l, e in results],
+            [("insert", "uuid-0", True), ("update", "uuid-1", True), ("insert", "uuid-2", True),
+             ("insert", "uuid-3", True), ("delete", "uuid-4", True)])
+
+        # batches send only the last write for each layer, inserting or
+        # updating depending on whether the record exists
+        del sent[:]
+        batch = Batch(gn, batch_size=10)
+        batch.save(layers[0])
+        batch.save(layers[1])
+        batch.delete(layers[1])
+        batch.save(layers[0])
+        self.assertEqual(len(batch), 2)
+        results = batch.flush()
+        self.assertEqual([(a, l.uuid) for a, l, e in results],
+                         [("update", "uuid-0"), ("delete", "uuid-1")])
+        self.assertEqual(len(sent), 1)
+        self.assertFalse(gn.set_metadata_privs_batch.called)
+
+    def test_geonetwork_privileges(self):
+        from geonode.geonetwork import Catalog
+        from StringIO import StringIO
+        import urlparse
+        groups = ['all', 'intranet']
+        replaced = []
+        requests = []
+        def urlopen(request):
+            url = urlparse.urlparse(request.get_full_url())
+            params = dict(urlparse.parse_qsl(url.query))
+            service = url.path.split("/")[-1]
+            requests.append(service)
+            if service == "portal.search.present":
+                dbid = params["uuid"].split("-")[-1] + "".join(replaced)
+                body = ('<response><metadata><geonet:info xmlns:geonet="http://www.fao.org/geonetwork">'
+                        '<id>%s</id></geonet:info></metadata></response>' % dbid)
+            elif params.get("type") == "groups":
+                body = "<info><groups>%s</groups></info>" % "".join(
+                    '<group id="%d"><name>%s</name></group>' % (i, g) for i, g in enumerate(groups))
+            elif params.get("type") == "operations":
+                body = '<info><operations><operation id="0"><name>view</name></operation></operations></info>'
+            elif replaced and not params["id"].endswith("".join(replaced)):
+                body = '<error id="metadata-not-found" />'
+            else:
+                body = '<response id="%s" />' % params["id"]
+            return StringIO(body)
+
+        gn = Catalog("http://localhost/privileges/geonetwork/", "admin", "admin")
+        gn.urlopen = urlopen
+        gn.set_metadata_privs_batch(["uuid-1", "uuid-2"], {"all": {"view": True}})
+        self.assertEqual(requests, ["xml.info", "xml.info", "portal.search.present", "metadata.admin",
+                                    "portal.search.present", "metadata.admin"])
+
+        # ids are remembered, also by other catalogs for the same GeoNetwork
+        del requests[:]
+        other = Catalog("http://localhost/privileges/geonetwork/", "admin", "admin")
+        other.urlopen = urlopen
+        other.set_metadata_privs("uuid-1", {"all": {"view": True}})
+        self.assertEqual(requests, ["metadata.admin"])
+
+        # unknown groups are looked up again
+        del requests[:]
+        groups.append("guest")
+        gn.set_metadata_privs("uuid-1", {"guest": {"view": True}})
+        self.assertEqual(requests, ["xml.info", "xml.info", "metadata.admin"])
+        self.assertRaises(KeyError, gn.set_metadata_privs, "uuid-1", {"nobody": {"view": True}})
+
+        # and so are the ids of records that were replaced
+        del requests[:]
+        replaced.append("0")
+        gn.set_metadata_privs("uuid-2", {"all": {"view": True}})
+        self.assertEqual(requests, ["metadata.admin", "portal.search.present", "metadata.admin"])
+
+    def test_geonetwork_batch(self):
+        from geonode.maps.models import GeoNetworkBatch
+        gn = Layer.objects.geonetwork
+        gn.reset_mock()
+        layer = Layer.objects.get(typename="base:CA")
+        with patch('geonode.maps.models.MetadataBatch') as mock_batch:
+            with GeoNetworkBatch() as batch:
+                with GeoNetworkBatch():
+                    layer.save_to_geonetwork()
+                layer.delete_from_geonetwork()
+                self.assertFalse(gn.update_layer.called)
+                self.assertFalse(gn.delete_layer.called)
+            mock_batch.return_value.save.assert_called_with(layer)
+            mock_batch.return_value.delete.assert_called_with(layer)
+            self.assertEqual(mock_batch.return_value.flush.call_count, 1)
+            self.assertEqual(batch.results, mock_batch.return_value.flush.return_value)
+
+    def test_geonetwork_batch_closed(self):
+        from geonode.maps.models import GeoNetworkBatch
+        layer = Layer.objects.get(typename="base:CA")
+        layer.metadata_digest = None
+        with patch('geonode.maps.models.Layer.objects.geonetwork') as gn:
+            gn.existing_uuids.return_value = set([layer.uuid])
+            gn.transaction.return_value = [("update", layer, None)]
+            with GeoNetworkBatch() as batch:
+                layer.save_to_geonetwork()
+                self.assertFalse(gn.update_layer.called)
+            self.assertTrue(gn.transaction.called)
+
+            # a worker that carries on after the batch was sent writes directly
+            gn.reset_mock()
+            layer.title = "Saved late"
+            batch.attach()
+            try:
+                layer.save_to_geonetwork()
+                layer.delete_from_geonetwork()
+            finally:
+                batch.detach()
+            self.assertTrue(gn.update_layer.called)
+            self.assertTrue(gn.delete_layer.called)
+            self.assertFalse(gn.transaction.called)
+
+    def test_metadata_digest(self):
+        from geonode.geonetwork import Batch
+        gn = Layer.objects.geonetwork
+        layer = Layer.objects.get(typename="base:CA")
+        layer.metadata_digest = None
+        gn.reset_mock()
+
+        layer.save_to_geonetwork()
+        self.assertTrue(gn.update_layer.called)
+        digest = Layer.objects.get(pk=layer.pk).metadata_digest
+        self.assertEqual(len(digest), 40)
+        self.assertEqual(layer.metadata_digest, digest)
+
+        # unchanged metadata isn't sent again
+        gn.reset_mock()
+        layer.save_to_geonetwork()
+        self.assertFalse(gn.get_by_uuid.called)
+        self.assertFalse(gn.update_layer.called)
+        self.assertEqual(Batch(gn).flush(), [])
+
+        batch = Batch(gn)
+        batch.save(layer)
+        self.assertEqual(batch.flush(), [])
+        self.assertFalse(gn.transaction.called)
+
+        catalog = Mock()
+        catalog.existing_uuids.return_value = set([layer.uuid])
+        catalog.transaction.return_value = [("update", layer, None)]
+        batch = Batch(catalog, force=True)
+        batch.save(layer)
+        self.assertEqual(batch.flush(), [("update", layer, None)])
+
+        layer.title = "A new title"
+        layer.save_to_geonetwork()
+        self.assertTrue(gn.update_layer.called)
+        self.assertNotEqual(Layer.objects.get(pk=layer.pk).metadata_digest, digest)
+
+    def test_rebuild_catalog(self):
+        from django.core.management import call_command
+        from StringIO import StringIO
+        import sys
+        import tempfile
+        layer = Layer.objects.get(typename="base:CA")
+        fd, state_path = tempfile.mkstemp()
+        os.close(fd)
+        saved = []
+        def flush(error):
+            return [("insert", l, error) for l in saved]
+
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            with patch('geonode.maps.management.commands.rebuildcatalog.Batch') as mock_batch:
+                mock_batch.return_value.save.side_effect = saved.append
+                mock_batch.return_value.flush.side_effect = lambda: flush("refused")
+                call_command('rebuildcatalog', workers=2, state=state_path)
+                self.assertEqual(saved, [layer])
+                state = json.load(open(state_path))
+                self.assertEqual(state, {"done_through": layer.id, "failed": [layer.id]})
+
+                # resuming only sends the refused record again
+                del saved[:]
+                mock_batch.return_value.flush.side_effect = lambda: flush(None)
+                call_command('rebuildcatalog', resume=True, state=state_path)
+                self.assertEqual(saved, [layer])
+                self.assertFalse(os.path.exists(state_path))
+
+                del saved[:]
+                json.dump({"done_through": layer.id, "failed": []}, open(state_path, "w"))
+                call_command('rebuildcatalog', resume=True, state=state_path)
+                self.assertEqual(saved, [])
+        finally:
+            sys.stdout = stdout
+            if os.path.exists(state_path):
+                os.remove(state_path)
+
+    def test_metadata_cache(self):
+        from geonode.maps.cswsearch import MetadataCache
+        cache = MetadataCache()
+        fetched = []
+        def fetch(uuid):
+            fetched.append(uuid)
+            return ("record %d" % len(fetched), None)
+        cache._fetch = fetch
+
+        try:
+            self.assertEqual(cache.get("a"), ("record 1", None))
+            self.assertEqual(cache.get("a"), ("record 1", None))
+            self.assertEqual(fetched, ["a"])
+
+            # stale records are returned while they are fetched again
+            settings.METADATA_CACHE_TTL = -1
+            self.assertEqual(cache.get("a"), ("record 1", None))
+            for i in range(100):
+                if cache._entries["a"][2] != ("record 1", None):
+                    break
+                time.sleep(0.01)
+            settings.METADATA_CACHE_TTL = 300
+            self.assertEqual(cache.get("a"), ("record 2", None))
+
+            cache.invalidate("a")
+            self.assertEqual(cache.get("a"), ("record 3", None))
+
+            settings.METADATA_CACHE_SIZE = 1
+            cache.get("b")
+            self.assertEqual(cache._entries.keys(), ["b"])
+        finally:
+            settings.METADATA_CACHE_TTL = 300
+            settings.METADATA_CACHE_SIZE = 500
+
     def test_split_query(self):
         query = 'alpha "beta gamma"   delta  '
         keywords = geonode.maps.views._split_query(query)
@@ -873,6 +1491,354 @@ class ViewTest(TestCase):
             layer = Layer.objects.all()[0]
             response = client.get("/maps/new?layer=" + layer.typename)
 
+    def test_new_map_with_stored_bbox(self):
+        from geonode.maps.models import bbox_to_wkt
+        Layer.objects.filter(typename="base:CA").update(
+            geographic_bounding_box=bbox_to_wkt(-10, 10, -5, 5, srid="EPSG:4326"),
+            bbox_x0=None, bbox_x1=None, bbox_y0=None, bbox_y1=None)
+        with patch('geonode.maps.models.Layer.objects.gs_catalog') as mock_gs:
+            client = Client()
+            response = client.get("/maps/new/data?layer=base:CA&layer=base:missing")
+            self.assertFalse(mock_gs.get_resource.called)
+        config = json.loads(response.content)
+        self.assertEquals(config["map"]["zoom"], 5)
+        names = [l.get("name") for l in config["map"]["layers"]]
+        self.assertTrue("base:CA" in names)
+        self.assertFalse("base:missing" in names)
+
+    def test_local_metadata_search(self):
+        from geonode.maps.search import extent_index, text_index, search_cache
+        Layer.objects.filter(typename="base:CA").update(title="California",
+            storeType="dataStore", bbox_x0=-10, bbox_x1=10, bbox_y0=-5, bbox_y1=5)
+        extent_index.clear()
+        text_index.clear()
+        search_cache.clear()
+        client = Client()
+        with patch.object(geonode.maps.views, 'get_csw') as mock_csw:
+            response = client.get("/data/search/api?scope=local&q=california&bbox=0,0,20,20")
+            result = json.loads(response.content)
+            self.assertEquals(result["total"], 1)
+            row = result["rows"][0]
+            self.assertEquals(row["name"], "base:CA")
+            self.assertEquals(row["bbox"], {"minx": -10, "maxx": 10, "miny": -5, "maxy": 5})
+            self.assertTrue(row["_local"])
+            self.assertEquals(result["query_info"]["spatial_index"]["matches"], 1)
+
+            response = client.get("/data/search/api?scope=local&bbox=11,0,20,20")
+            self.assertEquals(json.loads(response.content)["total"], 0)
+            response = client.get("/data/search/api?scope=local&q=oregon")
+            self.assertEquals(json.loads(response.content)["total"], 0)
+            response = client.get("/data/search/api?q=calif")
+            self.assertEquals(json.loads(response.content)["total"], 1)
+            self.assertFalse(mock_csw.called)
+
+    def test_search_facets(self):
+        from datetime import datetime
+        from geonode.maps.search import text_index, facet_index, search_cache
+        Layer.objects.filter(typename="base:CA").update(title="California",
+            keywords="boundaries counties", topic_category="boundaries",
+            storeType="dataStore", date=datetime(2010, 5, 1),
+            owner=User.objects.get(username="bobby"))
+        text_index.clear()
+        facet_index.clear()
+        search_cache.clear()
+        client = Client()
+
+        result = json.loads(client.get("/data/search/facets").content)
+        self.assertEquals(result["total"], 1)
+        self.assertEquals(result["facets"], {
+            "keyword": [["boundaries", 1], ["counties", 1]],
+            "topic_category": [["boundaries", 1]],
+            "date": [["2010", 1]],
+            "storeType": [["dataStore", 1]],
+            "owner": [["bobby", 1]]
+        })
+        result = json.loads(client.get("/data/search/facets?q=calif&keyword=counties&facet_limit=1").content)
+        self.assertEquals(result["facets"]["keyword"], [["boundaries", 1]])
+        result = json.loads(client.get("/data/search/facets?q=oregon").content)
+        self.assertEquals(result["total"], 0)
+        self.assertEquals(result["facets"]["owner"], [])
+
+        # facet values narrow the search results
+        response = client.get("/data/search/api?q=calif&topic_category=boundaries")
+        self.assertEquals(json.loads(response.content)["total"], 1)
+        response = client.get("/data/search/api?q=calif&date=2011")
+        self.assertEquals(json.loads(response.content)["total"], 0)
+
+        # counts follow layer changes
+        layer = Layer.objects.get(typename="base:CA")
+        layer.keywords = "counties"
+        facet_index.update(layer)
+        self.assertEquals(facet_index.counts()["keyword"], [("counties", 1)])
+        facet_index.remove(layer)
+        self.assertEquals(facet_index.counts()["keyword"], [])
+
+    def test_search_records(self):
+        from geonode.maps.search import text_index, search_cache
+        Layer.objects.filter(typename="base:CA").update(title="California",
+            abstract="Counties", storeType="dataStore")
+        text_index.clear()
+        search_cache.clear()
+        layer = Layer.objects.get(typename="base:CA")
+        client = Client()
+
+        # brief results only carry what's needed to list them
+        response = client.get("/data/search/api?scope=local&q=california&esn=brief")
+        row = json.loads(response.content)["rows"][0]
+        self.assertEquals(sorted(row.keys()), ["_local", "_permissions", "bbox", "detail",
+                                               "name", "title", "uuid"])
+        response = client.get("/data/search/api?scope=local&q=california&esn=summary")
+        row = json.loads(response.content)["rows"][0]
+        self.assertEquals(row["abstract"], "Counties")
+        self.assertFalse("download_links" in row)
+
+        # and the full records are fetched together
+        with patch.object(geonode.maps.views.cswsearch, 'records') as mock_records:
+            mock_records.return_value = [{'uuid': 'remote', 'title': 'Remote'}]
+            response = client.get("/data/search/records?uuid=remote,%s&uuid=missing" % layer.uuid)
+            rows = json.loads(response.content)["rows"]
+            self.assertEquals([r["uuid"] for r in rows], ["remote", layer.uuid])
+            self.assertEquals(rows[1]["name"], "base:CA")
+            self.assertTrue("download_links" in rows[1])
+            mock_records.assert_called_with(["remote", "missing"])
+
+    def test_search_catalog_brief(self):
+        from geonode.maps.search import search_cache
+        from StringIO import StringIO
+        search_cache.clear()
+        layer = Layer.objects.get(typename="base:CA")
+        response = """<?xml version="1.0"?>
+        <csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+            xmlns:dc="http://purl.org/dc/elements/1.1/">
+          <csw:SearchResults numberOfRecordsMatched="3" numberOfRecordsReturned="2" nextRecord="3">
+            <csw:BriefRecord><dc:identifier>%s</dc:identifier><dc:title>California</dc:title></csw:BriefRecord>
+            <csw:BriefRecord><dc:identifier>remote</dc:identifier><dc:title>Remote</dc:title></csw:BriefRecord>
+          </csw:SearchResults>
+        </csw:GetRecordsResponse>""" % layer.uuid
+        with patch('geonode.maps.cswsearch.urllib2.urlopen') as mock_urlopen:
+            mock_urlopen.return_value = StringIO(response)
+            response = Client().get("/data/search/api?scope=catalog&q=california&esn=brief&limit=2")
+            request = mock_urlopen.call_args[0][0]
+            self.assertTrue("<csw:ElementSetName>brief</csw:ElementSetName>" in request.get_data())
+        result = json.loads(response.content)
+        self.assertEquals(result["total"], 3)
+        self.assertEquals([r["title"] for r in result["rows"]], ["California", "Remote"])
+        self.assertEquals(result["rows"][0]["name"], "base:CA")
+        self.assertTrue(result["rows"][0]["_local"])
+        # later pages are brief too
+        self.assertTrue("esn=brief" in result["next"])
+
+    def test_search_harvested(self):
+        from geonode.maps.search import text_index, search_cache
+        from StringIO import StringIO
+        Layer.objects.filter(typename="base:CA").update(title="California")
+        text_index.clear()
+        search_cache.clear()
+        response = """<?xml version="1.0"?>
+        <csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2"
+            xmlns:dc="http://purl.org/dc/elements/1.1/">
+          <csw:SearchResults numberOfRecordsMatched="2" numberOfRecordsReturned="%d" nextRecord="%d">
+            %s
+          </csw:SearchResults>
+        </csw:GetRecordsResponse>"""
+        remote = "<csw:BriefRecord><dc:identifier>remote</dc:identifier><dc:title>Remote</dc:title></csw:BriefRecord>"
+        client = Client()
+        settings.SEARCH_HARVESTED_RECORDS = True
+        try:
+            with patch('geonode.maps.cswsearch.urllib2.urlopen') as mock_urlopen:
+                # local layers come from the local index, and the catalog
+                # is only asked to count its harvested records
+                mock_urlopen.return_value = StringIO(response % (0, 1, ""))
+                result = json.loads(client.get("/data/search/api?q=california&limit=1&esn=brief").content)
+                request = mock_urlopen.call_args[0][0].get_data()
+                self.assertTrue('resultType="hits"' in request)
+                self.assertTrue("_isHarvested" in request)
+                self.assertEquals(result["total"], 3)
+                self.assertEquals([r["name"] for r in result["rows"]], ["base:CA"])
+                self.assertTrue("start=1" in result["next"])
+                self.assertTrue("esn=brief" in result["next"])
+                self.assertFalse("scope" in result["next"])
+
+                # which the following local pages don't ask again
+                mock_urlopen.reset_mock()
+                result = json.loads(client.get("/data/search/api?q=california&limit=1").content)
+                self.assertFalse(mock_urlopen.called)
+                self.assertEquals(result["total"], 3)
+
+                # pages past the local layers list the harvested records
+                mock_urlopen.return_value = StringIO(response % (1, 2, remote))
+                result = json.loads(client.get("/data/search/api?q=california&limit=1&start=1").content)
+                request = mock_urlopen.call_args[0][0].get_data()
+                self.assertTrue('startPosition="1"' in request)
+                self.assertTrue('maxRecords="1"' in request)
+                self.assertEquals([r["title"] for r in result["rows"]], ["Remote"])
+                self.assertFalse(result["rows"][0]["_local"])
+                self.assertTrue("start=2" in result["next"])
+
+                # catalog searches keep their scope and extent on later pages
+                mock_urlopen.return_value = StringIO(response % (1, 2, remote))
+                result = json.loads(client.get("/data/search/api?scope=catalog&bbox=-180,-90,180,90"
+                                               "&q=remote&limit=1").content)
+                self.assertTrue("scope=catalog" in result["next"])
+                self.assertTrue("bbox=-180.0%2C-90.0%2C180.0%2C90.0" in result["next"])
+        finally:
+            settings.SEARCH_HARVESTED_RECORDS = False
+
+    def test_search_cache_query(self):
+        from geonode.maps.search import text_index, search_cache
+        Layer.objects.filter(typename="base:CA").update(title="California")
+        text_index.clear()
+        search_cache.clear()
+        client = Client()
+
+        response = client.get("/data/search/api?scope=local&q=California&start=1&limit=1")
+        result = json.loads(response.content)
+        self.assertEquals(result["query_info"]["q"], "California")
+        self.assertTrue("q=California" in result["prev"])
+
+        # the same keywords written differently share the cached result,
+        # but not its query text
+        response = client.get("/data/search/api?scope=local&q=california&start=1&limit=1")
+        result = json.loads(response.content)
+        self.assertEquals(result["query_info"]["q"], "california")
+        self.assertTrue("q=california" in result["prev"])
+        self.assertEquals(len(search_cache._entries), 1)
+
+    def test_csw(self):
+        from geonode.core.models import ANONYMOUS_USERS
+        from geonode.maps.cswsearch import getrecords_request, parse_getrecords, parse_records
+        from geonode.maps.search import text_index, extent_index
+        from StringIO import StringIO
+        from xml.etree.ElementTree import XML
+        Layer.objects.filter(typename="base:CA").update(title="California",
+            abstract="Counties", keywords="boundaries", storeType="dataStore",
+            bbox_x0=-124.4, bbox_x1=-114.1, bbox_y0=32.5, bbox_y1=42.0)
+        text_index.clear()
+        extent_index.clear()
+        layer = Layer.objects.get(typename="base:CA")
+        client = Client()
+
+        # layers are only listed to users who may view them
+        layer.set_gen_level(ANONYMOUS_USERS, layer.LEVEL_NONE)
+        response = client.get("/data/csw?service=CSW&version=2.0.2&request=GetRecords&resultType=results")
+        self.assertEquals(parse_getrecords(StringIO(response.content))["matches"], 0)
+        layer.set_gen_level(ANONYMOUS_USERS, layer.LEVEL_READ)
+
+        response = client.get("/data/csw?service=CSW&request=GetCapabilities")
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue("GetRecordById" in response.content)
+
+        response = client.get("/data/csw?service=CSW&version=2.0.2&request=GetRecords"
+                              "&resultType=results&elementSetName=full")
+        result = parse_getrecords(StringIO(response.content))
+        self.assertEquals(result["matches"], 1)
+        row = result["rows"][0]
+        self.assertEquals(row["uuid"], layer.uuid)
+        self.assertEquals(row["name"], "base:CA")
+        self.assertEquals(row["keywords"], ["boundaries"])
+        self.assertEquals(row["bbox"], {"minx": -124.4, "maxx": -114.1, "miny": 32.5, "maxy": 42.0})
+        self.assertTrue(row["download_links"])
+
+        # the filters GeoNode's own search sends are understood
+        for keywords, bbox, matches in [(["california"], None, 1),
+                                        (["oregon"], None, 0),
+                                        (["california", "oregon"], [-120, 35, -119, 36], 1),
+                                        (["california"], [0, 0, 10, 10], 0)]:
+            response = client.post("/data/csw", getrecords_request(keywords, 1, 10, bbox, "brief"),
+                                   content_type="application/xml")
+            self.assertEquals(parse_getrecords(StringIO(response.content))["matches"], matches)
+
+        response = client.get("/data/csw?service=CSW&version=2.0.2&request=GetRecordById"
+                              "&id=missing,%s" % layer.uuid)
+        self.assertEquals([r["uuid"] for r in parse_records(StringIO(response.content))], [layer.uuid])
+        response = client.get("/data/csw?service=CSW&version=2.0.2&request=GetRecordById&id=%s"
+                              "&outputSchema=http://www.isotc211.org/2005/gmd" % layer.uuid)
+        doc = XML(response.content)
+        self.assertEquals(doc.findtext(".//{http://www.isotc211.org/2005/gmd}fileIdentifier/"
+                                       "{http://www.isotc211.org/2005/gco}CharacterString"), layer.uuid)
+
+        response = client.get("/data/csw?service=CSW&version=2.0.2&request=Transaction")
+        self.assertEquals(response.status_code, 400)
+        self.assertTrue("OperationNotSupported" in response.content)
+
+    def test_search_permissions(self):
+        from geonode.core.models import ANONYMOUS_USERS, AUTHENTICATED_USERS
+        from geonode.maps.search import search_cache
+        search_cache.clear()
+        layer = Layer.objects.get(typename="base:CA")
+        layer.set_gen_level(ANONYMOUS_USERS, layer.LEVEL_READ)
+        layer.set_gen_level(AUTHENTICATED_USERS, layer.LEVEL_READ)
+        layer.set_user_level(User.objects.get(username="bobby"), layer.LEVEL_WRITE)
+        rows = [{'uuid': layer.uuid}, {'uuid': 'not-a-local-layer'}]
+
+        client = Client()
+        with patch.object(geonode.maps.views, '_metadata_search') as mock_ms:
+            mock_ms.return_value = {'rows': rows}
+            result = json.loads(client.get("/data/search/api?q=anon").content)
+            self.assertEquals(result["rows"][0]["_permissions"], {'view': True,
+                'change': False, 'delete': False, 'change_permissions': False})
+            self.assertFalse(result["rows"][1]["_local"])
+
+            client.login(username="bobby", password="bob")
+            result = json.loads(client.get("/data/search/api?q=bobby").content)
+            self.assertEquals(result["rows"][0]["_permissions"], {'view': True,
+                'change': True, 'delete': False, 'change_permissions': False})
+
+            # the same as asking for each permission separately
+            bobby = User.objects.get(username="bobby")
+            for flag, perm in [('view', 'view_layer'), ('change', 'change_layer'),
+                               ('delete', 'delete_layer'),
+                               ('change_permissions', 'change_layer_permissions')]:
+                self.assertEquals(result["rows"][0]["_permissions"][flag],
+                                  bobby.has_perm('maps.' + perm, obj=layer))
+
+    def test_maps_search(self):
+        from geonode.maps.search import search_cache
+        from geonode.maps.views import _maps_search
+        search_cache.clear()
+        bobby = User.objects.get(username="bobby")
+        contact, created = Contact.objects.get_or_create(user=bobby)
+        contact.name = "Bobby Contact"
+        contact.save()
+        for i in range(7):
+            Map.objects.create(title="Search map %d" % (i % 3), abstract="for paging",
+                zoom=1, projection="EPSG:900913", center_x=0, center_y=0, owner=bobby)
+
+        # walking the pages by cursor gives the same maps as by offset
+        for sort, dir in [('', 'ASC'), ('title', 'ASC'), ('title', 'DESC'),
+                          ('last_modified', 'DESC')]:
+            by_offset = [row['id'] for row in
+                         _maps_search('paging', 0, 10, sort, dir)['rows']]
+            self.assertEquals(len(by_offset), 7)
+            by_cursor = []
+            after = None
+            start = 0
+            while True:
+                result = _maps_search('paging', start, 3, sort, dir, after)
+                self.assertEquals(result['total'], 7)
+                by_cursor.extend(row['id'] for row in result['rows'])
+                if 'next' not in result:
+                    break
+                self.assertTrue('after=' in result['next'])
+                after = result['next_after']
+                start += 3
+            self.assertEquals(by_cursor, by_offset)
+
+        titles = [row['title'] for row in _maps_search('paging', 0, 10, 'title', 'DESC')['rows']]
+        self.assertEquals(titles, sorted(titles, reverse=True))
+        row = _maps_search('paging', 0, 1, '', 'ASC')['rows'][0]
+        self.assertEquals(row['owner'], "Bobby Contact")
+
+        # the total is cached until maps change
+        self.assertEquals(_maps_search('paging', 0, 1, '', 'ASC')['total'], 7)
+        Map.objects.create(title="Search map 7", abstract="for paging",
+            zoom=1, projection="EPSG:900913", center_x=0, center_y=0, owner=bobby)
+        self.assertEquals(_maps_search('paging', 0, 1, '', 'ASC')['total'], 8)
+
+        # bad cursors and sort fields are ignored
+        result = _maps_search('paging', 0, 10, 'owner; drop', 'ASC', 'not a cursor')
+        self.assertEquals(len(result['rows']), 8)
+
 
 from geonode.maps.forms import JSONField, LayerUploadForm, NewLayerUploadForm
 from django.core.files.uploadedfile import SimpleUploadedFile
@@ -992,6 +1958,50 @@ class FormTest(TestCase):
         self.assertEquals(set(os.listdir(tempdir)),
             set(['foo.shp', 'foo.shx', 'foo.dbf', 'foo.prj']))
 
+    def testZipArchives(self):
+        import zipfile
+        from StringIO import StringIO
+
+        def archive(*members):
+            data = StringIO()
+            zf = zipfile.ZipFile(data, 'w')
+            for member in members:
+                zf.writestr(member, " ")
+            zf.close()
+            return SimpleUploadedFile('foo.zip', data.getvalue())
+
+        files = dict(base_file=archive('foo.shp', 'foo.dbf', 'foo.shx'))
+        self.assertTrue(LayerUploadForm(dict(), files).is_valid())
+
+        files = dict(base_file=archive('foo.tif'))
+        self.assertTrue(LayerUploadForm(dict(), files).is_valid())
+
+        files = dict(base_file=archive('foo.shp', 'foo.dbf'))
+        self.assertFalse(LayerUploadForm(dict(), files).is_valid())
+
+        files = dict(base_file=SimpleUploadedFile('foo.zip', 'not a zip'))
+        self.assertFalse(LayerUploadForm(dict(), files).is_valid())
+
+    def testWriteFilesLinksTemporaryUploads(self):
+        import shutil
+        from django.core.files.uploadedfile import TemporaryUploadedFile
+        upload = TemporaryUploadedFile('foo.tif', 'image/tiff', 6, None)
+        upload.write('pixels')
+        upload.seek(0)
+        form = LayerUploadForm(dict(), dict(base_file=upload))
+        self.assertTrue(form.is_valid())
+
+        tempdir, base_file = form.write_files()
+        try:
+            self.assertEquals(base_file, os.path.join(tempdir, 'foo.tif'))
+            # the spooled upload is not copied
+            self.assertEquals(os.stat(base_file).st_ino,
+                              os.stat(upload.temporary_file_path()).st_ino)
+            self.assertEquals(open(base_file).read(), 'pixels')
+        finally:
+            upload.close()
+            shutil.rmtree(tempdir)
+
 
 class UtilsTest(TestCase):
     def setUp(self):
@@ -1243,6 +2253,188 @@ class UtilsTest(TestCase):
                 # no assertion, this should just run without error
                 check_geonode_is_up()
 
+    def test_cleanup_catalog_record(self):
+        from contextlib import nested
+        from StringIO import StringIO
+        from geonode.geonetwork import Catalog
+        from geonode.maps.utils import cleanup
+
+        gn = Catalog("http://localhost/geonetwork/", "admin", "admin")
+        gn._ids.records["dangling-uuid"] = "7"
+        sent = []
+        def urlopen(request):
+            sent.append(request.get_data())
+            return StringIO("""<csw:TransactionResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2">
+              <csw:TransactionSummary><csw:totalDeleted>1</csw:totalDeleted></csw:TransactionSummary>
+            </csw:TransactionResponse>""")
+        gn.urlopen = urlopen
+        gn.get_by_uuid = Mock(return_value=Mock())
+
+        with nested(
+                patch('geonode.maps.models.Layer.objects.gs_catalog'),
+                patch('geonode.maps.models.Layer.objects.geonetwork', new=gn),
+                patch('geonode.maps.utils.logger')
+            ) as (mock_gs, mock_gn, mock_logger):
+            cleanup("dangling", "dangling-uuid")
+            self.assertFalse(mock_logger.exception.called)
+            self.assertFalse(mock_logger.error.called)
+
+        # the dangling record was deleted
+        self.assertEquals(len(sent), 1)
+        self.assertTrue("<csw:Delete>" in sent[0])
+        self.assertTrue("<ogc:Literal>dangling-uuid</ogc:Literal>" in sent[0])
+        self.assertFalse("dangling-uuid" in gn._ids.records)
+
+    def test_upload_workers(self):
+        import shutil
+        import tempfile
+        from contextlib import nested
+        from geonode.maps.utils import upload
+
+        d = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(d, "sub"))
+            for f in ("roads.shp", "sub/roads.zip", "rivers.tif", "slow.tif", "notes.txt"):
+                open(os.path.join(d, f), 'w').close()
+
+            def file_upload(filename, user=None, title=None, overwrite=True, keywords=[], name=None):
+                if title == "slow":
+                    time.sleep(3)
+                layer = Mock()
+                layer.name = name
+                return layer
+
+            reported = []
+            with nested(
+                    patch('geonode.maps.utils.check_geonode_is_up'),
+                    patch('geonode.maps.utils.file_upload')
+                ) as (mock_up, mock_file_upload):
+                mock_file_upload.side_effect = file_upload
+                results = upload(d, overwrite=False, workers=3, timeout=1, callback=reported.append)
+
+            self.assertEquals(reported, results)
+            self.assertEquals(sorted(r['file'] for r in results),
+                              sorted(os.path.join(d, f) for f in
+                                     ("roads.shp", "sub/roads.zip", "rivers.tif", "slow.tif")))
+            names = dict((os.path.relpath(r['file'], d), r.get('name')) for r in results)
+            # files that would get the same new name don't
+            self.assertEquals(names["roads.shp"], "roads")
+            self.assertEquals(names["sub/roads.zip"], "roads_1")
+            self.assertEquals(names["rivers.tif"], "rivers")
+            self.assertEquals(names["slow.tif"], None)
+            slow = [r for r in results if r['file'].endswith("slow.tif")][0]
+            self.assertTrue("within 1 seconds" in slow['errors'])
+        finally:
+            shutil.rmtree(d)
+
+    def test_upload_manifest(self):
+        import shutil
+        import tempfile
+        from contextlib import nested
+        from geonode.maps.manifest import ImportManifest
+        from geonode.maps.utils import upload
+
+        d = tempfile.mkdtemp()
+        try:
+            data = os.path.join(d, "data")
+            os.mkdir(data)
+            ca = os.path.join(data, "ca.tif")
+            roads = os.path.join(data, "roads.tif")
+            for path in (ca, roads):
+                f = open(path, 'w')
+                f.write("pixels")
+                f.close()
+            manifest_path = os.path.join(d, "manifest.json")
+
+            def file_upload(filename, user=None, title=None, overwrite=True, keywords=[], name=None):
+                layer = Mock()
+                # ca.tif is imported as the fixture layer, roads.tif as a
+                # layer that is not in the database
+                layer.name = name or {"ca": "CA"}.get(title, title)
+                if layer.name == "CA":
+                    layer.uuid = Layer.objects.get(name="CA").uuid
+                else:
+                    layer.uuid = "uuid-" + layer.name
+                return layer
+
+            def run():
+                with nested(
+                        patch('geonode.maps.utils.check_geonode_is_up'),
+                        patch('geonode.maps.utils.file_upload'),
+                        patch('geonode.maps.models.Layer.save_to_geonetwork')
+                    ) as (mock_up, mock_file_upload, mock_save):
+                    mock_file_upload.side_effect = file_upload
+                    results = upload(data, overwrite=False, manifest=ImportManifest(manifest_path))
+                uploaded = dict((args[0], kwargs) for args, kwargs in mock_file_upload.call_args_list)
+                return dict((r['file'], r) for r in results), uploaded, mock_save.call_count
+
+            results, uploaded, saved = run()
+            self.assertEquals(sorted(uploaded), [ca, roads])
+            self.assertEquals(results[ca]['name'], "CA")
+            manifest = ImportManifest(manifest_path)
+            self.assertEquals(manifest.entry(ca)['uuid'], Layer.objects.get(name="CA").uuid)
+            self.assertTrue(manifest.entry(ca)['complete'])
+
+            # touching a file doesn't change it; roads.tif is imported again
+            # as a new layer as its layer is gone
+            os.utime(ca, (time.time() + 10, time.time() + 10))
+            results, uploaded, saved = run()
+            self.assertTrue(results[ca]['unchanged'])
+            self.assertEquals(sorted(uploaded), [roads])
+            self.assertEquals(uploaded[roads]['name'], None)
+            self.assertFalse(uploaded[roads]['overwrite'])
+            self.assertEquals(saved, 0)
+
+            # a changed file replaces its layer
+            f = open(ca, 'w')
+            f.write("other pixels")
+            f.close()
+            results, uploaded, saved = run()
+            self.assertEquals(uploaded[ca]['name'], "CA")
+            self.assertTrue(uploaded[ca]['overwrite'])
+            self.assertFalse('unchanged' in results[ca])
+
+            # an import interrupted before the metadata was written only
+            # writes the metadata
+            manifest = ImportManifest(manifest_path)
+            manifest.entry(ca)['complete'] = False
+            manifest.save()
+            results, uploaded, saved = run()
+            self.assertFalse(ca in uploaded)
+            self.assertEquals(saved, 1)
+            self.assertTrue(ImportManifest(manifest_path).entry(ca)['complete'])
+
+            # a layer that took the name of the recorded one is left alone
+            uuid = Layer.objects.get(name="CA").uuid
+            Layer.objects.filter(name="CA").update(uuid="another")
+            results, uploaded, saved = run()
+            self.assertTrue(ca in uploaded)
+            self.assertEquals(uploaded[ca]['name'], None)
+            self.assertFalse(uploaded[ca]['overwrite'])
+            self.assertFalse('unchanged' in results[ca])
+            Layer.objects.filter(name="CA").update(uuid=uuid)
+
+            # an interrupted import keeps the files it recorded
+            os.remove(manifest_path)
+            calls = []
+            def interrupted(filename, **kwargs):
+                calls.append(filename)
+                if len(calls) == 2:
+                    raise KeyboardInterrupt()
+                return file_upload(filename, **kwargs)
+            with nested(
+                    patch('geonode.maps.utils.check_geonode_is_up'),
+                    patch('geonode.maps.utils.file_upload')
+                ) as (mock_up, mock_file_upload):
+                mock_file_upload.side_effect = interrupted
+                self.assertRaises(KeyboardInterrupt, upload, data, overwrite=False,
+                                  manifest=ImportManifest(manifest_path))
+            entry = ImportManifest(manifest_path).entry(calls[0])
+            self.assertFalse(entry['complete'])
+            self.assertEquals(ImportManifest(manifest_path).entry(calls[1]), None)
+        finally:
+            shutil.rmtree(d)
+
 
     def test_save(self):
         import shutil
@@ -1282,6 +2474,7 @@ class UtilsTest(TestCase):
                     mock_resource.store.resource_type = "dataStore"
                     mock_resource.store.workspace.name = "geonode"
                     mock_resource.native_bbox = ["0", "0", "0", "0"]
+                    mock_resource.latlon_bbox = ["0", "0", "0", "0"]
                     mock_resource.projection = "EPSG:4326"
                     mock_gn.url_for_uuid.return_value = "http://example.com/metadata"
 
@@ -1299,3 +2492,132 @@ class UtilsTest(TestCase):
         finally:
             if d is not None:
                 shutil.rmtree(d)
+
+    def test_save_zip(self):
+        import shutil
+        import tempfile
+        import zipfile
+        from contextlib import nested
+        from geonode.maps.utils import save
+
+        d = tempfile.mkdtemp()
+        try:
+            shp_zip = os.path.join(d, "roads.zip")
+            zf = zipfile.ZipFile(shp_zip, 'w', zipfile.ZIP_DEFLATED)
+            for f in ("roads/roads.shp", "roads/roads.SHX", "roads/roads.dbf", "roads/roads.sld"):
+                zf.writestr(f, f == "roads/roads.sld" and "<sld/>" or f * 100)
+            zf.close()
+            layer_zip = os.path.join(d, "a_layer.zip")
+            zf = zipfile.ZipFile(layer_zip, 'w')
+            for f in ("a_layer.shp", "a_layer.shx", "a_layer.dbf"):
+                zf.writestr(f, f)
+            zf.close()
+            tif_zip = os.path.join(d, "dem.zip")
+            zf = zipfile.ZipFile(tif_zip, 'w', zipfile.ZIP_DEFLATED)
+            zf.writestr("dem.tif", "pixels" * 1000)
+            zf.close()
+
+            class MockWMS(object):
+
+                def __init__(self):
+                    self.contents = { 'geonode:a_layer': 'geonode:a_layer' }
+
+                def __getitem__(self, idx):
+                    return self.contents[idx]
+
+            sent = {}
+            def create_store(name, data, *args, **kwargs):
+                # what gsconfig would send
+                if isinstance(data, basestring):
+                    self.assertTrue(data not in (shp_zip, layer_zip))
+                    sent[name] = open(data).read()
+                    zf = zipfile.ZipFile(data)
+                    self.assertTrue(zf.testzip() is None)
+                    sent['members'] = dict((n, zf.read(n)) for n in zf.namelist())
+                    sent['compression'] = set(i.compress_type for i in zf.infolist())
+                    zf.close()
+                    os.unlink(data)
+                else:
+                    self.assertEquals(len(data), 6000)
+                    sent[name] = data.read()
+
+            with nested(
+                    patch.object(geonode.maps.models, '_wms', new=MockWMS()),
+                    patch('geonode.maps.models.Layer.objects.gs_catalog'),
+                    patch('geonode.maps.models.Layer.objects.geonetwork'),
+                    patch('geonode.maps.utils._create_db_featurestore')
+                ) as (mock_wms, mock_gs, mock_gn, mock_db_store):
+                    mock_gs.get_store.return_value.get_resources.return_value = []
+                    mock_resource = mock_gs.get_resource.return_value
+                    mock_resource.name = 'a_layer'
+                    mock_resource.title = 'a_layer'
+                    mock_resource.abstract = 'a_layer'
+                    mock_resource.store.name = "a_layer"
+                    mock_resource.store.resource_type = "dataStore"
+                    mock_resource.store.workspace.name = "geonode"
+                    mock_resource.native_bbox = ["0", "0", "0", "0"]
+                    mock_resource.latlon_bbox = ["0", "0", "0", "0"]
+                    mock_resource.projection = "EPSG:4326"
+                    mock_gs.create_featurestore.side_effect = create_store
+                    mock_gs.create_coveragestore.side_effect = create_store
+                    mock_db_store.side_effect = lambda name, data, overwrite: (
+                        create_store(name, data), (mock_gs.get_store(name), mock_resource))[1]
+                    owner = User.objects.get(username="admin")
+
+                    # a Shapefile is sent with its files at the root of the
+                    # archive, named after the layer
+                    save('a_layer', shp_zip, owner)
+                    self.assertEquals(sent['members'], {
+                        "a_layer.shp": "roads/roads.shp" * 100,
+                        "a_layer.shx": "roads/roads.SHX" * 100,
+                        "a_layer.dbf": "roads/roads.dbf" * 100})
+                    # copied without being decompressed
+                    self.assertEquals(sent['compression'], set([zipfile.ZIP_DEFLATED]))
+                    self.assertTrue(os.path.exists(shp_zip))
+                    mock_gs.create_style.assert_called_with('a_layer', "<sld/>")
+
+                    # so an archive already like that is sent as it is, and
+                    # left in place
+                    save('a_layer', layer_zip, owner)
+                    self.assertEquals(sent['a_layer'], open(layer_zip).read())
+                    self.assertTrue(os.path.exists(layer_zip))
+
+                    # a GeoTIFF is decompressed as it is sent
+                    save('a_layer', tif_zip, owner)
+                    self.assertEquals(sent['a_layer'], "pixels" * 1000)
+                    self.assertEquals(mock_gs.create_coveragestore.call_count, 1)
+        finally:
+            shutil.rmtree(d)
+
+    def test_get_zip_members(self):
+        import shutil
+        import tempfile
+        import zipfile
+        from geonode.maps.utils import get_zip_members, layer_type
+
+        d = tempfile.mkdtemp()
+        try:
+            def archive(name, members):
+                path = os.path.join(d, name)
+                zf = zipfile.ZipFile(path, 'w')
+                for member in members:
+                    zf.writestr(member, " ")
+                zf.close()
+                return path
+
+            shp = archive("a.zip", ["a.shp", "a.dbf", "a.shx", "a.prj", "b.dbf",
+                                    "__MACOSX/._a.shp"])
+            self.assertEquals(get_zip_members(shp),
+                dict(shp="a.shp", dbf="a.dbf", shx="a.shx", prj="a.prj"))
+            self.assertEquals(layer_type(shp), "featureType")
+            tif = archive("b.zip", ["data/b.TIF", "readme.txt"])
+            self.assertEquals(get_zip_members(tif), dict(tif="data/b.TIF"))
+            self.assertEquals(layer_type(tif), "coverage")
+
+            for members in (["a.shp", "a.dbf"], ["a.shp", "a.dbf", "a.shx", "b.tif"], ["readme.txt"]):
+                self.assertRaises(GeoNodeException, get_zip_members, archive("c.zip", members))
+            not_zip = os.path.join(d, "d.zip")
+            open(not_zip, 'w').close()
+            self.assertRaises(GeoNodeException, get_zip_members, not_zip)
+        finally:
+            shutil.rmtree(d)
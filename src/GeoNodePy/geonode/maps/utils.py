@@ -1,10 +1,10 @@
 from itertools import cycle, izip
 import logging
 import re
-from django.db import transaction
+from django.db import connection, transaction
 from django.utils.translation import ugettext as _
 from django.contrib.auth.models import User
-from geonode.maps.models import Map, Layer, MapLayer, Contact, ContactRole, Role, get_csw
+from geonode.maps.models import Map, Layer, MapLayer, Contact, ContactRole, Role, get_csw, GeoNetworkBatch
 from geonode.maps.gs_helpers import fixup_style, cascading_delete, get_sld_for, delete_from_postgis
 import geoserver
 from geoserver.catalog import FailedRequestError
@@ -16,10 +16,17 @@ from django.conf import settings
 import sys
 import os
 import glob
+import shutil
+import tempfile
 import traceback
 import inspect
 import string
+import struct
 import urllib2
+import threading
+import time
+from Queue import Queue, Empty
+import zipfile
 
 logger = logging.getLogger("geonode.maps.utils")
 
@@ -37,6 +44,11 @@ def layer_type(filename):
         return FeatureType.resource_type
     elif extension.lower() in ['.tif', '.tiff', '.geotiff', '.geotif']:
         return Coverage.resource_type
+    elif extension.lower() == '.zip':
+        if 'shp' in get_zip_members(filename):
+            return FeatureType.resource_type
+        else:
+            return Coverage.resource_type
     else:
         msg = ('Saving of extension [%s] is not implemented' % extension)
         raise GeoNodeException(msg)
@@ -84,14 +96,135 @@ def get_files(filename):
 
     return files
 
-def get_valid_name(layer_name):
-    """Create a brand new name
+def get_zip_members(archive):
+    """Finds the Shapefile or GeoTIFF in a zip archive, given as a filename
+       or a file object, reading only its central directory.  Returns a
+       dictionary of member names like get_files(): either the 'shp',
+       'dbf', 'shx' and optional 'prj' and 'sld' members of a Shapefile or
+       the 'tif' member of a GeoTIFF.
+    """
+    filename = getattr(archive, 'name', archive)
+    try:
+        zf = zipfile.ZipFile(archive)
+    except (zipfile.BadZipfile, IOError), e:
+        msg = '%s is not a valid zip archive: %s' % (filename, str(e))
+        raise GeoNodeException(msg)
+    try:
+        # skip directories and the resource forks OS X adds to archives
+        names = [info.filename for info in zf.infolist()
+                 if not info.filename.endswith('/') and not info.filename.startswith('__MACOSX/')]
+    finally:
+        zf.close()
+
+    def members(base_name, extensions):
+        return [n for n in names if os.path.splitext(n)[1].lower() in extensions
+                and (base_name is None or os.path.splitext(n)[0] == base_name)]
+
+    shps = members(None, ['.shp'])
+    tifs = members(None, ['.tif', '.tiff', '.geotiff', '.geotif'])
+    if len(shps) + len(tifs) != 1:
+        msg = ('A zip archive must hold exactly one Shapefile or GeoTIFF; '
+               '%s holds %d') % (filename, len(shps) + len(tifs))
+        raise GeoNodeException(msg)
+    if tifs:
+        return {'tif': tifs[0]}
+
+    files = {'shp': shps[0]}
+    base_name = os.path.splitext(shps[0])[0]
+    for ext in ('dbf', 'shx', 'prj', 'sld'):
+        matches = members(base_name, ['.' + ext])
+        if len(matches) == 1:
+            files[ext] = matches[0]
+        elif len(matches) > 1:
+            msg = ('Multiple helper files for %s exist in %s; they need to be '
+                   'distinct by spelling and not just case.') % (shps[0], filename)
+            raise GeoNodeException(msg)
+        elif ext in ('dbf', 'shx'):
+            msg = ('Expected helper file %s does not exist in %s; a Shapefile '
+                   'requires helper files with the extensions dbf and shx') % (
+                   base_name + '.' + ext, filename)
+            raise GeoNodeException(msg)
+    return files
+
+class _ZipMember(object):
+    """A member of a zip archive, decompressed as it is read, with the
+       length httplib needs to send it as a request body.
+    """
+    def __init__(self, filename, member):
+        self._zipfile = zipfile.ZipFile(filename)
+        self._length = self._zipfile.getinfo(member).file_size
+        self._file = self._zipfile.open(member)
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def close(self):
+        self._zipfile.close()
+
+def _repack_zip(archive, names):
+    """Copies members of a zip archive to a new temporary one under new
+       names, given as a dictionary of new names by member name, and
+       returns the new archive's filename.  The compressed data of each
+       member is copied as it is, in chunks, so nothing is decompressed or
+       read into memory whole.
+    """
+    fd, path = tempfile.mkstemp(suffix='.zip')
+    os.close(fd)
+    source = zipfile.ZipFile(archive)
+    src = open(archive, 'rb')
+    try:
+        out = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            for member, arcname in names.items():
+                info = source.getinfo(member)
+                # skip the local header, which may differ from the central
+                # directory entry in its extra field
+                src.seek(info.header_offset)
+                name_length, extra_length = struct.unpack('<HH', src.read(30)[26:30])
+                src.seek(name_length + extra_length, 1)
+
+                zinfo = zipfile.ZipInfo(arcname, info.date_time)
+                zinfo.compress_type = info.compress_type
+                # the sizes go in the header rather than after the data
+                zinfo.flag_bits = info.flag_bits & ~0x808
+                zinfo.external_attr = info.external_attr
+                zinfo.CRC = info.CRC
+                zinfo.compress_size = info.compress_size
+                zinfo.file_size = info.file_size
+                zinfo.header_offset = out.fp.tell()
+                out.fp.write(zinfo.FileHeader())
+                remaining = info.compress_size
+                while remaining > 0:
+                    chunk = src.read(min(remaining, 64 * 1024))
+                    if not chunk:
+                        raise zipfile.BadZipfile('%s is truncated' % archive)
+                    out.fp.write(chunk)
+                    remaining -= len(chunk)
+                # for ZipFile.close() to write the central directory
+                out.filelist.append(zinfo)
+                out.NameToInfo[arcname] = zinfo
+                out._didModify = True
+        finally:
+            out.close()
+    except:
+        os.remove(path)
+        raise
+    finally:
+        src.close()
+        source.close()
+    return path
+
+def get_valid_name(layer_name, reserved=()):
+    """Create a brand new name, which is also not one of the reserved names
     """
     xml_unsafe = re.compile(r"(^[^a-zA-Z\._]+)|([^a-zA-Z\._0-9]+)")
     name = xml_unsafe.sub("_", layer_name)
     proposed_name = name
     count = 1
-    while Layer.objects.filter(name=proposed_name).count() > 0:
+    while proposed_name in reserved or Layer.objects.filter(name=proposed_name).count() > 0:
         proposed_name = "%s_%d" % (name, count)
         count = count + 1
         logger.info("Requested name already used; adjusting name [%s] => [%s]", layer_name, proposed_name)
@@ -173,9 +306,8 @@ def cleanup(name, uuid):
    if csw_record is not None:
        logger.warning("Deleting dangling GeoNetwork record for [%s] (no Django record to match)", name)
        try:
-           # this is a bit hacky, delete_layer expects an instance of the layer
-           # model but it just passes it to a Django template so a dict works too.
-           gn.delete_layer({ "uuid": uuid }) 
+           if not gn.delete_record(uuid):
+               logger.error("Couldn't delete GeoNetwork record during cleanup()")
        except:
            logger.exception("Couldn't delete GeoNetwork record during cleanup()")
 
@@ -277,6 +409,36 @@ def save(layer, base_file, user, overwrite = True, title=None, abstract=None, pe
         data = main_file
     # ------------------
 
+    # Zipped data is sent without being extracted to disk: a zipped
+    # Shapefile is what GeoServer takes anyway, and a zipped GeoTIFF is
+    # decompressed as it is sent.
+    members = {}
+    linkdir = None
+    if os.path.splitext(base_file)[1].lower() == '.zip':
+        members = get_zip_members(base_file)
+        if 'shp' in members:
+            zf = zipfile.ZipFile(base_file)
+            try:
+                names = [n for n in zf.namelist() if not n.endswith('/')]
+                # GeoServer names the feature type after the .shp, and looks
+                # for its files at the root of the archive
+                if set(names) == set(members.values()) and \
+                        [n for n in names if os.path.splitext(n)[0] == name] == names:
+                    # gsconfig deletes the archive it sends, so give it a link
+                    linkdir = tempfile.mkdtemp()
+                    data = os.path.join(linkdir, os.path.basename(base_file))
+                    try:
+                        os.link(base_file, data)
+                    except (AttributeError, OSError):
+                        shutil.copyfile(base_file, data)
+                else:
+                    data = _repack_zip(base_file, dict((member, '%s.%s' % (name, ext))
+                        for ext, member in members.items() if ext != 'sld'))
+            finally:
+                zf.close()
+        else:
+            data = _ZipMember(base_file, members['tif'])
+
     try:
         store, gs_resource = create_store_and_resource(name, data, overwrite=overwrite)
     except geoserver.catalog.UploadError, e:
@@ -294,6 +456,11 @@ def save(layer, base_file, user, overwrite = True, title=None, abstract=None, pe
         raise
     else:
         logger.debug("Finished upload of [%s] to GeoServer without errors.", name)
+    finally:
+        if isinstance(data, _ZipMember):
+            data.close()
+        if linkdir is not None:
+            shutil.rmtree(linkdir)
 
 
     # Step 5. Create the resource in GeoServer
@@ -338,6 +505,12 @@ def save(layer, base_file, user, overwrite = True, title=None, abstract=None, pe
         f = open(files['sld'], 'r')
         sld = f.read()
         f.close()
+    elif 'sld' in members:
+        zf = zipfile.ZipFile(base_file)
+        try:
+            sld = zf.read(members['sld'])
+        finally:
+            zf.close()
     else:
         sld = get_sld_for(publishing)
 
@@ -374,6 +547,9 @@ def save(layer, base_file, user, overwrite = True, title=None, abstract=None, pe
 
     if created:
         saved_layer.set_default_permissions()
+    else:
+        # the new data may cover a different area than the old one
+        saved_layer.update_latlon_bbox(gs_resource.latlon_bbox)
 
     # Step 9. Create the points of contact records for the layer
     # A user without a profile might be uploading this
@@ -480,9 +656,13 @@ def check_geonode_is_up():
                 "Please make sure you have started GeoNetwork." % settings.GEONETWORK_BASE_URL)
         raise GeoNodeException(msg)
 
-def file_upload(filename, user=None, title=None, overwrite=True, keywords = []):
+def _name_for_title(title):
+    return slugify(title).replace('-','_')
+
+def file_upload(filename, user=None, title=None, overwrite=True, keywords = [], name=None):
     """Saves a layer in GeoNode asking as little information as possible.
-       Only filename is required, user and title are optional.
+       Only filename is required, user and title are optional.  The layer
+       name is made from the title unless name is given.
     """
     # Do not do attemt to do anything unless geonode is running
     check_geonode_is_up()
@@ -496,7 +676,8 @@ def file_upload(filename, user=None, title=None, overwrite=True, keywords = []):
         title = basename.title().replace('_', ' ')
 
     # ... and use a url friendly version of that title for the name
-    name = slugify(title).replace('-','_')
+    if name is None:
+        name = _name_for_title(title)
 
     # Note that this will replace any existing layer that has the same name
     # with the data that is being passed.
@@ -511,13 +692,184 @@ def file_upload(filename, user=None, title=None, overwrite=True, keywords = []):
     return new_layer
 
 
-def upload(incoming, user=None, overwrite=True, keywords = []):
+def _data_files(filename):
+    """The files making up the data in filename, its own and its helpers.
+    """
+    try:
+        return sorted(get_files(filename).values())
+    except GeoNodeException:
+        return [filename]
+
+def _upload_file(filename, user, overwrite, keywords, name=None, manifest=None):
+    """Uploads one file of a directory for upload(), returning its report.
+    """
+    basename, extension = os.path.splitext(os.path.basename(filename))
+    try:
+        layer = file_upload(filename,
+                            user=user,
+                            title=basename,
+                            overwrite=overwrite,
+                            keywords=keywords,
+                            name=name
+                           )
+    except GeoNodeException, e:
+        msg = '[%s] could not be uploaded. Error was: %s' % (filename, str(e))
+        logger.info(msg)
+        return {'file': filename, 'errors': msg}
+    else:
+        if manifest is not None:
+            manifest.record(filename, _data_files(filename), layer)
+        return {'file': filename, 'name': layer.name}
+
+def _plan_names(filenames, overwrite, known=None):
+    """Picks the layer name of each file for a parallel upload, so that
+       files being uploaded at the same time never pick the same new name.
+       Files in the known dict keep the layer name given there.
+       Returns a list of groups of indexes into filenames: files that would
+       be saved as the same layer are in one group, in the order given,
+       and are uploaded one after the other.  Also returns the names.
+    """
+    if known is None:
+        known = {}
+    names = []
+    groups = {}
+    order = []
+    for i, filename in enumerate(filenames):
+        basename, extension = os.path.splitext(os.path.basename(filename))
+        name = _name_for_title(basename)
+        if filename in known:
+            name = known[filename]
+        elif not overwrite:
+            name = get_valid_name(name, reserved=set(names) | set(known.values()))
+        names.append(name)
+        if name not in groups:
+            groups[name] = []
+            order.append(name)
+        groups[name].append(i)
+    return [groups[name] for name in order], names
+
+def _upload_parallel(filenames, user, overwrite, keywords, workers, timeout, callback, batch,
+                     known=None, manifest=None):
+    """Uploads filenames with a pool of worker threads for upload().
+    """
+    if known is None:
+        known = {}
+    groups, names = _plan_names(filenames, overwrite, known)
+    group_of = {}
+    pending = Queue()
+    for group in groups:
+        pending.put(group)
+        for i in group:
+            group_of[i] = group
+    events = Queue()
+    cancelled = threading.Event()
+    results = [None] * len(filenames)
+
+    def failed(i, reason):
+        results[i] = {'file': filenames[i], 'errors': '[%s] %s' % (filenames[i], reason)}
+
+    def work():
+        batch.attach()
+        try:
+            while not cancelled.isSet():
+                try:
+                    group = pending.get_nowait()
+                except Empty:
+                    return
+                for i in group:
+                    # skip the files that have already been given up on
+                    if cancelled.isSet() or results[i] is not None:
+                        continue
+                    events.put((i, 'started', time.time()))
+                    try:
+                        result = _upload_file(filenames[i], user, overwrite or filenames[i] in known,
+                                              keywords, names[i], manifest)
+                    except Exception, e:
+                        logger.exception('Uploading [%s] failed', filenames[i])
+                        result = {'file': filenames[i],
+                                  'errors': '[%s] could not be uploaded. Error was: %s' % (filenames[i], str(e))}
+                    events.put((i, 'finished', result))
+        finally:
+            batch.detach()
+            connection.close()
+
+    threads = []
+    def start_worker():
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for n in range(min(workers, len(groups))):
+        start_worker()
+
+    started = {}
+    reported = 0
+    while reported < len(filenames):
+        try:
+            # poll, so that an interrupt is noticed while waiting
+            i, event, value = events.get(True, 1)
+        except Empty:
+            pass
+        except KeyboardInterrupt:
+            if cancelled.isSet():
+                # interrupted again, so stop waiting for them too
+                for i in started:
+                    if results[i] is None:
+                        failed(i, 'was still uploading when the upload was cancelled')
+            logger.info('Upload cancelled; waiting for the files being uploaded to finish')
+            cancelled.set()
+        else:
+            if event == 'started':
+                started[i] = value
+            elif results[i] is None:
+                results[i] = value
+
+        if timeout is not None:
+            now = time.time()
+            for i, began in started.items():
+                if results[i] is None and now - began > timeout:
+                    failed(i, 'did not finish uploading within %d seconds' % timeout)
+                    # the thread can't be stopped, so give up on the rest of
+                    # its files and carry on without it
+                    for j in group_of[i]:
+                        if results[j] is None and j not in started:
+                            failed(j, 'was not uploaded, as an earlier file for layer %s timed out' % names[j])
+                    start_worker()
+
+        if cancelled.isSet():
+            running = [i for i in started if results[i] is None]
+            for i in range(len(filenames)):
+                if results[i] is None and (i not in started or not running):
+                    failed(i, 'was not uploaded, as the upload was cancelled')
+
+        # report in the order of the files
+        while reported < len(filenames) and results[reported] is not None:
+            if callback is not None:
+                callback(results[reported])
+            reported += 1
+    return results
+
+def upload(incoming, user=None, overwrite=True, keywords = [], workers=1, timeout=None, callback=None,
+           manifest=None):
     """Upload a directory of spatial data files to GeoNode and verifies each layer is in GeoServer.
 
-       Supported extensions are: .shp, .tif, and .zip (of a shapfile).
+       Supported extensions are: .shp, .tif, and .zip (of a Shapefile or GeoTIFF).
        It catches GeoNodeExceptions and gives a report per file
        >>> batch_upload('/tmp/mydata')
            [{'file': 'data1.tiff', 'name': 'geonode:data1' }, {'file': 'data2.shp', 'errors': 'Shapefile requires .prj file'}]
+
+       With more than one worker, that many files are uploaded at the same
+       time by a pool of threads.  A file still uploading after timeout
+       seconds is reported as failed and no longer waited for, and an
+       interrupt (Ctrl-C) stops new files from being started.  The reports
+       come in the order the files were found, and are also passed to
+       callback as soon as they are ready.
+
+       If manifest, a geonode.maps.manifest.ImportManifest, is given, files
+       it records as imported and unchanged since are skipped, with
+       'unchanged' in their report, and changed files replace the layer
+       they were imported as.  Those are reported first.
     """
     check_geonode_is_up()
 
@@ -531,28 +883,74 @@ def upload(incoming, user=None, overwrite=True, keywords = []):
         raise GeoNodeException(msg)
     else:
         datadir = incoming
-        results = []
-
+        filenames = []
         for root, dirs, files in os.walk(datadir):
             for short_filename in files:
                 basename, extension = os.path.splitext(short_filename)
-                filename = os.path.join(root, short_filename)
                 if extension in ['.tif', '.shp', '.zip']:
-                    try:
-                        layer = file_upload(filename,
-                                            user=user,
-                                            title=basename,
-                                            overwrite=overwrite,
-                                            keywords=keywords
-                                           )
-
-                    except GeoNodeException, e:
-                        msg = '[%s] could not be uploaded. Error was: %s' % (filename, str(e))
-                        logger.info(msg)
-                        results.append({'file': filename, 'errors': msg})
-                    else:
-                        results.append({'file': filename, 'name': layer.name})
-        return results
+                    filenames.append(os.path.join(root, short_filename))
+
+        try:
+            # the layers' GeoNetwork records are written together at the end
+            with GeoNetworkBatch() as batch:
+                reports = {}
+                known = {}
+                if manifest is not None:
+                    pending = []
+                    for filename in filenames:
+                        state = manifest.check(filename, _data_files(filename))
+                        if state != manifest.NEW:
+                            # the layer may have been deleted since, and its
+                            # name given to another one
+                            try:
+                                layer = Layer.objects.get(uuid=manifest.entry(filename)['uuid'])
+                            except Layer.DoesNotExist:
+                                # so import it as a new layer
+                                pass
+                            else:
+                                if state == manifest.CHANGED:
+                                    known[filename] = layer.name
+                                else:
+                                    if state == manifest.INCOMPLETE:
+                                        # interrupted before its metadata was written
+                                        layer.save_to_geonetwork()
+                                    reports[filename] = {'file': filename, 'name': layer.name,
+                                                         'unchanged': True}
+                                    if callback is not None:
+                                        callback(reports[filename])
+                                    continue
+                        pending.append(filename)
+                else:
+                    pending = filenames
+
+                if workers > 1:
+                    results = _upload_parallel(pending, user, overwrite, keywords,
+                                               workers, timeout, callback, batch, known, manifest)
+                else:
+                    results = []
+                    for filename in pending:
+                        results.append(_upload_file(filename, user, overwrite or filename in known,
+                                                    keywords, known.get(filename), manifest))
+                        if callback is not None:
+                            callback(results[-1])
+                for result in results:
+                    reports[result['file']] = result
+                results = [reports[filename] for filename in filenames]
+
+            failed = dict((layer.name, error) for action, layer, error in batch.results
+                          if error is not None)
+            for result in results:
+                if result.get('name') in failed:
+                    result['errors'] = ('[%s] could not be saved to GeoNetwork. Error was: %s'
+                                        % (result['file'], failed[result['name']]))
+            if manifest is not None:
+                manifest.complete(r['file'] for r in results if 'errors' not in r)
+            return results
+        finally:
+            # keep what was recorded even if the import is interrupted, so
+            # a run resumes instead of importing those files again
+            if manifest is not None:
+                manifest.save()
 
 
 def _create_db_featurestore(name, data, overwrite = False, charset = None):
@@ -1,10 +1,14 @@
 from geonode.core.models import AUTHENTICATED_USERS, ANONYMOUS_USERS
-from geonode.maps.models import Map, Layer, MapLayer, Contact, ContactRole,Role, get_csw
+from geonode.maps.models import Map, Layer, MapLayer, Contact, ContactRole,Role, get_csw, GeoNetworkBatch
+from geonode.maps import cswsearch, cswserver
+from geonode.maps.search import extent_index, text_index, map_text_index, facet_index, search_cache
 from geonode.maps.gs_helpers import fixup_style, cascading_delete, delete_from_postgis
 from geonode import geonetwork
 import geoserver
 from geoserver.resource import FeatureType, Coverage
 import base64
+import copy
+from datetime import datetime
 from django import forms
 from django.contrib.auth import authenticate, get_backends as get_auth_backends
 from django.contrib.auth.decorators import login_required
@@ -21,11 +25,11 @@ from django.utils.translation import ugettext as _
 import json
 import math
 import httplib2 
-from owslib.csw import CswRecord, namespaces
+from owslib.csw import namespaces
 from owslib.util import nspath
 import re
 from urllib import urlencode
-from urlparse import urlparse
+from urlparse import urlparse, parse_qsl
 import uuid
 import unicodedata
 from django.views.decorators.csrf import csrf_exempt, csrf_response_exempt
@@ -97,7 +101,8 @@ class LayerForm(forms.ModelForm):
 
     class Meta:
         model = Layer
-        exclude = ('contacts','workspace', 'store', 'name', 'uuid', 'storeType', 'typename')
+        exclude = ('contacts','workspace', 'store', 'name', 'uuid', 'storeType', 'typename',
+                   'bbox_x0', 'bbox_x1', 'bbox_y0', 'bbox_y1', 'metadata_digest')
 
 class RoleForm(forms.ModelForm):
     class Meta:
@@ -190,6 +195,42 @@ def mapJSON(request, mapid):
                 status=400
             )
 
+def _objects_with_perm(user, perm, ModelType, object_ids=None):
+    """
+    Bulk version of user.has_perm(perm, obj=...): returns the set of ids of
+    ModelType instances (optionally restricted to object_ids) that the user
+    has the permission for, using a fixed number of queries.
+    """
+    if not user.is_anonymous() and not user.is_active:
+        return set()
+    if user.is_superuser:
+        if object_ids is not None:
+            return set(object_ids)
+        return set(ModelType.objects.values_list('id', flat=True))
+
+    ids = set()
+    for bck in get_auth_backends():
+        if hasattr(bck, 'objects_with_perm'):
+            ids.update(bck.objects_with_perm(user, perm, ModelType, object_ids))
+    return ids
+
+def _objects_with_perms(user, perms, ModelType, object_ids):
+    """
+    Like _objects_with_perm for several permissions at once, returning a dict
+    from each permission name to the set of ids it is granted for.
+    """
+    if not user.is_anonymous() and not user.is_active:
+        return dict((perm, set()) for perm in perms)
+    if user.is_superuser:
+        return dict((perm, set(object_ids)) for perm in perms)
+
+    result = dict((perm, set()) for perm in perms)
+    for bck in get_auth_backends():
+        if hasattr(bck, 'objects_with_perms'):
+            for perm, ids in bck.objects_with_perms(user, perms, ModelType, object_ids).iteritems():
+                result[perm].update(ids)
+    return result
+
 def newmap_config(request):
     '''
     View that creates a new map.  
@@ -224,30 +265,21 @@ def newmap_config(request):
             return HttpResponse(status=405)
         
         if 'layer' in params:
-            bbox = None
             map = Map(projection="EPSG:900913")
+            layer_names = params.getlist('layer')
+            found = dict((l.typename, l) for l in
+                         Layer.objects.filter(typename__in=layer_names))
+            viewable = _objects_with_perm(request.user, 'maps.view_layer',
+                                          Layer, [l.id for l in found.values()])
             layers = []
-            for layer_name in params.getlist('layer'):
-                try:
-                    layer = Layer.objects.get(typename=layer_name)
-                except ObjectDoesNotExist:
-                    # bad layer, skip 
+            bboxes = []
+            for layer_name in layer_names:
+                layer = found.get(layer_name)
+                if layer is None or layer.id not in viewable:
+                    # bad or invisible layer, skip inclusion
                     continue
 
-                if not request.user.has_perm('maps.view_layer', obj=layer):
-                    # invisible layer, skip inclusion
-                    continue
-                    
-                layer_bbox = layer.resource.latlon_bbox
-                # assert False, str(layer_bbox)
-                if bbox is None:
-                    bbox = list(layer_bbox[0:4])
-                else:
-                    bbox[0] = min(bbox[0], layer_bbox[0])
-                    bbox[1] = max(bbox[1], layer_bbox[1])
-                    bbox[2] = min(bbox[2], layer_bbox[2])
-                    bbox[3] = max(bbox[3], layer_bbox[3])
-                
+                bboxes.append(layer.geographic_bbox())
                 layers.append(MapLayer(
                     map = map,
                     name = layer.typename,
@@ -255,8 +287,9 @@ def newmap_config(request):
                     visibility = True
                 ))
 
-            if bbox is not None:
-                minx, maxx, miny, maxy = [float(c) for c in bbox]
+            if bboxes:
+                x0s, x1s, y0s, y1s = zip(*bboxes)
+                minx, maxx, miny, maxy = min(x0s), max(x1s), min(y0s), max(y1s)
                 x = (minx + maxx) / 2
                 y = (miny + maxy) / 2
                 wkt = "POINT(" + str(x) + " " + str(y) + ")"
@@ -1144,6 +1177,15 @@ def _split_query(query):
 
 DEFAULT_SEARCH_BATCH_SIZE = 10
 MAX_SEARCH_BATCH_SIZE = 25
+DEFAULT_FACET_LIMIT = 10
+
+# the fields of search results in each element set, None meaning all
+_RESULT_FIELDS = {
+    'brief': ('uuid', 'name', 'title', 'detail', 'bbox'),
+    'summary': ('uuid', 'name', 'title', 'abstract', 'keywords', 'detail', 'bbox'),
+    'full': None
+}
+
 @csrf_exempt
 def metadata_search(request):
     """
@@ -1154,6 +1196,19 @@ def metadata_search(request):
     q - general query for keywords across all fields
     start - skip to this point in the results
     limit - max records to return
+    bbox - minx,miny,maxx,maxy lat/lon extent results must intersect
+    scope - 'local' to search only layers hosted by this GeoNode, or
+            'catalog' to search all records in GeoNetwork.  By default
+            the local layers are listed first, followed by the records
+            the catalog harvested from elsewhere if it harvests any (see
+            SEARCH_HARVESTED_RECORDS).
+    keyword, topic_category, date, storeType, owner - a facet value
+            (see search_facets) results must have.  Facets only apply
+            to local searches; giving one implies scope=local.
+    esn - 'full' (the default) for complete results, or 'summary' or 
+          'brief' for just the fields needed to list them (see 
+          _RESULT_FIELDS).  Full results can then be fetched with 
+          search_records.
 
     for ajax requests, the search returns a json structure 
     like this: 
@@ -1223,69 +1278,327 @@ def metadata_search(request):
             # ignore...
             pass
 
-    result = _metadata_search(query, start, limit, **advanced)
+    scope = params.get('scope', None)
+    if scope in ('local', 'catalog'):
+        advanced['scope'] = scope
+
+    facets = _facet_filters(params)
+    if facets:
+        advanced['facets'] = facets
 
-    # XXX slowdown here to dig out result permissions
+    esn = params.get('esn', 'full')
+    if esn in _RESULT_FIELDS:
+        advanced['esn'] = esn
+    else:
+        esn = 'full'
+
+    # results are cached before the user specific parts are added below,
+    # and copied since those are added in place
+    cache_key = (tuple(sorted(set(kw.lower() for kw in _split_query(query)))),
+                 tuple(advanced.get('bbox', ())), scope, start, limit,
+                 tuple(sorted(facets.items())), esn)
+    result = search_cache.get(cache_key)
+    if result is None:
+        result = _metadata_search(query, start, limit, **advanced)
+        search_cache.put(cache_key, result)
+    result = copy.deepcopy(result)
+    _set_result_query(result, query)
+
+    # dig out result permissions for the whole page at once
+    layer_ids = {}
+    typenames = {}
+    for uuid, layer_id, typename in Layer.objects.filter(
+            uuid__in=[doc['uuid'] for doc in result['rows']]).values_list('uuid', 'id', 'typename'):
+        layer_ids[uuid] = layer_id
+        typenames[uuid] = typename
+    perms = _objects_with_perms(request.user, ['maps.view_layer', 'maps.change_layer',
+                                               'maps.delete_layer', 'maps.change_layer_permissions'],
+                                Layer, layer_ids.values())
     for doc in result['rows']: 
-        try: 
-            layer = Layer.objects.get(uuid=doc['uuid'])
+        layer_id = layer_ids.get(doc['uuid'])
+        if layer_id is not None:
+            if not doc.get('detail'):
+                # brief catalog records carry no links
+                doc['name'] = typenames[doc['uuid']]
+                doc['detail'] = settings.SITEURL[:-1] + Layer(typename=doc['name']).get_absolute_url()
             doc['_local'] = True
             doc['_permissions'] = {
-                'view': request.user.has_perm('maps.view_layer', obj=layer),
-                'change': request.user.has_perm('maps.change_layer', obj=layer),
-                'delete': request.user.has_perm('maps.delete_layer', obj=layer),
-                'change_permissions': request.user.has_perm('maps.change_layer_permissions', obj=layer),
+                'view': layer_id in perms['maps.view_layer'],
+                'change': layer_id in perms['maps.change_layer'],
+                'delete': layer_id in perms['maps.delete_layer'],
+                'change_permissions': layer_id in perms['maps.change_layer_permissions'],
             }
-        except Layer.DoesNotExist:
+        else:
             doc['_local'] = False
-            pass
 
     result['success'] = True
     return HttpResponse(json.dumps(result), mimetype="application/json")
 
 def _metadata_search(query, start, limit, **kw):
-    
-    csw = get_csw()
+    """
+    Searches the local layer index, and GeoNetwork only for the records it
+    harvested from elsewhere, unless the catalog scope asks for all of its
+    records.
+    """
+    scope = kw.pop('scope', None)
+    if kw.get('facets'):
+        scope = 'local'
+    if scope == 'catalog':
+        return _csw_metadata_search(query, start, limit, **kw)
+    elif scope is None and getattr(settings, 'SEARCH_HARVESTED_RECORDS', False):
+        return _combined_metadata_search(query, start, limit, **kw)
+    else:
+        return _local_metadata_search(query, start, limit, **kw)
 
-    keywords = _split_query(query)
+def _set_result_query(result, query):
+    """
+    Puts the query text of this request in a search result, which may have
+    been cached for a request with the same keywords written differently.
+    """
+    if 'query_info' in result:
+        result['query_info']['q'] = query
+    for link in ('prev', 'next'):
+        if link in result:
+            path, params = result[link].split('?', 1)
+            params = [(k, k == 'q' and query or v) for k, v in parse_qsl(params, True)]
+            result[link] = path + '?' + urlencode(params)
+
+def _csw_metadata_search(query, start, limit, **kw):
     
-    csw.getrecords(keywords=keywords, startposition=start+1, maxrecords=limit, bbox=kw.get('bbox', None))
+    keywords = _split_query(query)
     
+    esn = kw.get('esn', 'full')
+    results = cswsearch.search(keywords=keywords, startposition=start+1,
+                               maxrecords=limit, bbox=kw.get('bbox', None), esn=esn)
+
+    result = {'rows': [_result_fields(row, esn) for row in results['rows']], 
+              'total': results['matches']}
+
+    result['query_info'] = {
+        'start': start,
+        'limit': limit,
+        'q': query
+    }
+    next = results['nextrecord']
+    _set_page_links(result, query, start, limit, next > 0 and next - 1 or None,
+                    scope='catalog', **kw)
     
-    # build results 
-    # XXX this goes directly to the result xml doc to obtain 
-    # correct ordering and a fuller view of the result record
-    # than owslib currently parses.  This could be improved by
-    # improving owslib.
-    results = [_build_search_result(doc) for doc in 
-               csw._exml.findall('//'+nspath('Record', namespaces['csw']))]
+    return result
+
+def _set_page_links(result, query, start, limit, next_start, scope=None, **kw):
+    """
+    Adds the prev and next links of a page of search results, repeating
+    all the search parameters.  next_start is None on the last page.
+    """
+    params = {'q': query, 'limit': limit}
+    if scope is not None:
+        params['scope'] = scope
+    if kw.get('esn', 'full') != 'full':
+        params['esn'] = kw['esn']
+    if kw.get('bbox') is not None:
+        params['bbox'] = ','.join(str(c) for c in kw['bbox'])
+    params.update(kw.get('facets') or {})
+    if start > 0:
+        params['start'] = max(start - limit, 0)
+        result['prev'] = reverse('geonode.maps.views.metadata_search') + '?' + urlencode(params)
+    if next_start is not None:
+        params['start'] = next_start
+        result['next'] = reverse('geonode.maps.views.metadata_search') + '?' + urlencode(params)
+
+def _local_search_ids(query, bbox=None, facets=None):
+    """
+    Finds the local layers matching query, whose extent intersects bbox and
+    which have the values in the facets dict.  Returns a tuple of the
+    matching layer ids, best first, and the extent index stats if bbox was
+    given.
+    """
+    ids = text_index.search(_split_query(query))
+
+    index_info = None
+    if bbox is not None:
+        matches, index_info = extent_index.intersects(bbox)
+        ids = [i for i in ids if i in matches]
+
+    if facets:
+        ids = facet_index.filter(ids, facets)
+
+    return ids, index_info
+
+def _local_metadata_search(query, start, limit, **kw):
+    """
+    Like _csw_metadata_search, but only searches layers in the local
+    database, using the in-process text and extent indexes.  No catalog
+    or GeoServer requests are made for vector layers.
+    """
+    ids, index_info = _local_search_ids(query, kw.get('bbox'), kw.get('facets'))
+
+    page = ids[start:start + limit]
+    layers = Layer.objects.in_bulk(page)
+    results = [_build_layer_result(layers[i], kw.get('esn', 'full')) for i in page if i in layers]
+
+    result = {'rows': results,
+              'total': len(ids)}
+
+    result['query_info'] = {
+        'start': start,
+        'limit': limit,
+        'q': query,
+        'scope': 'local'
+    }
+    if index_info is not None:
+        result['query_info']['spatial_index'] = index_info
 
-    result = {'rows': results, 
-              'total': csw.results['matches']}
+    _set_page_links(result, query, start, limit,
+                    start + limit < len(ids) and start + limit or None, scope='local', **kw)
+
+    return result
+
+def _combined_metadata_search(query, start, limit, **kw):
+    """
+    Lists the local layers matching query from the local indexes, as
+    _local_metadata_search does, followed by the matching records the
+    catalog harvested from elsewhere.  GeoNetwork is only searched for the
+    pages reaching past the local layers, and to count the harvested
+    records, which is done once per query while the search cache keeps it.
+    """
+    esn = kw.get('esn', 'full')
+    keywords = _split_query(query)
+    ids, index_info = _local_search_ids(query, kw.get('bbox'))
+
+    page = ids[start:start + limit]
+    layers = Layer.objects.in_bulk(page)
+    rows = [_build_layer_result(layers[i], esn) for i in page if i in layers]
+
+    count_key = ('harvested', tuple(sorted(set(k.lower() for k in keywords))),
+                 tuple(kw.get('bbox') or ()))
+    harvested = search_cache.get(count_key)
+    if len(page) < limit or harvested is None:
+        results = cswsearch.search(keywords=keywords, startposition=max(start - len(ids), 0) + 1,
+                                   maxrecords=limit - len(page), bbox=kw.get('bbox'), esn=esn,
+                                   harvested=True)
+        rows.extend(_result_fields(row, esn) for row in results['rows'])
+        harvested = results['matches']
+        search_cache.put(count_key, harvested)
+
+    total = len(ids) + harvested
+    result = {'rows': rows,
+              'total': total}
 
     result['query_info'] = {
         'start': start,
         'limit': limit,
         'q': query
     }
-    if start > 0: 
-        prev = max(start - limit, 0)
-        params = urlencode({'q': query, 'start': prev, 'limit': limit})
-        result['prev'] = reverse('geonode.maps.views.metadata_search') + '?' + params
+    if index_info is not None:
+        result['query_info']['spatial_index'] = index_info
+
+    _set_page_links(result, query, start, limit,
+                    start + limit < total and start + limit or None, **kw)
 
-    next = csw.results.get('nextrecord', 0) 
-    if next > 0:
-        params = urlencode({'q': query, 'start': next - 1, 'limit': limit})
-        result['next'] = reverse('geonode.maps.views.metadata_search') + '?' + params
-    
     return result
 
+def _facet_filters(params):
+    return dict((f, params[f]) for f in facet_index.facets if params.get(f))
+
+def search_facets(request):
+    """
+    Counts the local layers matching a search by each value of the keyword,
+    topic_category, date (year), storeType and owner facets, so the results
+    can be narrowed down with the facet parameters of metadata_search.
+
+    accepts the q, bbox and facet parameters of metadata_search, and
+    facet_limit - max values to return per facet (default 10)
+
+    returns a json structure like this:
+
+    {
+    'total': <number of layers matching>,
+    'facets': {
+        'keyword': [[<value>, <count>], ...],
+        'topic_category': [...],
+        ...
+    }}
+    """
+    params = request.GET
+    query = params.get('q', '')
+    bbox = None
+    if params.get('bbox'):
+        try:
+            bbox = [float(x) for x in params['bbox'].split(',')]
+        except ValueError:
+            pass
+        if bbox is not None and len(bbox) != 4:
+            bbox = None
+    try:
+        facet_limit = int(params.get('facet_limit', DEFAULT_FACET_LIMIT))
+    except ValueError:
+        facet_limit = DEFAULT_FACET_LIMIT
+    filters = _facet_filters(params)
+
+    keywords = _split_query(query)
+    cache_key = ('facets', tuple(sorted(set(kw.lower() for kw in keywords))),
+                 tuple(bbox or ()), tuple(sorted(filters.items())), facet_limit)
+    result = search_cache.get(cache_key)
+    if result is None:
+        if keywords or bbox is not None or filters:
+            ids, index_info = _local_search_ids(query, bbox, filters)
+            result = {'total': len(ids),
+                      'facets': facet_index.counts(ids, facet_limit)}
+        else:
+            # use the totals kept by the index
+            result = {'total': Layer.objects.count(),
+                      'facets': facet_index.counts(None, facet_limit)}
+        search_cache.put(cache_key, result)
+
+    result = dict(result, success=True)
+    return HttpResponse(json.dumps(result), mimetype="application/json")
+
+def search_records(request):
+    """
+    returns the full search results (as metadata_search does with 
+    esn=full) for the records whose uuids are given as a comma 
+    separated uuid parameter, at most MAX_SEARCH_BATCH_SIZE of them.
+    Local layers are read from the database and any others are 
+    fetched from the catalog together.
+
+    {
+    'rows': [<result>, ...]
+    }
+    """
+    uuids = []
+    for value in request.GET.getlist('uuid'):
+        uuids.extend(u for u in value.split(',') if u)
+    uuids = uuids[:MAX_SEARCH_BATCH_SIZE]
+
+    rows = {}
+    for layer in Layer.objects.filter(uuid__in=uuids):
+        rows[layer.uuid] = _build_layer_result(layer)
+    remote = [u for u in uuids if u not in rows]
+    if remote:
+        for row in cswsearch.records(remote):
+            rows[row['uuid']] = row
+
+    result = {
+        'rows': [rows[u] for u in uuids if u in rows],
+        'success': True
+    }
+    return HttpResponse(json.dumps(result), mimetype="application/json")
+
+@csrf_exempt
+def csw(request):
+    """
+    a read-only CSW 2.0.2 service for the local layers that the user 
+    may view, answered from the database rather than GeoNetwork.  
+    see geonode.maps.cswserver
+    """
+    return cswserver.handle(request, _objects_with_perm(request.user, 'maps.view_layer', Layer))
+
 def search_result_detail(request):
     uuid = request.GET.get("uuid")
-    csw = get_csw()
-    csw.getrecordbyid([uuid], outputschema=namespaces['gmd'])
-    rec = csw.records.values()[0]
-    raw_xml = csw._exml.find(nspath('MD_Metadata', namespaces['gmd']))
+    record = cswsearch.metadata_cache.get(uuid)
+    if record is None:
+        return HttpResponse(status=404)
+    rec, raw_xml = record
     extra_links = _extract_links(rec, raw_xml)
     
     try:
@@ -1340,75 +1653,40 @@ def _extract_links(rec, xml):
             download=download_links
         )
 
+def _result_fields(result, esn):
+    """
+    reduces a search result to the fields of the element set esn.
+    """
+    fields = _RESULT_FIELDS[esn]
+    if fields is None:
+        return result
+    return dict((f, result[f]) for f in fields if f in result)
 
-def _build_search_result(doc):
+def _build_layer_result(layer, esn='full'):
     """
-    accepts a node representing a csw result 
-    record and builds a POD structure representing 
-    the search result.
+    builds the same structure as cswsearch.build_search_result
+    for a local layer, from the database rather than
+    its catalog record.
     """
-    if doc is None:
-        return None
-    # Let owslib do some parsing for us...
-    rec = CswRecord(doc)
     result = {}
-    result['title'] = rec.title
-    result['uuid'] = rec.identifier
-    result['abstract'] = rec.abstract
-    result['keywords'] = [x for x in rec.subjects if x]
-    result['detail'] = rec.uri or ''
-
-    # XXX needs indexing ? how
+    result['title'] = layer.title
+    result['uuid'] = layer.uuid
+    result['abstract'] = layer.abstract
+    result['keywords'] = layer.keyword_list()
+    result['detail'] = settings.SITEURL[:-1] + layer.get_absolute_url()
     result['attribution'] = {'title': '', 'href': ''}
-
-    # XXX !_! pull out geonode 'typename' if there is one
-    # index this directly... 
-    if rec.uri:
-        try:
-            result['name'] = urlparse(rec.uri).path.split('/')[-1]
-        except: 
-            pass
-    # fallback: use geonetwork uuid
-    if not result.get('name', ''):
-        result['name'] = rec.identifier
-
-    # Take BBOX from GeoNetwork Result...
-    # XXX this assumes all our bboxes are in this 
-    # improperly specified SRS.
-    if rec.bbox is not None and rec.bbox.crs == 'urn:ogc:def:crs:::WGS 1984':
-        # slight workaround for ticket 530
+    result['name'] = layer.typename
+    if layer.bbox_x0 is not None:
         result['bbox'] = {
-            'minx': min(rec.bbox.minx, rec.bbox.maxx),
-            'maxx': max(rec.bbox.minx, rec.bbox.maxx),
-            'miny': min(rec.bbox.miny, rec.bbox.maxy),
-            'maxy': max(rec.bbox.miny, rec.bbox.maxy)
+            'minx': layer.bbox_x0,
+            'maxx': layer.bbox_x1,
+            'miny': layer.bbox_y0,
+            'maxy': layer.bbox_y1
         }
-    
-    # XXX these could be exposed in owslib record...
-    # locate all download links
-    format_re = re.compile(".*\((.*)(\s*Format*\s*)\).*?")
-    result['download_links'] = []
-    for link_el in doc.findall(nspath('URI', namespaces['dc'])):
-        if link_el.get('protocol', '') == 'WWW:DOWNLOAD-1.0-http--download':
-            try:
-                extension = link_el.get('name', '').split('.')[-1]
-                format = format_re.match(link_el.get('description')).groups()[0]
-                href = link_el.text
-                result['download_links'].append((extension, format, href))
-            except: 
-                pass
-
-    # construct the link to the geonetwork metadata record (not self-indexed)
-    md_link = settings.GEONETWORK_BASE_URL + "srv/en/csw?" + urlencode({
-            "request": "GetRecordById",
-            "service": "CSW",
-            "version": "2.0.2",
-            "OutputSchema": "http://www.isotc211.org/2005/gmd",
-            "ElementSetName": "full",
-            "id": rec.identifier
-        })
-    result['metadata_links'] = [("text/xml", "TC211", md_link)]
-
+    if esn != 'full':
+        return _result_fields(result, esn)
+    result['download_links'] = layer.download_links()
+    result['metadata_links'] = [("text/xml", "TC211", cswsearch.metadata_link(layer.uuid))]
     return result
 
 def browse_data(request):
@@ -1469,6 +1747,8 @@ def maps_search(request):
     limit - max records to return
     sort - field to sort results on
     dir - ASC or DESC, for ascending or descending order
+    after - a cursor from 'next_after' of the previous batch; 
+            when given the batch is found from it rather than start
 
     for ajax requests, the search returns a json structure 
     like this: 
@@ -1476,6 +1756,7 @@ def maps_search(request):
     {
     'total': <total result count>,
     'next': <url for next batch if exists>,
+    'next_after': <cursor for the next batch if exists>,
     'prev': <url for previous batch if exists>,
     'query_info': {
         'start': <integer indicating where this batch starts>,
@@ -1518,31 +1799,106 @@ def maps_search(request):
     sort_field = params.get('sort', u'')
     sort_field = unicodedata.normalize('NFKD', sort_field).encode('ascii','ignore')  
     sort_dir = params.get('dir', 'ASC')
-    result = _maps_search(query, start, limit, sort_field, sort_dir)
+    after = params.get('after')
+    result = _maps_search(query, start, limit, sort_field, sort_dir, after)
 
     result['success'] = True
     return HttpResponse(json.dumps(result), mimetype="application/json")
 
-def _maps_search(query, start, limit, sort_field, sort_dir):
+# fields maps may be sorted on, mapped to the Map field holding the value
+_MAPS_SORT_FIELDS = {
+    'title': 'title',
+    'abstract': 'abstract',
+    'last_modified': 'last_modified',
+    'id': 'id'
+}
+
+# the owner's contact name, looked up in the same query as the maps
+_MAPS_OWNER_NAME_SQL = "SELECT MIN(c.name) FROM %(contact)s c WHERE c.user_id = %(map)s.owner_id"
+
+def _encode_maps_cursor(map, sort_field):
+    value = getattr(map, sort_field)
+    if isinstance(value, datetime):
+        value = str(value)
+    return base64.urlsafe_b64encode(json.dumps([value, map.id]))
+
+def _decode_maps_cursor(cursor):
+    """
+    Returns the (sort value, map id) pair encoded in an "after" cursor, or
+    None if it isn't a valid cursor.
+    """
+    try:
+        value, map_id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return value, int(map_id)
+    except (TypeError, ValueError):
+        return None
 
+def _maps_search(query, start, limit, sort_field, sort_dir, after=None):
+    """
+    Searches maps by title, abstract and the titles of their layers, ranking
+    the results by relevance unless a sort field is given.  Pages are
+    selected with start, an offset into the results, unless after is given;
+    it is a cursor taken from a previous result ('next_after') and selects
+    the maps following the last one of that page in the same order, which
+    unlike an offset doesn't get slower on later pages.
+    """
     keywords = _split_query(query)
 
-    maps = Map.objects
-    for keyword in keywords:
-        maps = maps.filter(
-              Q(title__icontains=keyword)
-            | Q(abstract__icontains=keyword))
+    sort_field = _MAPS_SORT_FIELDS.get(sort_field)
+    descending = sort_dir == "DESC"
+    position = after and _decode_maps_cursor(after) or None
 
-    if sort_field:
-        order_by = ("" if sort_dir == "ASC" else "-") + sort_field
-        maps = maps.order_by(order_by)
+    maps = Map.objects.select_related('owner').extra(select={
+        'owner_name': _MAPS_OWNER_NAME_SQL % {
+            'contact': Contact._meta.db_table,
+            'map': Map._meta.db_table
+        }
+    })
+
+    if keywords:
+        # matching and ordering is left to the map index, so only the page
+        # itself is read from the database
+        ids = map_text_index.search(keywords, sort_field, descending)
+        total = len(ids)
+        offset = start
+        if position:
+            try:
+                offset = ids.index(position[1]) + 1
+            except ValueError:
+                pass
+        start = offset
+        page_ids = ids[start:start + limit]
+        by_id = maps.in_bulk(page_ids)
+        page = [by_id[i] for i in page_ids if i in by_id]
+    else:
+        # the total is kept across pages
+        total = search_cache.get(('maps_count',))
+        if total is None:
+            total = Map.objects.count()
+            search_cache.put(('maps_count',), total)
+
+        # id breaks ties so that the order is total and a cursor is unambiguous
+        prefix = "-" if descending else ""
+        if sort_field in (None, 'id'):
+            maps = maps.order_by(prefix + 'id')
+        else:
+            maps = maps.order_by(prefix + sort_field, prefix + 'id')
+
+        if position:
+            value, map_id = position
+            field = sort_field or 'id'
+            op = "lt" if descending else "gt"
+            page = maps.filter(
+                  Q(**{"%s__%s" % (field, op): value})
+                | Q(**{field: value, "id__%s" % op: map_id}))[:limit]
+        else:
+            page = maps[start:start+limit]
 
     maps_list = []
-
-    for map in maps.all()[start:start+limit]:
-        try:
-            owner_name = Contact.objects.get(user=map.owner).name
-        except:
+    last = None
+    for map in page:
+        owner_name = map.owner_name
+        if not owner_name and map.owner is not None:
             owner_name = map.owner.first_name + " " + map.owner.last_name
 
         mapdict = {
@@ -1551,29 +1907,39 @@ def _maps_search(query, start, limit, sort_field, sort_dir):
             'abstract' : map.abstract,
             'detail' : reverse('geonode.maps.views.map_controller', args=(map.id,)),
             'owner' : owner_name,
-            'owner_detail' : reverse('profiles.views.profile_detail', args=(map.owner.username,)),
+            'owner_detail' : map.owner and reverse('profiles.views.profile_detail', args=(map.owner.username,)),
             'last_modified' : map.last_modified.isoformat()
             }
         maps_list.append(mapdict)
+        last = map
 
     result = {'rows': maps_list, 
-              'total': maps.count()}
+              'total': total}
 
     result['query_info'] = {
         'start': start,
         'limit': limit,
         'q': query
     }
+    if position:
+        result['query_info']['after'] = after
+
+    link_params = {'q': query, 'limit': limit}
+    if sort_field:
+        link_params['sort'] = sort_field
+    if descending:
+        link_params['dir'] = sort_dir
+
     if start > 0: 
         prev = max(start - limit, 0)
-        params = urlencode({'q': query, 'start': prev, 'limit': limit})
+        params = urlencode(dict(link_params, start=prev))
         result['prev'] = reverse('geonode.maps.views.maps_search') + '?' + params
 
-    next = start + limit + 1
-    if next < maps.count():
-         params = urlencode({'q': query, 'start': next - 1, 'limit': limit})
-         result['next'] = reverse('geonode.maps.views.maps_search') + '?' + params
-    
+    if last is not None and start + limit < total:
+        result['next_after'] = _encode_maps_cursor(last, sort_field or 'id')
+        params = urlencode(dict(link_params, start=start + limit, after=result['next_after']))
+        result['next'] = reverse('geonode.maps.views.maps_search') + '?' + params
+
     return result
 
 @csrf_exempt    
@@ -1676,7 +2042,8 @@ def batch_delete(request):
                 return HttpResponse("User not authorized to delete map", status=403)
 
     if "layers" in spec:
-        Layer.objects.filter(pk__in = spec["layers"]).delete()
+        with GeoNetworkBatch():
+            Layer.objects.filter(pk__in = spec["layers"]).delete()
 
     if "maps" in spec:
         Map.objects.filter(pk__in = spec["maps"]).delete()
@@ -292,6 +292,32 @@ DB_DATASTORE_HOST = ''
 DB_DATASTORE_PORT = ''
 DB_DATASTORE_TYPE=''
 
+# Seconds after which the in-process search indexes over local layers are
+# rebuilt from the database, to pick up changes made by other processes
+LOCAL_SEARCH_INDEX_TTL = 300
+
+# Set to True if GeoNetwork harvests records from other catalogs, so that
+# searches list the harvested records after the local layers
+SEARCH_HARVESTED_RECORDS = False
+
+# Data search results are cached for SEARCH_CACHE_TTL seconds, keeping at most
+# SEARCH_CACHE_SIZE result pages; the cache is emptied when a layer changes
+SEARCH_CACHE_TTL = 60
+SEARCH_CACHE_SIZE = 100
+
+# Seconds after which cached GeoNetwork metadata records are refreshed in the
+# background, and the number of records to keep
+METADATA_CACHE_TTL = 300
+METADATA_CACHE_SIZE = 500
+
+# The most records to write to GeoNetwork in one CSW transaction when layers
+# are imported or deleted in bulk
+CSW_TRANSACTION_BATCH_SIZE = 50
+
+# Directory where static embed pages are written for publicly readable maps,
+# for the web server to serve directly.  None disables them.
+MAP_EMBED_BUNDLE_ROOT = None
+
 try:
     from local_settings import *
 except ImportError:
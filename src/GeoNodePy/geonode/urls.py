@@ -31,6 +31,9 @@ urlpatterns = patterns('',
     url(r'^data/acls/?$', 'geonode.maps.views.layer_acls', name='layer_acls'),
     url(r'^data/search/?$', 'geonode.maps.views.search_page', name='search'),
     url(r'^data/search/api/?$', 'geonode.maps.views.metadata_search', name='search_api'),
+    url(r'^data/search/facets/?$', 'geonode.maps.views.search_facets', name='search_facets'),
+    url(r'^data/search/records/?$', 'geonode.maps.views.search_records', name='search_records'),
+    url(r'^data/csw/?$', 'geonode.maps.views.csw', name='csw'),
     url(r'^data/search/detail/?$', 'geonode.maps.views.search_result_detail', name='search_result_detail'),
     url(r'^data/api/batch_permissions/?$', 'geonode.maps.views.batch_permissions'),
     url(r'^data/api/batch_delete/?$', 'geonode.maps.views.batch_delete'),